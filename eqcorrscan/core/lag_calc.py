@@ -20,7 +20,7 @@ from obspy.core.event import Catalog
 from obspy.core.event import Event, Pick, WaveformStreamID
 from obspy.core.event import ResourceIdentifier, Comment
 
-from eqcorrscan.utils.correlate import get_stream_xcorr
+from eqcorrscan.utils.correlate import get_stream_xcorr, CorrelationMaxima
 from eqcorrscan.core.match_filter.family import Family
 from eqcorrscan.core.match_filter.template import Template
 from eqcorrscan.utils.plotting import plot_repicked
@@ -103,12 +103,15 @@ def _xcorr_interp(ccc, dt):
     return shift, coeff
 
 
-def _concatenate_and_correlate(streams, template, cores):
+def _concatenate_and_correlate(streams, template, cores, output="full"):
     """
     Concatenate a list of streams into one stream and correlate that with a
     template.
 
-    All traces in a stream must have the same length.
+    All traces in a stream must have the same length. With `output="max"`
+    only the maximum correlation and its index for each stream and channel
+    are returned, as a
+    :class:`eqcorrscan.utils.correlate.CorrelationMaxima`.
     """
     UsedChannel = namedtuple("UsedChannel", "channel used")
 
@@ -160,14 +163,24 @@ def _concatenate_and_correlate(streams, template, cores):
             _template += tr
     # Do correlations
     xcorr_func = get_stream_xcorr(name_or_func="fftw")
+    kwargs = dict()
+    if output == "max":
+        kwargs.update(lag_windows=[
+            (i * channel_length,
+             i * channel_length + channel_length - template_length + 1)
+            for i in range(len(streams))])
     ccc, _, chan_order = xcorr_func(
         templates=[_template], stream=concatenated_stream, stack=False,
-        cores=cores)
+        cores=cores, output=output, **kwargs)
     # Re-order used_chans
     chan_order = chan_order[0]
     for _used_chans in used_chans:
         _used_chans.sort(key=lambda chan: chan_order.index(chan.channel))
 
+    if output == "max":
+        # (template, channel, stream) -> (stream, channel)
+        return CorrelationMaxima(
+            max_cc=ccc.max_cc[0].T, lag=ccc.lag[0].T), used_chans
     # Reshape ccc output
     ccc_out = np.zeros((len(streams), len(chans),
                         channel_length - template_length + 1),
@@ -240,11 +253,16 @@ def xcorr_pick_family(family, stream, shift_len=0.2, min_cc=0.4,
         Logger.warning("Not all detections have matching data. "
                        "Proceeding anyway. HINT: Make sure SEED IDs match")
     # Correlation function needs a list of streams, we need to maintain order.
+    # Without interpolation only the maxima of the correlations are needed.
     ccc, chans = _concatenate_and_correlate(
-        streams=detect_streams, template=family.template.st, cores=cores)
+        streams=detect_streams, template=family.template.st, cores=cores,
+        output="full" if interpolate else "max")
     for i, detection_id in enumerate(detection_ids):
         detection = [d for d in family.detections if d.id == detection_id][0]
-        correlations = ccc[i]
+        if interpolate:
+            correlations = ccc[i]
+        else:
+            correlations = zip(ccc.max_cc[i], ccc.lag[i])
         picked_chans = chans[i]
         detect_stream = detect_streams_dict[detection_id]
         checksum, cccsum, used_chans = 0.0, 0.0, 0
@@ -257,8 +275,8 @@ def xcorr_pick_family(family, stream, shift_len=0.2, min_cc=0.4,
             if interpolate:
                 shift, cc_max = _xcorr_interp(correlation, dt=delta)
             else:
-                cc_max = np.amax(correlation)
-                shift = np.argmax(correlation) * delta
+                cc_max, shift = correlation
+                shift *= delta
             if np.isnan(cc_max):  # pragma: no cover
                 Logger.error(
                     'Problematic trace, no cross correlation possible')
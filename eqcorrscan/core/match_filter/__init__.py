@@ -13,13 +13,16 @@ from eqcorrscan.core.match_filter.family import Family  # NOQA
 from eqcorrscan.core.match_filter.template import (  # NOQA
     Template, read_template)  # NOQA
 from eqcorrscan.core.match_filter.tribe import Tribe, read_tribe  # NOQA
+from eqcorrscan.core.match_filter.realtime import (  # NOQA
+    RealTimeTribe, stream_packets)  # NOQA
 from eqcorrscan.core.match_filter.detection import (  # NOQA
     Detection, read_detections, get_catalog, write_catalog,  # NOQA
     write_detections)  # NOQA
 from eqcorrscan.core.match_filter.matched_filter import (  # NOQA
     MatchFilterError, match_filter)  # NOQA
 from eqcorrscan.core.match_filter.helpers import (  # NOQA
-    normxcorr2, extract_from_stream, _spike_test, temporary_directory)  # NOQA
+    normxcorr2, extract_from_stream, _spike_test, temporary_directory,  # NOQA
+    CorrelationCache, read_cccsums)  # NOQA
 
 CAT_EXT_MAP = {"QUAKEML": "xml", "SC3ML": "xml"}  # , "NORDIC": "out"}
 # TODO: add in nordic support once bugs fixed upstream - 1.2.0 Obspy PR #2195
@@ -30,7 +33,8 @@ __all__ = [
     'read_tribe', 'Detection', 'read_detections', 'get_catalog',
     'write_catalog', 'MatchFilterError',
     'normxcorr2', 'extract_from_stream', '_spike_test', 'temporary_directory',
-    'write_detections']
+    'write_detections', 'CorrelationCache', 'read_cccsums', 'RealTimeTribe',
+    'stream_packets']
 
 
 if __name__ == '__main__':
@@ -9,6 +9,8 @@ Helper functions for network matched-filter detection of seismic data.
     (https://www.gnu.org/copyleft/lesser.html)
 """
 import contextlib
+import hashlib
+import json
 import os
 import shutil
 import tarfile
@@ -16,10 +18,10 @@ import tempfile
 import logging
 
 import numpy as np
-from obspy import Stream
+from obspy import Stream, Trace, UTCDateTime
 from obspy.core.event import Event
 
-from eqcorrscan.utils.correlate import get_array_xcorr
+from eqcorrscan.utils.correlate import get_array_xcorr, get_stream_xcorr
 
 
 Logger = logging.getLogger(__name__)
@@ -386,6 +388,255 @@ def extract_from_stream(stream, detections, pad=5.0, length=30.0):
     return streams
 
 
+class CorrelationCache(object):
+    """
+    On-disk store of correlation sums for re-use between runs.
+
+    Each entry holds the (n_templates, npts) cccsums for one group of
+    templates and one chunk of data as a `.npy` file, which is read back
+    memory-mapped, alongside a json file of the channels used. Entries are
+    keyed on a hash of the template names and data, the continuous data
+    and the processing and correlation settings, so changing any of these
+    results in a new entry. :meth:`Tribe.detect` keys entries on the raw
+    data of each chunk, so that re-runs skip processing as well as
+    correlation.
+
+    :type directory: str
+    :param directory: Directory to store entries in, created if needed.
+
+    .. Note::
+        The cache does not manage its size: remove `directory` to clear it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return "CorrelationCache(directory={0})".format(self.directory)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key, "json"))
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, "{0}.{1}".format(key, extension))
+
+    @staticmethod
+    def fingerprint(stream):
+        """
+        Hash the data and headers of a stream.
+
+        :type stream: `obspy.core.stream.Stream`
+        :param stream: Stream to hash.
+
+        :return: Hex digest.
+        :rtype: str
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for tr in stream:
+            digest.update("{0} {1} {2} {3}".format(
+                tr.id, tr.stats.starttime, tr.stats.sampling_rate,
+                tr.data.dtype).encode())
+            digest.update(np.ascontiguousarray(tr.data).data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(template_names, templates, stream=None, xcorr_func=None,
+            concurrency=None, processing=None, fingerprint=None, **kwargs):
+        """
+        Hash the inputs to a correlation run.
+
+        :type template_names: list
+        :param template_names: Names of the templates.
+        :type templates: list
+        :param templates: List of template streams.
+        :type stream: `obspy.core.stream.Stream`
+        :param stream:
+            Continuous data, processed unless the `processing` used is
+            given.
+        :param xcorr_func: Name of, or callable correlation backend.
+        :type concurrency: str
+        :param concurrency: Concurrency of the correlation backend.
+        :type processing: dict
+        :param processing:
+            Settings used to process `stream` before correlation, if it is
+            raw data. Values must be json serializable.
+        :type fingerprint: str
+        :param fingerprint:
+            :meth:`fingerprint` of `stream`, to avoid hashing the same data
+            for several keys.
+        :param kwargs:
+            Other arguments to the correlation function, only str, int,
+            float, bool and None values are included.
+
+        :return: Hex digest.
+        :rtype: str
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        # Hash the functions that will run, so that the default backend is
+        # resolved and generic wrappers are told apart by what they wrap.
+        settings = {"xcorr_func": [
+            "{0}.{1}".format(func.__module__, func.__qualname__)
+            for func in (get_array_xcorr(xcorr_func),
+                         get_stream_xcorr(xcorr_func, concurrency))]}
+        settings.update({
+            key: value for key, value in kwargs.items()
+            if isinstance(value, (str, int, float, bool, type(None)))})
+        settings.update({"processing": processing})
+        digest.update(
+            json.dumps(settings, sort_keys=True, default=str).encode())
+        digest.update(json.dumps(list(template_names)).encode())
+        digest.update(CorrelationCache.fingerprint(
+            [tr for st in templates for tr in st]).encode())
+        digest.update(
+            (fingerprint or CorrelationCache.fingerprint(stream)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Read an entry.
+
+        :type key: str
+        :param key: Key from :meth:`key`.
+
+        :return:
+            Memory-mapped cccsums, list of number of channels and list of
+            channels used for each template, or None if there is no entry.
+        """
+        if key not in self:
+            return None
+        with open(self._path(key, "json"), "r") as f:
+            meta = json.load(f)
+        cccsums = np.load(self._path(key, "npy"), mmap_mode="r")
+        chans = [[tuple(chan) for chan in _chans] for _chans in meta["chans"]]
+        return cccsums, meta["no_chans"], chans
+
+    def get_info(self, key):
+        """
+        Read the information stored with an entry.
+
+        :type key: str
+        :param key: Key from :meth:`key`.
+
+        :return:
+            Dictionary given as `info` to :meth:`put`, or None if there is no
+            entry.
+        """
+        if key not in self:
+            return None
+        with open(self._path(key, "json"), "r") as f:
+            return json.load(f).get("info", {})
+
+    def put(self, key, cccsums, no_chans, chans, info=None):
+        """
+        Write an entry.
+
+        :type key: str
+        :param key: Key from :meth:`key`.
+        :type cccsums: numpy.ndarray
+        :param cccsums: Correlation sums.
+        :type no_chans: list
+        :param no_chans: Number of channels used for each template.
+        :type chans: list
+        :param chans: Channels used for each template.
+        :type info: dict
+        :param info:
+            Other json serializable information to store with the entry.
+        """
+        # Write to temporary files and move so that partial entries are
+        # never read.
+        tmp_npy = self._path(key, "tmp.npy")
+        np.save(tmp_npy, cccsums)
+        os.replace(tmp_npy, self._path(key, "npy"))
+        meta = {"no_chans": [int(n) for n in no_chans],
+                "chans": [[list(chan) for chan in _chans]
+                          for _chans in chans],
+                "info": info or {}}
+        tmp_json = self._path(key, "tmp.json")
+        with open(tmp_json, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_json, self._path(key, "json"))
+
+
+def _write_cccsums(path, cccsums, template_names, starttime,
+                   sampling_rate, no_chans, chans):
+    """
+    Write correlation sums for one chunk of data to disk.
+
+    Each template gets a directory within `path`, and each chunk a `.npy`
+    file (named by the start-time of the chunk) and a json file of the
+    timing and channels used.
+
+    :type path: str
+    :param path: Directory to write to.
+    :type cccsums: numpy.ndarray
+    :param cccsums: Correlation sums, one row per template.
+    :type template_names: list
+    :param template_names: Names of the templates in the same order.
+    :type starttime: `obspy.core.utcdatetime.UTCDateTime`
+    :param starttime: Time of the first sample of the correlation sums.
+    :type sampling_rate: float
+    :param sampling_rate: Sampling-rate of the correlation sums.
+    :type no_chans: list
+    :param no_chans: Number of channels used for each template.
+    :type chans: list
+    :param chans: Channels used for each template.
+    """
+    chunk_name = starttime.strftime("%Y%m%dT%H%M%S.%f")
+    for i, template_name in enumerate(template_names):
+        template_dir = os.path.join(path, template_name)
+        if not os.path.isdir(template_dir):
+            os.makedirs(template_dir)
+        np.save(os.path.join(template_dir, chunk_name + ".npy"), cccsums[i])
+        meta = {"starttime": str(starttime),
+                "sampling_rate": float(sampling_rate),
+                "no_chans": int(no_chans[i]),
+                "chans": [list(chan) for chan in chans[i]]}
+        with open(os.path.join(template_dir, chunk_name + ".json"), "w") as f:
+            json.dump(meta, f)
+
+
+def read_cccsums(path, template_names=None):
+    """
+    Read correlation sums written by `return_cccsums="mmap:<path>"`.
+
+    :type path: str
+    :param path: Directory the correlation sums were written to.
+    :type template_names: list
+    :param template_names:
+        Names of templates to read, if None, all templates will be read.
+
+    :return:
+        Dictionary of a :class:`obspy.core.stream.Stream` of correlation sums
+        for each template, one trace per chunk of data. Trace data are
+        read-only memory-mapped arrays.
+    :rtype: dict
+    """
+    if template_names is None:
+        template_names = sorted(
+            name for name in os.listdir(path)
+            if os.path.isdir(os.path.join(path, name)))
+    cccsums = dict()
+    for template_name in template_names:
+        template_dir = os.path.join(path, template_name)
+        st = Stream()
+        for chunk_file in sorted(os.listdir(template_dir)):
+            if not chunk_file.endswith(".json"):
+                continue
+            with open(os.path.join(template_dir, chunk_file), "r") as f:
+                meta = json.load(f)
+            data = np.load(os.path.join(
+                template_dir, chunk_file[0:-5] + ".npy"), mmap_mode="r")
+            tr = Trace(data=data, header={
+                "starttime": UTCDateTime(meta["starttime"]),
+                "sampling_rate": meta["sampling_rate"]})
+            tr.stats.no_chans = meta["no_chans"]
+            tr.stats.chans = [tuple(chan) for chan in meta["chans"]]
+            st += tr
+        cccsums.update({template_name: st})
+    return cccsums
+
+
 def normxcorr2(template, image):
     """
     Thin wrapper to eqcorrscan.utils.correlate functions.
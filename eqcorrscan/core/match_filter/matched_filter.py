@@ -11,19 +11,34 @@ with data and output the detections.
     GNU Lesser General Public License, Version 3
     (https://www.gnu.org/copyleft/lesser.html)
 """
+import functools
+import inspect
 import logging
+import math
+import queue
+import sys
+import threading
+from multiprocessing import Pool, cpu_count
 from timeit import default_timer
 
 import numpy as np
-from obspy import Catalog, UTCDateTime, Stream
+from obspy import Catalog, UTCDateTime, Stream, Trace
 
 from eqcorrscan.core.match_filter.helpers import (
-    _spike_test, extract_from_stream)
+    _spike_test, extract_from_stream, _write_cccsums)
 
-from eqcorrscan.utils.correlate import get_stream_xcorr
-from eqcorrscan.utils.findpeaks import multi_find_peaks
+from eqcorrscan.utils.correlate import (
+    get_stream_xcorr, _fftw_stream_xcorr, TemplateSpectra,
+    TEMPLATE_SPECTRA_MAX_BYTES, estimate_correlation_memory, plan_core_split)
+from eqcorrscan.utils.findpeaks import find_peaks_fused
 from eqcorrscan.utils.pre_processing import (
-    dayproc, shortproc, _prep_data_for_correlation)
+    _dayproc, _shortproc, _prep_data_for_correlation)
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None
 
 Logger = logging.getLogger(__name__)
 
@@ -71,12 +86,14 @@ def _group_detect(templates, stream, threshold, threshold_type, trig_int,
                   xcorr_func=None, concurrency=None, cores=None,
                   ignore_length=False, ignore_bad_data=False,
                   overlap="calculate", full_peaks=False, process_cores=None,
-                  **kwargs):
+                  memory_limit=None, **kwargs):
     """
     Pre-process and compute detections for a group of templates.
 
-    Will process the stream object, so if running in a loop, you will want
-    to copy the stream before passing it to this function.
+    Templates must be chunked and resampled the same, but may differ in
+    filter settings: each chunk of data is resampled once and filtered once
+    for each set of filter settings. `stream` is left intact unless
+    `pre_processed=True`, in which case it will be trimmed in place.
 
     :type templates: list
     :param templates: List of :class:`eqcorrscan.core.match_filter.Template`
@@ -88,8 +105,8 @@ def _group_detect(templates, stream, threshold, threshold_type, trig_int,
         the multiple of the median absolute deviation.
     :type threshold_type: str
     :param threshold_type:
-        The type of threshold to be used, can be MAD, absolute or
-        av_chan_corr.  See Note on thresholding below.
+        The type of threshold to be used, can be MAD, MAD_approx,
+        absolute or av_chan_corr.  See Note on thresholding below.
     :type trig_int: float
     :param trig_int:
         Minimum gap between detections from one template in seconds.
@@ -152,22 +169,49 @@ def _group_detect(templates, stream, threshold, threshold_type, trig_int,
     :param process_cores:
         Number of processes to use for pre-processing (if different to
         `cores`).
+    :type memory_limit: int
+    :param memory_limit:
+        Memory available for correlations in bytes. If set, templates will
+        be split into equal groups small enough for the estimated memory
+        use of the correlations to fit (no larger than `group_size` if that
+        is also set).
 
     :return:
         :class:`eqcorrscan.core.match_filter.Party` of families of detections.
+
+    .. Note::
+        When using the "fftw" backend, template spectra are stored in a
+        :class:`eqcorrscan.utils.correlate.TemplateSpectra` and re-used
+        for all chunks of data, up to `TEMPLATE_SPECTRA_MAX_BYTES` (or half
+        of `memory_limit` if smaller). Pass `template_spectra` as a keyword
+        argument to control this (`None` to disable).
+
+    .. Note::
+        Pass a
+        :class:`eqcorrscan.core.match_filter.helpers.CorrelationCache` as the
+        `correlation_cache` keyword argument to store correlation sums for
+        each chunk and group of templates on disk for later re-use. Unless
+        `pre_processed` or `plot` are set, entries are looked up before each
+        chunk is processed, and chunks found are neither processed nor
+        correlated.
     """
     from eqcorrscan.core.match_filter.party import Party
     from eqcorrscan.core.match_filter.family import Family
+    from eqcorrscan.core.match_filter.template import group_templates
 
     master = templates[0]
-    # Check that they are all processed the same.
+    # Check that they are all chunked and resampled the same, templates that
+    # differ only in filter settings share the processing of each chunk.
     lap = 0.0
     for template in templates:
         starts = [t.stats.starttime for t in template.st.sort(['starttime'])]
         if starts[-1] - starts[0] > lap:
             lap = starts[-1] - starts[0]
-        if not template.same_processing(master):
+        if not template.same_processing(master, ignore_filters=True):
             raise MatchFilterError('Templates must be processed the same.')
+    processing_groups = group_templates(templates)
+    if pre_processed and len(processing_groups) > 1:
+        raise MatchFilterError('Templates must be processed the same.')
     if overlap is None:
         overlap = 0.0
     elif not isinstance(overlap, float) and str(overlap) == str("calculate"):
@@ -180,67 +224,260 @@ def _group_detect(templates, stream, threshold, threshold_type, trig_int,
                 f"Overlap of {overlap} s is greater than process "
                 f"length ({master.process_length} s), ignoring overlap")
         overlap = 0
+    party = Party()
+    if "template_spectra" not in kwargs.keys() and get_stream_xcorr(
+            xcorr_func, concurrency) is _fftw_stream_xcorr:
+        # Templates do not change between chunks, compute spectra once.
+        max_bytes = TEMPLATE_SPECTRA_MAX_BYTES
+        if memory_limit is not None:
+            max_bytes = min(max_bytes, memory_limit // 2)
+        kwargs.update({"template_spectra": TemplateSpectra(
+            max_bytes=max_bytes)})
+    if memory_limit is not None:
+        group_size, predicted_memory = _memory_group_size(
+            templates=templates, memory_limit=memory_limit,
+            group_size=group_size, daylong=daylong, cores=cores,
+            cores_outer=kwargs.get("cores_outer"),
+            fft_len=kwargs.get("fft_len"),
+            template_spectra=kwargs.get("template_spectra"))
+    if group_size is not None:
+        template_groups = [
+            [processing_group[i: i + group_size]
+             for i in range(0, len(processing_group), group_size)]
+            for processing_group in processing_groups]
+    else:
+        template_groups = [[processing_group]
+                           for processing_group in processing_groups]
+    correlation_cache, cached = kwargs.get("correlation_cache"), None
     if not pre_processed:
         if process_cores is None:
             process_cores = cores
-        streams = _group_process(
-            template_group=templates, parallel=parallel_process,
+        if correlation_cache is not None and not plot:
+            # Look up the raw data before processing so that hits skip
+            # processing as well as correlation.
+            cached = functools.partial(
+                _cache_lookup, correlation_cache=correlation_cache,
+                template_groups=template_groups, daylong=daylong,
+                ignore_length=ignore_length, ignore_bad_data=ignore_bad_data,
+                xcorr_func=xcorr_func, concurrency=concurrency, **{
+                    key: value for key, value in kwargs.items()
+                    if key not in _MATCH_FILTER_ARGS})
+        # Process the next chunk while the current chunk is correlated
+        streams = _prefetch_group_process(
+            template_groups=processing_groups, parallel=parallel_process,
             cores=process_cores, stream=stream, daylong=daylong,
             ignore_length=ignore_length, ignore_bad_data=ignore_bad_data,
-            overlap=overlap)
-        for _st in streams:
-            Logger.debug(f"Processed stream:\n{_st.__str__(extended=True)}")
+            overlap=overlap, cached=cached)
     else:
         Logger.warning('Not performing any processing on the continuous data.')
-        streams = [stream]
-    detections = []
-    party = Party()
-    if group_size is not None:
-        n_groups = int(len(templates) / group_size)
-        if n_groups * group_size < len(templates):
-            n_groups += 1
-    else:
-        n_groups = 1
-    for st_chunk in streams:
-        chunk_start, chunk_end = (min(tr.stats.starttime for tr in st_chunk),
-                                  max(tr.stats.endtime for tr in st_chunk))
-        Logger.info(
-            f'Computing detections between {chunk_start} and {chunk_end}')
-        st_chunk.trim(starttime=chunk_start, endtime=chunk_end)
-        for tr in st_chunk:
-            if len(tr) > len(st_chunk[0]):
-                tr.data = tr.data[0:len(st_chunk[0])]
-        for i in range(n_groups):
-            if group_size is not None:
-                end_group = (i + 1) * group_size
-                start_group = i * group_size
-                if i == n_groups:
-                    end_group = len(templates)
+        streams = [[stream]]
+    for chunk_streams in streams:
+        for group_index, st_chunk in enumerate(chunk_streams):
+            cache_keys = [None for _ in template_groups[group_index]]
+            if cached is not None:
+                st_chunk, cache_keys = st_chunk
+            if cached is not None and all(
+                    key in correlation_cache for key in cache_keys):
+                group_detections = [
+                    _cached_detections(
+                        correlation_cache=correlation_cache, cache_key=key,
+                        templates=template_group, threshold=threshold,
+                        threshold_type=threshold_type, trig_int=trig_int,
+                        full_peaks=full_peaks,
+                        peak_cores=process_cores if cores is not None else 1,
+                        output_event=kwargs.get("output_event", True),
+                        return_cccsums=kwargs.get("return_cccsums"))
+                    for key, template_group in zip(
+                        cache_keys, template_groups[group_index])]
+            elif st_chunk is None:
+                continue
             else:
-                end_group = len(templates)
-                start_group = 0
-            template_group = [t for t in templates[start_group: end_group]]
-            detections += match_filter(
-                template_names=[t.name for t in template_group],
-                template_list=[t.st for t in template_group], st=st_chunk,
-                xcorr_func=xcorr_func, concurrency=concurrency,
-                threshold=threshold, threshold_type=threshold_type,
-                trig_int=trig_int, plot=plot, plotdir=plotdir, cores=cores,
-                full_peaks=full_peaks, peak_cores=process_cores,
-                **kwargs)
-            for template in template_group:
-                family = Family(template=template, detections=[])
-                for detection in detections:
-                    if detection.template_name == template.name:
-                        for pick in detection.event.picks:
-                            pick.time += template.prepick
-                        for origin in detection.event.origins:
-                            origin.time += template.prepick
-                        family.detections.append(detection)
-                party += family
+                Logger.debug(
+                    f"Processed stream:\n{st_chunk.__str__(extended=True)}")
+                chunk_start, chunk_end = (
+                    min(tr.stats.starttime for tr in st_chunk),
+                    max(tr.stats.endtime for tr in st_chunk))
+                Logger.info(
+                    f'Computing detections between {chunk_start} and '
+                    f'{chunk_end}')
+                st_chunk.trim(starttime=chunk_start, endtime=chunk_end)
+                for tr in st_chunk:
+                    if len(tr) > len(st_chunk[0]):
+                        tr.data = tr.data[0:len(st_chunk[0])]
+                group_detections = [
+                    match_filter(
+                        template_names=[t.name for t in template_group],
+                        template_list=[t.st for t in template_group],
+                        st=st_chunk, xcorr_func=xcorr_func,
+                        concurrency=concurrency, threshold=threshold,
+                        threshold_type=threshold_type, trig_int=trig_int,
+                        plot=plot, plotdir=plotdir, cores=cores,
+                        full_peaks=full_peaks, peak_cores=process_cores,
+                        cache_key=key, **kwargs)
+                    for key, template_group in zip(
+                        cache_keys, template_groups[group_index])]
+            for template_group, detections in zip(
+                    template_groups[group_index], group_detections):
+                for template in template_group:
+                    family = Family(template=template, detections=[])
+                    for detection in detections:
+                        if detection.template_name == template.name:
+                            for pick in detection.event.picks:
+                                pick.time += template.prepick
+                            for origin in detection.event.origins:
+                                origin.time += template.prepick
+                            family.detections.append(detection)
+                    party += family
+    if kwargs.get("template_spectra") is not None:
+        Logger.info("Template spectra used {0:.1f} MB".format(
+            kwargs["template_spectra"].nbytes / 1024 ** 2))
+    if memory_limit is not None:
+        peak_rss = _peak_rss()
+        Logger.info(
+            "Predicted correlation memory: {0:.1f} MB, observed peak RSS: "
+            "{1} MB".format(
+                predicted_memory / 1024 ** 2, "unknown" if peak_rss is None
+                else "{0:.1f}".format(peak_rss / 1024 ** 2)))
+        if peak_rss is not None and peak_rss > memory_limit:
+            Logger.warning(
+                "Peak RSS of {0:.1f} MB exceeded memory_limit of {1:.1f} "
+                "MB".format(peak_rss / 1024 ** 2, memory_limit / 1024 ** 2))
     return party
 
 
+def _memory_group_size(templates, memory_limit, group_size=None,
+                       daylong=False, cores=None, cores_outer=None,
+                       fft_len=None, template_spectra=True):
+    """
+    Work out the number of templates to correlate at once to fit in memory.
+
+    :type templates: list
+    :param templates: List of Templates, all processed the same.
+    :type memory_limit: int
+    :param memory_limit: Memory available for correlations in bytes.
+    :type group_size: int
+    :param group_size: Maximum group size.
+    :type daylong: bool
+    :param daylong: Whether data are processed in day-long chunks.
+    :type cores: int
+    :param cores: Number of cores used for correlation.
+    :type cores_outer: int
+    :param cores_outer: Number of channels correlated concurrently.
+    :type fft_len: int
+    :param fft_len: Length of fft used.
+    :type template_spectra: :class:`eqcorrscan.utils.correlate.TemplateSpectra`
+    :param template_spectra:
+        Store of template spectra, or None if spectra are not stored. The
+        spectra of all templates are kept between chunks (up to the
+        `max_bytes` of the store), so are counted for every group.
+
+    :return: Group size and estimated memory use in bytes for that size.
+    """
+    master = templates[0]
+    process_length = 86400 if daylong else master.process_length
+    image_len = int(process_length * master.samp_rate)
+    template_len = max(tr.stats.npts for t in templates for tr in t.st)
+    n_channels = len({tr.id for t in templates for tr in t.st})
+    cores_outer = plan_core_split(
+        cores=cores, n_channels=n_channels, cores_outer=cores_outer).outer
+    shape = dict(
+        n_channels=n_channels, template_len=template_len,
+        image_len=image_len, fft_len=fft_len, cores_outer=cores_outer,
+        template_spectra=False)
+    # Memory use is linear in the number of templates
+    fixed = estimate_correlation_memory(n_templates=0, **shape)
+    per_template = estimate_correlation_memory(n_templates=1, **shape) - fixed
+    if template_spectra is not None:
+        # Spectra of all templates are kept between chunks
+        stored = estimate_correlation_memory(
+            n_templates=len(templates),
+            **dict(shape, template_spectra=True)) - \
+            estimate_correlation_memory(n_templates=len(templates), **shape)
+        max_bytes = getattr(template_spectra, "max_bytes", None)
+        if max_bytes is not None:
+            stored = min(stored, max_bytes)
+        fixed += stored
+    max_size = int((memory_limit - fixed) // per_template)
+    if max_size < 1:
+        Logger.warning(
+            "memory_limit of {0:.1f} MB is below the estimated {1:.1f} MB "
+            "needed for one template, running templates one at a time".format(
+                memory_limit / 1024 ** 2,
+                (fixed + per_template) / 1024 ** 2))
+        max_size = 1
+    if group_size is not None:
+        max_size = min(max_size, group_size)
+    # Balance the groups rather than leaving a small remainder
+    n_groups = math.ceil(len(templates) / max_size)
+    group_size = math.ceil(len(templates) / n_groups)
+    predicted = fixed + group_size * per_template
+    Logger.info(
+        "Correlating {0} groups of up to {1} templates, predicted memory "
+        "use: {2:.1f} MB".format(n_groups, group_size, predicted / 1024 ** 2))
+    return group_size, predicted
+
+
+def _peak_rss():
+    """ Peak resident set size of this process in bytes, if known. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def _prefetch(iterable, buffer_size=1):
+    """
+    Iterate over `iterable` in a background thread.
+
+    Up to `buffer_size` items are computed ahead of the consumer, so that
+    producing the next item overlaps with using the current one. Errors
+    raised by `iterable` are re-raised in the consumer.
+
+    :param iterable: Iterable to consume.
+    :type buffer_size: int
+    :param buffer_size: Maximum number of items to hold ready.
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    finished = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as e:
+            _put((None, e))
+            return
+        _put((finished, None))
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        # Stop the producer if the consumer exits early
+        stop.set()
+        producer.join()
+
+
 def _group_process(template_group, parallel, cores, stream, daylong,
                    ignore_length, ignore_bad_data, overlap):
     """
@@ -274,14 +511,95 @@ def _group_process(template_group, parallel, cores, stream, daylong,
 
     :return: list of processed streams.
     """
-    master = template_group[0]
-    processed_streams = []
+    return [streams[0] for streams in _iter_group_process(
+        template_groups=[template_group], parallel=parallel, cores=cores,
+        stream=stream, daylong=daylong, ignore_length=ignore_length,
+        ignore_bad_data=ignore_bad_data, overlap=overlap)]
+
+
+def _prefetch_group_process(template_groups, parallel, cores, stream,
+                            **kwargs):
+    """
+    Process chunks with :func:`_iter_group_process` in a background thread.
+
+    Chunks are processed while the consumer correlates the previous chunk,
+    using :func:`_prefetch`. Parallel processing uses a single pool of
+    processes started here, in the calling thread, before the background
+    thread exists: forking from the background thread while the consumer
+    is running multi-threaded FFTW or OpenMP code can deadlock the child
+    processes.
+
+    Arguments are as for :func:`_iter_group_process`.
+
+    :return: Iterator of lists of processed streams for each chunk.
+    """
+    pool = None
+    if parallel:
+        pool = Pool(processes=min(cores or cpu_count(), max(len(stream), 1)))
+    try:
+        yield from _prefetch(_iter_group_process(
+            template_groups=template_groups, parallel=parallel, cores=cores,
+            stream=stream, pool=pool, **kwargs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _iter_group_process(template_groups, parallel, cores, stream, daylong,
+                        ignore_length, ignore_bad_data, overlap, pool=None,
+                        cached=None):
+    """
+    Process data into chunks for one or more groups of templates.
+
+    Generator version of :func:`_group_process`, chunks are processed as
+    they are requested. All templates must be chunked and resampled the
+    same, but groups may have different filter settings: each chunk is
+    gap-filled, detrended and resampled once, then filtered once for each
+    unique set of filter settings.
+
+    :type template_groups: list
+    :param template_groups:
+        List of lists of Templates, each list with the same processing.
+    :type pool: multiprocessing.pool.Pool
+    :param pool:
+        Pool to process with when `parallel` is True, if None then a pool
+        is made for each chunk.
+    :type cached: callable
+    :param cached:
+        Called with the raw data, start-time and end-time of each chunk
+        before it is processed, returning a list of (hit, value) tuples, one
+        for each group. Groups with a hit are not processed.
+
+    Other arguments are as for :func:`_group_process`.
+
+    :return:
+        Iterator of lists of processed streams for each chunk, one for each
+        group (None where data quality for that group is insufficient or, if
+        `cached` is given, for a hit). If `cached` is given each item is a
+        tuple of the processed stream and the value returned by `cached`.
+    """
+    master = template_groups[0][0]
+    filters = []
+    for group in template_groups:
+        _filter = (group[0].lowcut, group[0].highcut, group[0].filt_order)
+        if _filter not in filters:
+            filters.append(_filter)
+    filter_index = [
+        filters.index((group[0].lowcut, group[0].highcut,
+                       group[0].filt_order)) for group in template_groups]
+    if len(filters) > 1:
+        Logger.info(
+            f"Resampling data once for {len(filters)} sets of filters")
+    # Sort a shallow copy (by end-time, then start-time) to leave the input
+    # stream untouched.
+    stream = Stream(sorted(
+        stream, key=lambda tr: (tr.stats.endtime, tr.stats.starttime)))
     kwargs = {
-        'filt_order': master.filt_order,
-        'highcut': master.highcut, 'lowcut': master.lowcut,
+        'filters': filters,
         'samp_rate': master.samp_rate, 'parallel': parallel,
         'num_cores': cores, 'ignore_length': ignore_length,
-        'ignore_bad_data': ignore_bad_data}
+        'ignore_bad_data': ignore_bad_data, 'pool': pool}
     # Processing always needs to be run to account for gaps - pre-process will
     # check whether filtering and resampling needs to be done.
     process_length = master.process_length
@@ -290,7 +608,7 @@ def _group_process(template_group, parallel, cores, stream, daylong,
             Logger.warning(
                 'Processing day-long data, but template was cut from %i s long'
                 ' data, will reduce correlations' % master.process_length)
-        func = dayproc
+        func = _dayproc
         process_length = 86400
         # Check that data all start on the same day, otherwise strange
         # things will happen...
@@ -298,14 +616,14 @@ def _group_process(template_group, parallel, cores, stream, daylong,
         if not len(list(set(starttimes))) == 1:
             Logger.warning('Data start on different days, setting to last day')
             starttime = UTCDateTime(
-                stream.sort(['starttime'])[-1].stats.starttime.date)
+                max(tr.stats.starttime for tr in stream).date)
         else:
-            starttime = stream.sort(['starttime'])[0].stats.starttime
+            starttime = min(tr.stats.starttime for tr in stream)
     else:
         # We want to use shortproc to allow overlaps
-        func = shortproc
-        starttime = stream.sort(['starttime'])[0].stats.starttime
-    endtime = stream.sort(['endtime'])[-1].stats.endtime
+        func = _shortproc
+        starttime = min(tr.stats.starttime for tr in stream)
+    endtime = max(tr.stats.endtime for tr in stream)
     data_len_samps = round((endtime - starttime) * master.samp_rate) + 1
     assert overlap < process_length, "Overlap must be less than process length"
     chunk_len_samps = (process_length - overlap) * master.samp_rate
@@ -347,37 +665,57 @@ def _group_process(template_group, parallel, cores, stream, daylong,
                     " this.".format(
                         tr.id, tr.stats.starttime, tr.stats.endtime))
         if len(chunk_stream) > 0:
-            Logger.debug(
-                f"Processing chunk:\n{chunk_stream.__str__(extended=True)}")
-            _processed_stream = func(st=chunk_stream, **kwargs)
-            # If data have more zeros then pre-processing will return a
-            # trace of 0 length
-            _processed_stream.traces = [
-                tr for tr in _processed_stream if tr.stats.npts != 0]
-            if len(_processed_stream) == 0:
-                Logger.warning(
-                    f"Data quality insufficient between {kwargs['starttime']}"
-                    f" and {_endtime}")
-                continue
-            # Pre-procesing does additional checks for zeros - we need to check
-            # again whether we actually have something useful from this.
-            processed_chunk_stream_lengths = [
-                tr.stats.endtime - tr.stats.starttime
-                for tr in _processed_stream]
-            if min(processed_chunk_stream_lengths) >= .8 * process_length:
-                processed_streams.append(_processed_stream)
+            chunk_cache = None
+            if cached is not None:
+                chunk_cache = cached(
+                    chunk_stream, kwargs['starttime'], _endtime)
+            # Only filter for groups without a cached result
+            needed = sorted({
+                filter_index[i] for i in range(len(template_groups))
+                if chunk_cache is None or not chunk_cache[i][0]})
+            processed_streams = [None for _ in filters]
+            if len(needed) == 0:
+                Logger.info(
+                    f"Using cached results between {kwargs['starttime']} "
+                    f"and {_endtime}, not processing")
             else:
-                Logger.warning(
-                    f"Data quality insufficient between {kwargs['starttime']}"
-                    f" and {_endtime}")
-                continue
-
-    if _endtime < stream[0].stats.endtime:
+                Logger.debug(
+                    f"Processing chunk:\n"
+                    f"{chunk_stream.__str__(extended=True)}")
+                _processed_streams = func(st=chunk_stream, **dict(
+                    kwargs, filters=[filters[i] for i in needed]))
+                for i, _processed_stream in zip(needed, _processed_streams):
+                    # If data have more zeros then pre-processing will
+                    # return a trace of 0 length
+                    _processed_stream.traces = [
+                        tr for tr in _processed_stream if tr.stats.npts != 0]
+                    # Pre-procesing does additional checks for zeros - we
+                    # need to check again whether we actually have something
+                    # useful.
+                    if len(_processed_stream) == 0 or min(
+                            tr.stats.endtime - tr.stats.starttime
+                            for tr in _processed_stream) < \
+                            .8 * process_length:
+                        Logger.warning(
+                            f"Data quality insufficient between "
+                            f"{kwargs['starttime']} and {_endtime}")
+                        _processed_stream = None
+                    processed_streams[i] = _processed_stream
+            group_streams = [processed_streams[i] for i in filter_index]
+            if chunk_cache is not None:
+                if any(st is not None for st in group_streams) or any(
+                        hit for hit, _ in chunk_cache):
+                    yield [(st, value) for st, (_, value) in zip(
+                        group_streams, chunk_cache)]
+            elif any(st is not None for st in group_streams):
+                yield group_streams
+
+    first_endtime = min(tr.stats.endtime for tr in stream)
+    if _endtime < first_endtime:
         Logger.warning(
             "Last bit of data between {0} and {1} will go unused "
             "because it is shorter than a chunk of {2} s".format(
-                _endtime, stream[0].stats.endtime, process_length))
-    return processed_streams
+                _endtime, first_endtime, process_length))
 
 
 def match_filter(template_names, template_list, st, threshold,
@@ -385,7 +723,8 @@ def match_filter(template_names, template_list, st, threshold,
                  xcorr_func=None, concurrency=None, cores=None,
                  plot_format='png', output_cat=False, output_event=True,
                  extract_detections=False, arg_check=True, full_peaks=False,
-                 peak_cores=None, spike_test=True, **kwargs):
+                 peak_cores=None, spike_test=True, correlation_cache=None,
+                 cache_key=None, return_cccsums=None, **kwargs):
     """
     Main matched-filter detection function.
 
@@ -413,7 +752,8 @@ def match_filter(template_names, template_list, st, threshold,
     :param threshold: A threshold value set based on the threshold_type
     :type threshold_type: str
     :param threshold_type:
-        The type of threshold to be used, can be MAD, absolute or av_chan_corr.
+        The type of threshold to be used, can be MAD, MAD_approx, absolute or
+        av_chan_corr.
         See Note on thresholding below.
     :type trig_int: float
     :param trig_int:
@@ -468,11 +808,35 @@ def match_filter(template_names, template_list, st, threshold,
     :type spike_test: bool
     :param spike_test: If set True, raise error when there is a spike in data.
         defaults to True.
+    :type correlation_cache:
+        :class:`eqcorrscan.core.match_filter.helpers.CorrelationCache`
+    :param correlation_cache:
+        Cache to read correlation sums from, or store them in. If these
+        templates have been correlated with these data using the same
+        settings before, the correlations are read from the cache and only
+        thresholding and peak-finding are run.
+    :type cache_key: str
+    :param cache_key:
+        Key of the correlation sums in `correlation_cache`, defaults to
+        :meth:`CorrelationCache.key` of the templates, data and correlation
+        settings.
+    :type return_cccsums: str
+    :param return_cccsums:
+        Set to `"mmap:<path>"` to write the correlation sums to the
+        directory `<path>`, see note below.
 
     .. Note::
         When using the "fftw" correlation backend the length of the fft
         can be set. See :mod:`eqcorrscan.utils.correlate` for more info.
 
+    .. Note::
+        With `return_cccsums="mmap:<path>"` the correlation sums for each
+        template are written to `<path>/<template name>/`, one `.npy` file
+        for each call (named by the start-time of the data), alongside a
+        json file of the start-time, sampling-rate and channels used. Use
+        :func:`eqcorrscan.core.match_filter.helpers.read_cccsums` to read
+        them back as memory-mapped traces.
+
     .. note::
         **Returns:**
 
@@ -540,6 +904,12 @@ def match_filter(template_names, template_list, st, threshold,
 
         where :math:`cccsum` is the cross-correlation sum for a given template.
 
+        **MAD_approx** is the MAD threshold using a histogram estimate of
+        the median, which avoids copying and partially sorting each cccsum.
+        The estimate is within :math:`max(abs(cccsum)) / (2 \\times 1024^2)`
+        of the exact median, see
+        :func:`eqcorrscan.utils.findpeaks.median_abs`.
+
         **absolute** threshold is a true absolute threshold based on the
         cccsum value.
 
@@ -600,7 +970,6 @@ def match_filter(template_names, template_list, st, threshold,
         ...     xcorr_func=custom_normxcorr)  # doctest:+ELLIPSIS
         calling custom xcorr function...
     """
-    from eqcorrscan.core.match_filter.detection import Detection
     from eqcorrscan.utils.plotting import _match_filter_plot
 
     if "plotvar" in kwargs.keys():
@@ -624,9 +993,10 @@ def match_filter(template_names, template_list, st, threshold,
         if not isinstance(st, Stream):
             msg = 'st must be of type: obspy.core.stream.Stream'
             raise MatchFilterError(msg)
-        if str(threshold_type) not in [str('MAD'), str('absolute'),
-                                       str('av_chan_corr')]:
-            msg = 'threshold_type must be one of: MAD, absolute, av_chan_corr'
+        if str(threshold_type) not in [str('MAD'), str('MAD_approx'),
+                                       str('absolute'), str('av_chan_corr')]:
+            msg = ('threshold_type must be one of: MAD, MAD_approx, '
+                   'absolute, av_chan_corr')
             raise MatchFilterError(msg)
         for tr in st:
             if not tr.stats.sampling_rate == st[0].stats.sampling_rate:
@@ -644,6 +1014,11 @@ def match_filter(template_names, template_list, st, threshold,
                 if isinstance(tr.data, np.ma.core.MaskedArray):
                     raise MatchFilterError(
                         'Template contains masked array, split first')
+    if return_cccsums is not None and not str(return_cccsums).startswith(
+            "mmap:"):
+        raise MatchFilterError(
+            "return_cccsums must be of the form mmap:<path>, not {0}".format(
+                return_cccsums))
     if spike_test:
         Logger.info("Checking for spikes in data")
         _spike_test(st)
@@ -668,83 +1043,258 @@ def match_filter(template_names, template_list, st, threshold,
     for template in templates:
         Logger.debug(template.__str__())
     Logger.debug(stream.__str__())
-    multichannel_normxcorr = get_stream_xcorr(xcorr_func, concurrency)
-    outtic = default_timer()
-    [cccsums, no_chans, chans] = multichannel_normxcorr(
-        templates=templates, stream=stream, cores=cores, **kwargs)
-    if len(cccsums[0]) == 0:
-        raise MatchFilterError('Correlation has not run, zero length cccsum')
-    outtoc = default_timer()
-    Logger.info('Looping over templates and streams took: {0:.4f}s'.format(
-        outtoc - outtic))
+    cached = None
+    if correlation_cache is not None:
+        if cache_key is None:
+            cache_key = correlation_cache.key(
+                template_names=_template_names, templates=templates,
+                stream=stream, xcorr_func=xcorr_func,
+                concurrency=concurrency, **kwargs)
+        cached = correlation_cache.get(cache_key)
+    if cached is not None:
+        Logger.info("Read correlations from {0}".format(correlation_cache))
+        cccsums, no_chans, chans = cached
+    else:
+        multichannel_normxcorr = get_stream_xcorr(xcorr_func, concurrency)
+        outtic = default_timer()
+        [cccsums, no_chans, chans] = multichannel_normxcorr(
+            templates=templates, stream=stream, cores=cores, **kwargs)
+        if len(cccsums[0]) == 0:
+            raise MatchFilterError(
+                'Correlation has not run, zero length cccsum')
+        outtoc = default_timer()
+        Logger.info(
+            'Looping over templates and streams took: {0:.4f}s'.format(
+                outtoc - outtic))
+        if correlation_cache is not None:
+            # Enough to match the templates to the correlations without
+            # the data, see _cached_detections
+            correlation_cache.put(
+                cache_key, cccsums, no_chans, chans, info={
+                    "starttime": str(stream[0].stats.starttime),
+                    "sampling_rate": stream[0].stats.sampling_rate,
+                    "seed_ids": [tr.id for tr in stream]})
+    if return_cccsums is not None:
+        cccsum_path = return_cccsums[len("mmap:"):]
+        Logger.info("Writing correlation sums to {0}".format(cccsum_path))
+        _write_cccsums(
+            path=cccsum_path, cccsums=cccsums, template_names=_template_names,
+            starttime=stream[0].stats.starttime,
+            sampling_rate=stream[0].stats.sampling_rate, no_chans=no_chans,
+            chans=chans)
     Logger.debug(
         'The shape of the returned cccsums is: {0}'.format(cccsums.shape))
     Logger.debug(
         'This is from {0} templates correlated with {1} channels of '
         'data'.format(len(templates), len(stream)))
-    detections = []
+    detections, thresholds = _detections_from_cccsums(
+        cccsums=cccsums, no_chans=no_chans, chans=chans,
+        template_names=_template_names, templates=templates,
+        starttime=stream[0].stats.starttime,
+        sampling_rate=stream[0].stats.sampling_rate, threshold=threshold,
+        threshold_type=threshold_type, trig_int=trig_int,
+        full_peaks=full_peaks, peak_cores=peak_cores if parallel else 1,
+        output_event=output_cat or output_event)
+    if plot:
+        for i, cccsum in enumerate(cccsums):
+            _match_filter_plot(
+                stream=stream, cccsum=cccsum, template_names=_template_names,
+                rawthresh=thresholds[i], plotdir=plotdir,
+                plot_format=plot_format, i=i)
     if output_cat:
-        det_cat = Catalog()
-    if str(threshold_type) == str("absolute"):
-        thresholds = [threshold for _ in range(len(cccsums))]
-    elif str(threshold_type) == str('MAD'):
-        thresholds = [threshold * np.median(np.abs(cccsum))
-                      for cccsum in cccsums]
+        det_cat = Catalog([detection.event for detection in detections])
+    if extract_detections:
+        detection_streams = extract_from_stream(stream, detections)
+    del stream, templates
+
+    if output_cat and not extract_detections:
+        return detections, det_cat
+    elif not extract_detections:
+        return detections
+    elif extract_detections and not output_cat:
+        return detections, detection_streams
     else:
+        return detections, det_cat, detection_streams
+
+
+# Arguments used by match_filter rather than the correlation function
+_MATCH_FILTER_ARGS = set(inspect.signature(match_filter).parameters)
+
+
+def _cache_lookup(chunk_stream, starttime, endtime, correlation_cache,
+                  template_groups, daylong, ignore_length, ignore_bad_data,
+                  xcorr_func=None, concurrency=None, **kwargs):
+    """
+    Look up correlations for a chunk of raw data in a cache.
+
+    Entries are keyed on the raw data, the processing settings and the
+    templates, so that hits need neither processing nor correlation.
+
+    :type chunk_stream: `obspy.core.stream.Stream`
+    :param chunk_stream: Raw data for the chunk.
+    :type starttime: `obspy.core.utcdatetime.UTCDateTime`
+    :param starttime: Start of the chunk.
+    :type endtime: `obspy.core.utcdatetime.UTCDateTime`
+    :param endtime: End of the chunk.
+    :type correlation_cache:
+        :class:`eqcorrscan.core.match_filter.helpers.CorrelationCache`
+    :param correlation_cache: Cache to look in.
+    :type template_groups: list
+    :param template_groups:
+        For each group of identically processed templates, a list of the
+        lists of templates correlated together.
+    :param kwargs: Arguments to the correlation function.
+
+    Other arguments are as for :func:`_group_detect`.
+
+    :return:
+        List of a tuple for each processing group of whether all of its
+        entries are in the cache, and the list of keys of the entries.
+    """
+    fingerprint = correlation_cache.fingerprint(chunk_stream)
+    lookups = []
+    for group in template_groups:
+        master = group[0][0]
+        processing = dict(
+            lowcut=master.lowcut, highcut=master.highcut,
+            filt_order=master.filt_order, samp_rate=master.samp_rate,
+            process_length=master.process_length, daylong=daylong,
+            ignore_length=ignore_length, ignore_bad_data=ignore_bad_data,
+            starttime=str(starttime), endtime=str(endtime))
+        keys = [correlation_cache.key(
+            template_names=[t.name for t in template_group],
+            templates=[t.st for t in template_group], xcorr_func=xcorr_func,
+            concurrency=concurrency, processing=processing,
+            fingerprint=fingerprint, **kwargs)
+            for template_group in group]
+        lookups.append((all(key in correlation_cache for key in keys), keys))
+    return lookups
+
+
+def _detections_from_cccsums(cccsums, no_chans, chans, template_names,
+                             templates, starttime, sampling_rate, threshold,
+                             threshold_type, trig_int, full_peaks=False,
+                             peak_cores=1, output_event=True):
+    """
+    Threshold correlation sums and make detections from their peaks.
+
+    :type cccsums: numpy.ndarray
+    :param cccsums: Correlation sums, one row per template.
+    :type no_chans: list
+    :param no_chans: Number of channels used for each template.
+    :type chans: list
+    :param chans: Channels used for each template.
+    :type template_names: list
+    :param template_names: Names of the templates in the same order.
+    :type templates: list
+    :param templates:
+        Template streams as correlated (see
+        :func:`eqcorrscan.utils.pre_processing._prep_data_for_correlation`)
+    :type starttime: `obspy.core.utcdatetime.UTCDateTime`
+    :param starttime: Time of the first sample of the correlation sums.
+    :type sampling_rate: float
+    :param sampling_rate: Sampling-rate of the correlation sums.
+    :type peak_cores: int
+    :param peak_cores: Number of threads to use for peak-finding.
+    :type output_event: bool
+    :param output_event: Whether to include events in the Detections.
+
+    Other arguments are as for :func:`match_filter`.
+
+    :return: List of Detections, and the threshold for each template.
+    """
+    from eqcorrscan.core.match_filter.detection import Detection
+
+    detections = []
+    if str(threshold_type) == str('av_chan_corr'):
         thresholds = [threshold * no_chans[i] for i in range(len(cccsums))]
-    if peak_cores is None:
-        peak_cores = cores
+    else:
+        # MAD thresholds are computed alongside peak finding
+        thresholds = [threshold for _ in range(len(cccsums))]
     outtic = default_timer()
-    all_peaks = multi_find_peaks(
-        arr=cccsums, thresh=thresholds, parallel=parallel,
-        trig_int=int(trig_int * stream[0].stats.sampling_rate),
-        full_peaks=full_peaks, cores=peak_cores)
+    peak_rows, peak_samples, peak_values, thresholds = find_peaks_fused(
+        arr=cccsums, thresh=thresholds,
+        mad=str(threshold_type) in ('MAD', 'MAD_approx'),
+        approximate=str(threshold_type) == 'MAD_approx',
+        trig_int=int(trig_int * sampling_rate), full_peaks=full_peaks,
+        cores=peak_cores)
+    peak_bounds = np.searchsorted(peak_rows, np.arange(len(cccsums) + 1))
     outtoc = default_timer()
     Logger.info("Finding peaks took {0:.4f}s".format(outtoc - outtic))
     for i, cccsum in enumerate(cccsums):
         if np.abs(np.mean(cccsum)) > 0.05:
             Logger.warning('Mean is not zero!  Check this!')
-        # Set up a trace object for the cccsum as this is easier to plot and
-        # maintains timing
-        if plot:
-            _match_filter_plot(
-                stream=stream, cccsum=cccsum, template_names=_template_names,
-                rawthresh=thresholds[i], plotdir=plotdir,
-                plot_format=plot_format, i=i)
-        if all_peaks[i]:
+        if peak_bounds[i + 1] > peak_bounds[i]:
             Logger.debug("Found {0} peaks for template {1}".format(
-                len(all_peaks[i]), _template_names[i]))
-            for peak in all_peaks[i]:
-                detecttime = (
-                    stream[0].stats.starttime +
-                    peak[1] / stream[0].stats.sampling_rate)
+                peak_bounds[i + 1] - peak_bounds[i], template_names[i]))
+            for j in range(peak_bounds[i], peak_bounds[i + 1]):
+                detecttime = starttime + peak_samples[j] / sampling_rate
                 detection = Detection(
-                    template_name=_template_names[i], detect_time=detecttime,
-                    no_chans=no_chans[i], detect_val=peak[0],
+                    template_name=template_names[i], detect_time=detecttime,
+                    no_chans=no_chans[i], detect_val=peak_values[j],
                     threshold=thresholds[i], typeofdet='corr', chans=chans[i],
                     threshold_type=threshold_type, threshold_input=threshold)
-                if output_cat or output_event:
+                if output_event:
                     detection._calculate_event(template_st=templates[i])
                 detections.append(detection)
-                if output_cat:
-                    det_cat.append(detection.event)
         else:
             Logger.debug("Found 0 peaks for template {0}".format(
-                _template_names[i]))
+                template_names[i]))
     Logger.info("Made {0} detections from {1} templates".format(
         len(detections), len(templates)))
-    if extract_detections:
-        detection_streams = extract_from_stream(stream, detections)
-    del stream, templates
+    return detections, thresholds
 
-    if output_cat and not extract_detections:
-        return detections, det_cat
-    elif not extract_detections:
-        return detections
-    elif extract_detections and not output_cat:
-        return detections, detection_streams
-    else:
-        return detections, det_cat, detection_streams
+
+def _cached_detections(correlation_cache, cache_key, templates, threshold,
+                       threshold_type, trig_int, full_peaks=False,
+                       peak_cores=1, output_event=True, return_cccsums=None):
+    """
+    Make detections from correlation sums stored by :func:`match_filter`.
+
+    The continuous data are not needed: the templates are matched to the
+    stored channels as :func:`match_filter` matched them to the data.
+
+    :type correlation_cache:
+        :class:`eqcorrscan.core.match_filter.helpers.CorrelationCache`
+    :param correlation_cache: Cache holding the correlation sums.
+    :type cache_key: str
+    :param cache_key: Key of the correlation sums.
+    :type templates: list
+    :param templates: List of :class:`eqcorrscan.core.match_filter.Template`
+
+    Other arguments are as for :func:`_detections_from_cccsums` and
+    :func:`match_filter`.
+
+    :return: List of Detections.
+    """
+    Logger.info("Read correlations from {0}".format(correlation_cache))
+    cccsums, no_chans, chans = correlation_cache.get(cache_key)
+    info = correlation_cache.get_info(cache_key)
+    starttime = UTCDateTime(info["starttime"])
+    sampling_rate = info["sampling_rate"]
+    # Only the channels of the data are used to match templates
+    channels = Stream([
+        Trace(data=np.zeros(1, dtype=np.float32), header=dict(
+            zip(("network", "station", "location", "channel"),
+                seed_id.split(".")),
+            starttime=starttime, sampling_rate=sampling_rate))
+        for seed_id in info["seed_ids"]])
+    _, template_streams, template_names = _prep_data_for_correlation(
+        stream=channels, templates=[t.st.copy() for t in templates],
+        template_names=[t.name for t in templates])
+    if return_cccsums is not None:
+        _write_cccsums(
+            path=return_cccsums[len("mmap:"):], cccsums=cccsums,
+            template_names=template_names, starttime=starttime,
+            sampling_rate=sampling_rate, no_chans=no_chans, chans=chans)
+    detections, _ = _detections_from_cccsums(
+        cccsums=cccsums, no_chans=no_chans, chans=chans,
+        template_names=template_names, templates=template_streams,
+        starttime=starttime, sampling_rate=sampling_rate,
+        threshold=threshold, threshold_type=threshold_type,
+        trig_int=trig_int, full_peaks=full_peaks, peak_cores=peak_cores,
+        output_event=output_event)
+    return detections
 
 
 if __name__ == "__main__":
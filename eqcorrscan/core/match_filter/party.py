@@ -417,7 +417,9 @@ class Party(object):
         :type new_threshold: float
         :param new_threshold: New threshold level
         :type new_threshold_type: str
-        :param new_threshold_type: Either 'MAD', 'absolute' or 'av_chan_corr'
+        :param new_threshold_type:
+            Either 'MAD', 'MAD_approx', 'absolute' or 'av_chan_corr'. MAD
+            types can only be used on detections made with the same type.
 
         .. rubric:: Examples
 
@@ -448,13 +450,15 @@ class Party(object):
         for family in self.families:
             rethresh_detections = []
             for d in family.detections:
-                if new_threshold_type == 'MAD' and d.threshold_type == 'MAD':
+                if (new_threshold_type in ('MAD', 'MAD_approx') and
+                        d.threshold_type == new_threshold_type):
                     new_thresh = (d.threshold /
                                   d.threshold_input) * new_threshold
-                elif new_threshold_type == 'MAD' and d.threshold_type != 'MAD':
+                elif new_threshold_type in ('MAD', 'MAD_approx'):
                     raise MatchFilterError(
-                        'Cannot recalculate MAD level, '
-                        'use another threshold type')
+                        'Cannot recalculate {0} level, '
+                        'use another threshold type'.format(
+                            new_threshold_type))
                 elif new_threshold_type == 'absolute':
                     new_thresh = new_threshold
                 elif new_threshold_type == 'av_chan_corr':
@@ -574,12 +578,11 @@ class Party(object):
                 peaks=detect_vals, index=detect_times,
                 trig_int=trig_int * 10 ** 6)
         # Need to match both the time and the detection value
-        declustered_detections = []
-        for ind in peaks_out:
-            matching_time_indices = np.where(detect_times == ind[-1])[0]
-            matches = matching_time_indices[
-                np.where(detect_vals[matching_time_indices] == ind[0])[0][0]]
-            declustered_detections.append(all_detections[matches])
+        detection_lookup = {}
+        for i, key in enumerate(zip(detect_times, detect_vals)):
+            detection_lookup.setdefault(key, all_detections[i])
+        declustered_detections = [
+            detection_lookup[(ind[-1], ind[0])] for ind in peaks_out]
         # Convert this list into families
         template_names = list(set([d.template_name
                                    for d in declustered_detections]))
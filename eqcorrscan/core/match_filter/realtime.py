@@ -0,0 +1,596 @@
+"""
+Real-time matched-filter detection of streaming seismic data.
+
+Data are received as packets (short traces, as delivered by SeedLink or a
+file tailer) and held in rolling buffers. Each step only processes and
+correlates the newly received data (plus the overlap needed for the
+templates and filters), so the cost of correlation does not grow with the
+length of the buffer. MAD thresholds are computed from the whole
+correlation buffer at every step, so their cost does.
+
+:copyright:
+    EQcorrscan developers.
+
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+import logging
+import math
+from collections import namedtuple
+from timeit import default_timer
+
+import numpy as np
+from obspy import Stream, Trace
+
+from eqcorrscan.core.match_filter.detection import Detection
+from eqcorrscan.core.match_filter.matched_filter import MatchFilterError
+from eqcorrscan.core.match_filter.template import group_templates
+from eqcorrscan.core.match_filter.tribe import Tribe
+from eqcorrscan.utils.correlate import (
+    get_stream_xcorr, _fftw_stream_xcorr, TemplateSpectra, _default_fft_len)
+from eqcorrscan.utils.findpeaks import median_abs, multi_find_peaks
+from eqcorrscan.utils.pre_processing import (
+    _shortproc, _prep_data_for_correlation)
+
+Logger = logging.getLogger(__name__)
+
+
+StepMetrics = namedtuple(
+    "StepMetrics",
+    ["endtime", "samples", "duration", "speed", "latency", "detections"])
+StepMetrics.__doc__ = """
+Metrics for one step of a :class:`RealTimeTribe`.
+
+endtime: End of the data available for the step.
+samples: Number of new correlation samples computed (summed over groups).
+duration: Wall-clock time taken by the step in seconds.
+speed: Seconds of data correlated per second of wall-clock time.
+latency:
+    Maximum delay in seconds between a sample arriving and a detection at
+    that sample being returned, including the time taken by the step.
+detections: Number of detections returned by the step.
+"""
+
+
+class _RingBuffer(object):
+    """
+    Fixed-capacity buffer keeping the most recent samples.
+
+    Samples are addressed by their absolute index, which increases by one
+    for every sample appended.
+
+    :type capacity: int
+    :param capacity: Number of samples to keep.
+    :type shape: tuple
+    :param shape: Shape of the leading (non-time) dimensions.
+    :type dtype: numpy.dtype
+    :param dtype: Data type of the buffer.
+    """
+    def __init__(self, capacity, shape=(), dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros(tuple(shape) + (capacity, ), dtype=dtype)
+        self.written = 0
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def first(self):
+        """ Absolute index of the oldest sample held. """
+        return self.written - len(self)
+
+    def skip_to(self, index):
+        """ Discard the held samples and continue from absolute index. """
+        if index != self.written:
+            self.written, self._count = index, 0
+
+    def append(self, data):
+        """ Append data along the last axis. """
+        n = data.shape[-1]
+        if n > self.capacity:
+            data = data[..., n - self.capacity:]
+        index = np.arange(
+            self.written + n - data.shape[-1], self.written + n
+        ) % self.capacity
+        self.data[..., index] = data
+        self.written += n
+        self._count += n
+
+    def get(self, start, end):
+        """ Copy of the held samples with absolute indexes start to end-1. """
+        start, end = max(start, self.first), min(end, self.written)
+        index = np.arange(start, max(start, end)) % self.capacity
+        return self.data[..., index]
+
+
+class _ChannelBuffer(object):
+    """
+    Rolling buffer of raw data for one channel.
+
+    Gaps between packets are filled with zeros, and samples that overlap
+    data already received are discarded.
+    """
+    def __init__(self, trace, buffer_length):
+        self.stats = trace.stats.copy()
+        self.sampling_rate = trace.stats.sampling_rate
+        self.starttime = trace.stats.starttime
+        self.ring = _RingBuffer(
+            capacity=int(math.ceil(buffer_length * self.sampling_rate)))
+        self.received = None
+
+    @property
+    def endtime(self):
+        """ Time of the most recent sample. """
+        return self.starttime + (self.ring.written - 1) / self.sampling_rate
+
+    @property
+    def first_time(self):
+        """ Time of the oldest sample held. """
+        return self.starttime + self.ring.first / self.sampling_rate
+
+    def append(self, trace):
+        offset = int(round(
+            (trace.stats.starttime - self.starttime) * self.sampling_rate))
+        data = trace.data
+        if offset < self.ring.written:
+            data = data[self.ring.written - offset:]
+        elif offset > self.ring.written:
+            Logger.info("Gap of {0} samples for {1}, filling with "
+                        "zeros".format(offset - self.ring.written, trace.id))
+            self.ring.append(np.zeros(offset - self.ring.written))
+        if len(data):
+            self.ring.append(data)
+            self.received = default_timer()
+
+    def get_trace(self, starttime, endtime):
+        """ Trace of the buffered data between starttime and endtime. """
+        start = int(math.floor(
+            (starttime - self.starttime) * self.sampling_rate)) - 1
+        end = int(math.ceil(
+            (endtime - self.starttime) * self.sampling_rate)) + 2
+        start = max(start, self.ring.first)
+        data = self.ring.get(start, end)
+        header = self.stats.copy()
+        header.starttime = self.starttime + start / self.sampling_rate
+        header.npts = len(data)
+        return Trace(data=data, header=header)
+
+
+class _GroupState(object):
+    """ Correlation state for a group of identically processed templates. """
+    def __init__(self, templates, buffer_length):
+        self.templates = templates
+        master = templates[0]
+        self.samp_rate = master.samp_rate
+        self.filters = [(master.lowcut, master.highcut, master.filt_order)]
+        self.seed_ids = {tr.id for template in templates
+                         for tr in template.st}
+        self.span = max(
+            int(round((max(tr.stats.endtime for tr in template.st) -
+                       min(tr.stats.starttime for tr in template.st)) *
+                      self.samp_rate)) + 1
+            for template in templates)
+        self.history = _RingBuffer(
+            capacity=int(math.ceil(buffer_length * self.samp_rate)),
+            shape=(len(templates), ), dtype=np.float32)
+        self.next_index = None
+        self.peak_from = None
+        self.no_chans = [0 for _ in templates]
+        self.chans = [[] for _ in templates]
+
+
+class RealTimeTribe(Tribe):
+    """
+    Tribe for matched-filter detection of streaming data.
+
+    Packets of data are added with :meth:`append` and detections are made
+    by :meth:`step`; :meth:`run` does both for an iterable of packets.
+    Raw data are kept in a rolling buffer for each channel. Each step
+    processes the data received since the last step (with `processing_pad`
+    seconds either side to avoid filter edge-effects) and correlates them
+    with the templates (with the template-length overlap needed to compute
+    correlations for every new sample). Template spectra are kept between
+    steps for the "fftw" correlation backend.
+
+    Detections are returned once no larger correlation can occur within
+    `trig_int` of them, so a detection is returned at most
+    `processing_pad + template length + trig_int` seconds of data (plus the
+    time taken to compute a step) after the data containing it were
+    received.
+
+    :type templates: list
+    :param templates: List of templates.
+    :type threshold: float
+    :param threshold:
+        Threshold level, as for
+        :meth:`eqcorrscan.core.match_filter.Tribe.detect`.
+    :type threshold_type: str
+    :param threshold_type:
+        The type of threshold to be used, can be MAD, MAD_approx, absolute
+        or av_chan_corr. MAD thresholds are computed from the correlations
+        held in the buffer, MAD_approx thresholds use a histogram estimate
+        of the median (see :func:`eqcorrscan.utils.findpeaks.median_abs`)
+        which is cheaper to compute for long buffers.
+    :type trig_int: float
+    :param trig_int: Minimum gap between detections from one template in
+        seconds.
+    :type buffer_length: float
+    :param buffer_length:
+        Length of the data and correlation buffers in seconds. Must be
+        longer than the data needed for a step.
+    :type processing_pad: float
+    :param processing_pad:
+        Seconds of data processed either side of the new data and then
+        discarded to remove filter edge-effects. Defaults to five periods
+        of the lowest filter corner.
+    :type channel_delay: float
+    :param channel_delay:
+        Channels whose most recent data are more than `channel_delay`
+        seconds behind the most recent data of any channel are not waited
+        for, and are treated as gaps.
+    :type xcorr_func: str or callable
+    :param xcorr_func:
+        A str of a registered xcorr function or a callable for implementing
+        a custom xcorr function. For more information see:
+        :func:`eqcorrscan.utils.correlate.register_array_xcorr`
+    :type concurrency: str
+    :param concurrency:
+        The type of concurrency to apply to the xcorr function. Options are
+        'multithread', 'multiprocess', 'concurrent'. For more details see
+        :func:`eqcorrscan.utils.correlate.get_stream_xcorr`
+    :type cores: int
+    :param cores: Number of workers for processing and detection.
+
+    Other keyword arguments are passed to the xcorr function.
+
+    .. Note::
+        MAD thresholds are computed from the correlations held in the
+        buffer, so will be noisy until the buffer has filled. They are
+        recomputed from the whole buffer at every step, so the time taken
+        grows with `buffer_length` and the number of templates.
+
+    .. Note::
+        The templates should not be changed after the first step, call
+        :meth:`reset` if they are.
+
+    .. rubric:: Example
+
+    >>> from obspy import read
+    >>> from eqcorrscan.core.match_filter import Template
+    >>> st = read()
+    >>> template = Template(
+    ...     name="test", st=read().trim(st[0].stats.starttime + 10,
+    ...                                 st[0].stats.starttime + 13),
+    ...     lowcut=2.0, highcut=8.0, samp_rate=100.0, filt_order=4,
+    ...     process_length=3600, prepick=0.5)
+    >>> rt_tribe = RealTimeTribe(
+    ...     templates=[template], threshold=0.8, threshold_type="av_chan_corr",
+    ...     trig_int=2.0)
+    >>> print(rt_tribe)
+    RealTimeTribe of 1 templates
+    """
+    def __init__(self, templates=None, threshold=8.0, threshold_type="MAD",
+                 trig_int=1.0, buffer_length=300.0, processing_pad=None,
+                 channel_delay=10.0, xcorr_func=None, concurrency=None,
+                 cores=None, **kwargs):
+        super().__init__(templates=templates)
+        if str(threshold_type) not in [
+                'MAD', 'MAD_approx', 'absolute', 'av_chan_corr']:
+            raise MatchFilterError(
+                'threshold_type must be one of: MAD, MAD_approx, absolute, '
+                'av_chan_corr')
+        self.threshold = threshold
+        self.threshold_type = threshold_type
+        self.trig_int = trig_int
+        self.buffer_length = buffer_length
+        self.processing_pad = processing_pad
+        self.channel_delay = channel_delay
+        self.xcorr_func = xcorr_func
+        self.concurrency = concurrency
+        self.cores = cores
+        self.kwargs = kwargs
+        self.reset()
+
+    def __repr__(self):
+        return "RealTimeTribe of {0} templates".format(len(self.templates))
+
+    def reset(self):
+        """ Clear buffered data, correlation state and metrics. """
+        self.buffers = {}
+        self.metrics = []
+        self._groups = None
+        self._origin = None
+        self._template_spectra = TemplateSpectra()
+
+    @property
+    def endtime(self):
+        """
+        End of the data that the next step will use.
+
+        Channels more than `channel_delay` seconds behind the most recent
+        data are ignored.
+        """
+        if len(self.buffers) == 0:
+            return None
+        ends = [buf.endtime for buf in self.buffers.values()]
+        latest = max(ends)
+        return min(end for end in ends
+                   if end >= latest - self.channel_delay)
+
+    def _pad(self, group):
+        if self.processing_pad is not None:
+            return self.processing_pad
+        corners = [corner for corner in group.filters[0][0:2] if corner]
+        return 5.0 / min(corners) if corners else 0.0
+
+    def append(self, packet):
+        """
+        Add a packet of data to the buffers.
+
+        :type packet: `obspy.core.stream.Stream` or `obspy.core.trace.Trace`
+        :param packet:
+            New data. Traces for channels not in the templates are ignored.
+            Gappy (masked) traces are split and the gaps filled with zeros.
+        """
+        if isinstance(packet, Trace):
+            packet = Stream([packet])
+        seed_ids = {tr.id for template in self.templates
+                    for tr in template.st}
+        for tr in packet.split():
+            if tr.id not in seed_ids or len(tr.data) == 0:
+                continue
+            buf = self.buffers.get(tr.id)
+            if buf is not None and \
+                    buf.sampling_rate != tr.stats.sampling_rate:
+                Logger.warning(
+                    "Sampling rate changed for {0}, discarding buffered "
+                    "data".format(tr.id))
+                buf = None
+            if buf is None:
+                buf = _ChannelBuffer(tr, buffer_length=self.buffer_length)
+                self.buffers[tr.id] = buf
+            buf.append(tr)
+            if self._origin is None:
+                self._origin = tr.stats.starttime
+
+    def step(self):
+        """
+        Correlate the data received since the last step.
+
+        :return: List of new detections.
+        :rtype: list
+        """
+        tic = default_timer()
+        endtime = self.endtime
+        if endtime is None:
+            return []
+        if self._groups is None:
+            self._groups = [
+                _GroupState(group, buffer_length=self.buffer_length)
+                for group in group_templates(self.templates)]
+        detections, samples, data_seconds, latency = [], 0, 0.0, 0.0
+        for group in self._groups:
+            n_new, finalised = self._correlate_group(group, endtime=endtime)
+            samples += n_new
+            data_seconds = max(data_seconds, n_new / group.samp_rate)
+            detections.extend(self._detect_group(group))
+            if finalised is not None:
+                latency = max(latency, endtime - finalised)
+        toc = default_timer()
+        duration = toc - tic
+        # Include the time that the newest data waited for this step
+        received = max(buf.received for buf in self.buffers.values())
+        metrics = StepMetrics(
+            endtime=endtime, samples=samples, duration=duration,
+            speed=data_seconds / duration if duration else float("inf"),
+            latency=latency + toc - received, detections=len(detections))
+        Logger.info(
+            "Step to {0} correlated {1} samples in {2:.3f}s ({3:.1f}x "
+            "real-time), latency {4:.1f}s, {5} detections".format(
+                metrics.endtime, metrics.samples, metrics.duration,
+                metrics.speed, metrics.latency, metrics.detections))
+        self.metrics.append(metrics)
+        return detections
+
+    def run(self, packets, step_length=1.0):
+        """
+        Detect in an iterable of packets.
+
+        :type packets: iterable
+        :param packets:
+            Iterable of Streams or Traces, e.g. from a SeedLink client or
+            :func:`stream_packets`.
+        :type step_length: float
+        :param step_length:
+            Minimum seconds of new data before running a step.
+
+        :return: Generator of :class:`eqcorrscan.core.match_filter.Detection`
+        """
+        last = None
+        for packet in packets:
+            self.append(packet)
+            endtime = self.endtime
+            if endtime is None:
+                continue
+            if last is None or endtime - last >= step_length:
+                for detection in self.step():
+                    yield detection
+                last = endtime
+        if self.endtime is not None and self.endtime != last:
+            for detection in self.step():
+                yield detection
+
+    def _index(self, time, samp_rate, rounding=math.floor):
+        """ Index of time on the correlation sample grid. """
+        return int(rounding(round((time - self._origin) * samp_rate, 6)))
+
+    def _correlate_group(self, group, endtime):
+        """
+        Process and correlate new data for a group.
+
+        :return: Number of new correlation samples and the time up to which
+            detections have been finalised.
+        """
+        buffers = [buf for seed_id, buf in self.buffers.items()
+                   if seed_id in group.seed_ids and buf.endtime >= endtime]
+        if len(buffers) == 0:
+            return 0, None
+        pad = self._pad(group)
+        pad_n = int(math.ceil(pad * group.samp_rate))
+        end_index = self._index(endtime, group.samp_rate)
+        last_index = end_index - pad_n - group.span + 1
+        earliest = self._index(max(buf.first_time for buf in buffers),
+                               group.samp_rate, rounding=math.ceil) + pad_n
+        if group.next_index is None:
+            group.next_index = earliest
+            group.peak_from = earliest
+        elif group.next_index < earliest:
+            Logger.warning(
+                "Data between {0} and {1} were dropped before they could be "
+                "correlated, increase buffer_length or step more "
+                "often".format(
+                    self._origin + group.next_index / group.samp_rate,
+                    self._origin + earliest / group.samp_rate))
+            group.next_index = earliest
+            group.peak_from = max(group.peak_from, earliest)
+        first_index = group.next_index
+        if last_index < first_index:
+            return 0, None
+        # Process from pad before the first new sample to the end of data
+        start = self._origin + (first_index - pad_n) / group.samp_rate
+        end = self._origin + (end_index + 1) / group.samp_rate
+        st = Stream([buf.get_trace(start, end) for buf in buffers])
+        st = _shortproc(
+            st=st, filters=group.filters, samp_rate=group.samp_rate,
+            starttime=start, endtime=end, parallel=self.cores is not None,
+            num_cores=self.cores or False, ignore_length=True,
+            ignore_bad_data=True)[0]
+        n_keep = end_index - pad_n - first_index + 1
+        for tr in st:
+            tr.data = tr.data[pad_n:pad_n + n_keep]
+            tr.stats.starttime = start + pad_n / group.samp_rate
+        st.traces = [tr for tr in st if len(tr.data) == n_keep]
+        if len(st) == 0:
+            return 0, None
+        templates = [template.st.copy() for template in group.templates]
+        st, templates, _ = _prep_data_for_correlation(
+            stream=st, templates=templates,
+            template_names=[template.name for template in group.templates])
+        kwargs = self.kwargs.copy()
+        if get_stream_xcorr(self.xcorr_func, self.concurrency) is \
+                _fftw_stream_xcorr:
+            kwargs.setdefault("template_spectra", self._template_spectra)
+            # Size the fft to the data for this step, rounded up to a power
+            # of two so that steps of similar length re-use stored spectra
+            template_len = templates[0][0].stats.npts
+            step_fft_len = 2 ** int(math.ceil(math.log2(
+                template_len + st[0].stats.npts - 1)))
+            kwargs.setdefault("fft_len", min(step_fft_len, _default_fft_len(
+                template_len, group.history.capacity, len(templates),
+                len(st), self.cores)))
+        cccsums, no_chans, chans = get_stream_xcorr(
+            self.xcorr_func, self.concurrency)(
+            templates=templates, stream=st, cores=self.cores, **kwargs)
+        n_new = last_index - first_index + 1
+        group.history.skip_to(first_index)
+        group.history.append(cccsums[:, 0:n_new])
+        group.next_index = last_index + 1
+        group.no_chans, group.chans = no_chans, chans
+        finalised = self._origin + (
+            last_index - int(self.trig_int * group.samp_rate)) / \
+            group.samp_rate
+        return n_new, finalised
+
+    def _detect_group(self, group):
+        """ Find new, final peaks in the correlations for a group. """
+        if group.next_index is None:
+            return []
+        trig_n = int(self.trig_int * group.samp_rate)
+        final_index = group.history.written - 1 - trig_n
+        if final_index < group.peak_from:
+            return []
+        window_start = max(group.peak_from - trig_n, group.history.first)
+        cccsums = group.history.get(window_start, group.history.written)
+        if str(self.threshold_type) == "absolute":
+            thresholds = [self.threshold for _ in group.templates]
+        elif str(self.threshold_type) == "MAD":
+            thresholds = self.threshold * np.median(
+                np.abs(group.history.get(
+                    group.history.first, group.history.written)), axis=1)
+        elif str(self.threshold_type) == "MAD_approx":
+            thresholds = self.threshold * median_abs(
+                group.history.get(group.history.first, group.history.written),
+                approximate=True, cores=self.cores)
+        else:
+            thresholds = [self.threshold * no_chans
+                          for no_chans in group.no_chans]
+        all_peaks = multi_find_peaks(
+            arr=cccsums, thresh=thresholds, trig_int=trig_n, parallel=False)
+        detections = []
+        for i, peaks in enumerate(all_peaks):
+            template = group.templates[i]
+            for peak in peaks or []:
+                index = window_start + peak[1]
+                if not group.peak_from <= index <= final_index:
+                    continue
+                detection = Detection(
+                    template_name=template.name,
+                    detect_time=self._origin + index / group.samp_rate,
+                    no_chans=group.no_chans[i], detect_val=peak[0],
+                    threshold=thresholds[i], typeofdet='corr',
+                    chans=group.chans[i], threshold_type=self.threshold_type,
+                    threshold_input=self.threshold)
+                detection._calculate_event(template=template)
+                detections.append(detection)
+        group.peak_from = final_index + 1
+        return sorted(detections, key=lambda d: d.detect_time)
+
+
+def stream_packets(st, packet_length=1.0):
+    """
+    Split a stream into time-ordered packets to replay as real-time data.
+
+    :type st: `obspy.core.stream.Stream`
+    :param st: Stream to split.
+    :type packet_length: float
+    :param packet_length: Length of packets in seconds.
+
+    :return: Generator of Streams, each holding one packet for each channel.
+
+    .. rubric:: Example
+
+    >>> from obspy import read
+    >>> packets = list(stream_packets(read(), packet_length=10.0))
+    >>> print(len(packets))
+    3
+    >>> print(packets[0])  # doctest: +NORMALIZE_WHITESPACE
+    3 Trace(s) in Stream:
+    BW.RJOB..EHZ | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:12.990000Z\
+ | 100.0 Hz, 1000 samples
+    BW.RJOB..EHN | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:12.990000Z\
+ | 100.0 Hz, 1000 samples
+    BW.RJOB..EHE | 2009-08-24T00:20:03.000000Z - 2009-08-24T00:20:12.990000Z\
+ | 100.0 Hz, 1000 samples
+    """
+    starttime = min(tr.stats.starttime for tr in st)
+    endtime = max(tr.stats.endtime for tr in st)
+    packet_start = starttime
+    while packet_start <= endtime:
+        packet = Stream()
+        for tr in st:
+            packet_tr = tr.slice(
+                packet_start, packet_start + packet_length -
+                tr.stats.delta / 2, nearest_sample=False)
+            if len(packet_tr.data):
+                packet += packet_tr
+        packet_start += packet_length
+        if len(packet):
+            yield packet
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
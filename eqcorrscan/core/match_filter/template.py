@@ -267,10 +267,18 @@ class Template(object):
         """
         return copy.deepcopy(self)
 
-    def same_processing(self, other):
+    def same_processing(self, other, ignore_filters=False):
         """
         Check is the templates are processed the same.
 
+        :type other: Template
+        :param other: Template to compare to.
+        :type ignore_filters: bool
+        :param ignore_filters:
+            Whether to ignore differences in filter settings (lowcut,
+            highcut and filt_order), i.e. check only that the data are
+            chunked and resampled the same.
+
         .. rubric:: Example
 
         >>> from obspy import read
@@ -283,9 +291,14 @@ class Template(object):
         >>> template_b.lowcut = 5.0
         >>> template_a.same_processing(template_b)
         False
+        >>> template_a.same_processing(template_b, ignore_filters=True)
+        True
         """
+        skip = ['name', 'st', 'prepick', 'event', 'template_info']
+        if ignore_filters:
+            skip.extend(['lowcut', 'highcut', 'filt_order'])
         for key in self.__dict__.keys():
-            if key in ['name', 'st', 'prepick', 'event', 'template_info']:
+            if key in skip:
                 continue
             if not self.__dict__[key] == other.__dict__[key]:
                 return False
@@ -388,8 +401,8 @@ class Template(object):
             the multiple of the median absolute deviation.
         :type threshold_type: str
         :param threshold_type:
-            The type of threshold to be used, can be MAD, absolute or
-            av_chan_corr.  See Note on thresholding below.
+            The type of threshold to be used, can be MAD, MAD_approx,
+            absolute or av_chan_corr.  See Note on thresholding below.
         :type trig_int: float
         :param trig_int:
             Minimum gap between detections in seconds. If multiple detections
@@ -492,6 +505,12 @@ class Template(object):
             where :math:`cccsum` is the cross-correlation sum for a
             given template.
 
+            **MAD_approx** is the MAD threshold using a histogram estimate of
+            the median, which avoids copying and partially sorting each cccsum.
+            The estimate is within
+            :math:`max(abs(cccsum)) / (2 \\times 1024^2)` of the exact median,
+            see :func:`eqcorrscan.utils.findpeaks.median_abs`.
+
             **absolute** threshold is a true absolute threshold based on the
             cccsum value.
 
@@ -680,11 +699,15 @@ def read_template(fname):
     return template
 
 
-def group_templates(templates):
+def group_templates(templates, ignore_filters=False):
     """
     Group templates into sets of similarly processed templates.
 
     :type templates: List of Tribe of Templates
+    :type ignore_filters: bool
+    :param ignore_filters:
+        Whether to group templates that differ only in filter settings, see
+        :meth:`Template.same_processing`.
     :return: List of Lists of Templates.
     """
     template_groups = []
@@ -695,7 +718,9 @@ def group_templates(templates):
         else:
             new_group = [master]
             for slave in templates:
-                if master.same_processing(slave) and master != slave:
+                if master.same_processing(
+                        slave, ignore_filters=ignore_filters) and \
+                        master != slave:
                     new_group.append(slave)
             template_groups.append(new_group)
     # template_groups will contain an empty first list
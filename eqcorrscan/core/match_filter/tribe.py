@@ -428,7 +428,7 @@ class Tribe(object):
                xcorr_func=None, concurrency=None, cores=None,
                ignore_length=False, ignore_bad_data=False, group_size=None,
                overlap="calculate", full_peaks=False, save_progress=False,
-               process_cores=None, **kwargs):
+               process_cores=None, memory_limit=None, **kwargs):
         """
         Detect using a Tribe of templates within a continuous stream.
 
@@ -440,8 +440,8 @@ class Tribe(object):
             the multiple of the median absolute deviation.
         :type threshold_type: str
         :param threshold_type:
-            The type of threshold to be used, can be MAD, absolute or
-            av_chan_corr.  See Note on thresholding below.
+            The type of threshold to be used, can be MAD, MAD_approx,
+            absolute or av_chan_corr.  See Note on thresholding below.
         :type trig_int: float
         :param trig_int:
             Minimum gap between detections from one template in seconds.
@@ -505,6 +505,15 @@ class Tribe(object):
         :param process_cores:
             Number of processes to use for pre-processing (if different to
             `cores`).
+        :type memory_limit: int
+        :param memory_limit:
+            Memory available for correlations in bytes. If set, templates
+            are split into equal groups small enough for the estimated
+            memory use of the correlations (see
+            :func:`eqcorrscan.utils.correlate.estimate_correlation_memory`)
+            to fit, no larger than `group_size` if that is also set. The
+            predicted memory use and the observed peak resident memory are
+            logged.
 
         :return:
             :class:`eqcorrscan.core.match_filter.Party` of Families of
@@ -514,6 +523,35 @@ class Tribe(object):
             When using the "fftw" correlation backend the length of the fft
             can be set. See :mod:`eqcorrscan.utils.correlate` for more info.
 
+        .. Note::
+            When using the "fftw" correlation backend the template spectra
+            are computed once and re-used for every chunk of data. By
+            default up to 2 GB (or half of `memory_limit` if smaller) of
+            spectra are kept. To change this pass a
+            :class:`eqcorrscan.utils.correlate.TemplateSpectra` with
+            `max_bytes` set as the `template_spectra` keyword argument, or
+            `template_spectra=None` to disable re-use.
+
+        .. Note::
+            Pass a
+            :class:`eqcorrscan.core.match_filter.helpers.CorrelationCache`
+            as the `correlation_cache` keyword argument to store correlation
+            sums on disk. Re-running with the same templates, data and
+            settings (e.g. to try a different threshold) then reads the
+            correlations from the cache rather than re-computing them.
+            Entries are keyed on the raw data of each chunk and the
+            processing settings, so chunks found in the cache are not
+            processed either (unless `plot=True`, which needs the data).
+
+        .. Note::
+            Pass `return_cccsums="mmap:<path>"` as a keyword argument to
+            write the correlation sums for every chunk of data to `<path>`
+            as they are computed. See
+            :func:`eqcorrscan.core.match_filter.matched_filter.match_filter`
+            for the layout and
+            :func:`eqcorrscan.core.match_filter.helpers.read_cccsums` to
+            read them back.
+
         .. Note::
             `stream` must not be pre-processed. If your data contain gaps
             you should *NOT* fill those gaps before using this method.
@@ -564,6 +602,12 @@ class Tribe(object):
             where :math:`cccsum` is the cross-correlation sum for a given
             template.
 
+            **MAD_approx** is the MAD threshold using a histogram estimate of
+            the median, which avoids copying and partially sorting each cccsum.
+            The estimate is within
+            :math:`max(abs(cccsum)) / (2 \\times 1024^2)` of the exact median,
+            see :func:`eqcorrscan.utils.findpeaks.median_abs`.
+
             **absolute** threshold is a true absolute threshold based on the
             cccsum value.
 
@@ -580,18 +624,21 @@ class Tribe(object):
             length is the number of channels within this template.
         """
         party = Party()
-        template_groups = group_templates(self.templates)
+        # Templates that differ only in filter settings share the chunking,
+        # gap-filling and resampling of the data.
+        template_groups = group_templates(self.templates, ignore_filters=True)
         # now we can compute the detections for each group
         for group in template_groups:
             group_party = _group_detect(
-                templates=group, stream=stream.copy(), threshold=threshold,
+                templates=group, stream=stream, threshold=threshold,
                 threshold_type=threshold_type, trig_int=trig_int,
                 plot=plot, group_size=group_size, pre_processed=False,
                 daylong=daylong, parallel_process=parallel_process,
                 xcorr_func=xcorr_func, concurrency=concurrency, cores=cores,
                 ignore_length=ignore_length, overlap=overlap, plotdir=plotdir,
                 full_peaks=full_peaks, process_cores=process_cores,
-                ignore_bad_data=ignore_bad_data, arg_check=False, **kwargs)
+                ignore_bad_data=ignore_bad_data, memory_limit=memory_limit,
+                arg_check=False, **kwargs)
             party += group_party
             if save_progress:
                 party.write("eqcorrscan_temporary_party")
@@ -624,8 +671,8 @@ class Tribe(object):
             the multiple of the median absolute deviation.
         :type threshold_type: str
         :param threshold_type:
-            The type of threshold to be used, can be MAD, absolute or
-            av_chan_corr.  See Note on thresholding below.
+            The type of threshold to be used, can be MAD, MAD_approx,
+            absolute or av_chan_corr.  See Note on thresholding below.
         :type trig_int: float
         :param trig_int:
             Minimum gap between detections from one template in seconds.
@@ -733,6 +780,12 @@ class Tribe(object):
             where :math:`cccsum` is the cross-correlation sum for a given
             template.
 
+            **MAD_approx** is the MAD threshold using a histogram estimate of
+            the median, which avoids copying and partially sorting each cccsum.
+            The estimate is within
+            :math:`max(abs(cccsum)) / (2 \\times 1024^2)` of the exact median,
+            see :func:`eqcorrscan.utils.findpeaks.median_abs`.
+
             **absolute** threshold is a true absolute threshold based on the
             cccsum value.
 
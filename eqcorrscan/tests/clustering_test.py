@@ -42,6 +42,32 @@ class ClusteringTests(unittest.TestCase):
             st1=self.st1.copy(), streams=[self.st2.copy()], shift_len=0.2)
         self.assertEqual(round(cccoh[0], 6), 1)
 
+    def test_cross_chan_coherence_full_output(self):
+        """Check that the maxima match those of the full correlations."""
+        st2 = self.st2.copy()
+        for tr in st2:
+            tr.data = np.roll(tr.data, 10)
+        cccoh, positions = cross_chan_correlation(
+            st1=self.st1.copy(), streams=[st2], shift_len=0.5)
+        cccoh_full, positions_full = cross_chan_correlation(
+            st1=self.st1.copy(), streams=[st2], shift_len=0.5,
+            output="full")
+        self.assertTrue(np.allclose(cccoh, cccoh_full))
+        self.assertTrue(np.array_equal(positions, positions_full))
+
+    def test_cross_chan_coherence_time_domain_max(self):
+        """Check that the time-domain maxima match the fftw maxima."""
+        st2 = self.st2.copy()
+        for tr in st2:
+            tr.data = np.roll(tr.data, 10)
+        cccoh, positions = cross_chan_correlation(
+            st1=self.st1.copy(), streams=[st2], shift_len=0.5)
+        cccoh_time, positions_time = cross_chan_correlation(
+            st1=self.st1.copy(), streams=[st2], shift_len=0.5,
+            xcorr_func="time_domain_max")
+        self.assertTrue(np.allclose(cccoh, cccoh_time, atol=1e-5))
+        self.assertTrue(np.array_equal(positions, positions_time))
+
     def test_inverted_coherence(self):
         """Reverse channels and ensure we get -1"""
         st2 = self.st2.copy()
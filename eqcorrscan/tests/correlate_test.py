@@ -1,6 +1,7 @@
 import copy
 import itertools
 import logging
+import os
 from collections import defaultdict
 from functools import wraps
 from os.path import join
@@ -13,6 +14,7 @@ from scipy.fftpack import next_fast_len
 
 import eqcorrscan.utils.correlate as corr
 from eqcorrscan.utils.correlate import register_array_xcorr
+from eqcorrscan.utils.pre_processing import _prep_data_for_correlation
 from eqcorrscan.utils.timer import time_func
 from eqcorrscan.helpers.mock_logger import MockLoggingHandler
 
@@ -144,6 +146,12 @@ def get_real_multichannel_data():
         starttime=t1, endtime=t2)
     return st
 
+
+# built in functions that return full correlograms ("time_domain_max" only
+# returns the maxima)
+full_xcorr_funcs = [name for name in corr.XCORR_FUNCS_ORIGINAL.keys()
+                    if name != 'time_domain_max']
+
 # ----------------------------- module fixtures
 
 
@@ -201,7 +209,7 @@ def array_ccs(array_template, array_stream, pads):
      as the cc calculated by said function"""
     out = {}
 
-    for name in list(corr.XCORR_FUNCS_ORIGINAL.keys()):
+    for name in full_xcorr_funcs:
         func = corr.get_array_xcorr(name)
         print("Running %s" % name)
         cc, _ = time_func(func, name, array_template, array_stream, pads)
@@ -224,7 +232,7 @@ def array_ccs_low_amp(array_template, array_stream, pads):
      This specifically tests low amplitude streams as raised in issue #181."""
     out = {}
     arr_stream = array_stream * 10e-8
-    for name in list(corr.XCORR_FUNCS_ORIGINAL.keys()):
+    for name in full_xcorr_funcs:
         func = corr.get_array_xcorr(name)
         print("Running {0} with low-variance".format(name))
         _log_handler.reset()
@@ -285,7 +293,7 @@ def real_multichannel_stream():
 
 # a dict of all registered stream functions (this is a bit long)
 stream_funcs = {fname + '_' + mname: corr.get_stream_xcorr(fname, mname)
-                for fname in sorted(corr.XCORR_FUNCS_ORIGINAL.keys())
+                for fname in sorted(full_xcorr_funcs)
                 for mname in corr.XCORR_STREAM_METHODS
                 if fname != 'default'}
 
@@ -954,3 +962,829 @@ class TestRegisterAlternativeConcurrency:
     def test_new_method_was_called(self, normxcorr_new_multithread):
         """ ensure the new method was called """
         assert self.counter[normxcorr_new_multithread]
+
+
+class TestFFTWPlanCache:
+    """ Tests for the persistent FFTW plan cache and wisdom handling """
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        corr.clear_fftw_plan_cache()
+        yield
+        corr.set_fftw_planning("estimate")
+        corr.clear_fftw_plan_cache()
+
+    def test_plans_reused(self, multichannel_templates, multichannel_stream):
+        """ Repeated calls with the same shape should re-use plans """
+        func = corr.get_stream_xcorr("fftw")
+        cccsums, _, _ = func(multichannel_templates, multichannel_stream)
+        assert corr._fftw_plan_cache_len() == 1
+        cccsums_cached, _, _ = func(
+            multichannel_templates, multichannel_stream)
+        assert corr._fftw_plan_cache_len() == 1
+        assert np.allclose(cccsums, cccsums_cached, atol=1e-6)
+        func(multichannel_templates, multichannel_stream, fft_len=2 ** 12)
+        assert corr._fftw_plan_cache_len() == 2
+
+    def test_measure_planning(self, multichannel_templates,
+                              multichannel_stream):
+        """ Measured plans should give the same answer as estimated plans """
+        func = corr.get_stream_xcorr("fftw")
+        cccsums, _, _ = func(multichannel_templates, multichannel_stream)
+        corr.set_fftw_planning("measure")
+        cccsums_measured, _, _ = func(
+            multichannel_templates, multichannel_stream)
+        assert corr._fftw_plan_cache_len() == 2
+        assert np.allclose(cccsums, cccsums_measured, atol=1e-5)
+
+    def test_bad_planning_raises(self):
+        with pytest.raises(ValueError):
+            corr.set_fftw_planning("guess")
+
+    def test_wisdom_round_trip(self, tmpdir, multichannel_templates,
+                               multichannel_stream):
+        wisdom_file = str(tmpdir.join("wisdom.txt"))
+        corr.set_fftw_planning("measure")
+        corr.get_stream_xcorr("fftw")(
+            multichannel_templates, multichannel_stream)
+        try:
+            corr.export_fftw_wisdom(wisdom_file)
+        except IOError:
+            pytest.skip("FFTW library does not support wisdom (e.g. MKL)")
+        assert os.path.isfile(wisdom_file)
+        assert corr.import_fftw_wisdom(wisdom_file)
+
+    def test_missing_wisdom(self, tmpdir):
+        assert not corr.import_fftw_wisdom(str(tmpdir.join("missing.txt")))
+
+
+class TestTemplateSpectra:
+    """ Tests for re-using pre-computed template spectra """
+    @pytest.mark.parametrize("stack", [True, False])
+    def test_prepared_matches_unprepared(
+            self, multichannel_templates, multichannel_stream, stack):
+        func = corr.get_stream_xcorr("fftw")
+        template_spectra = corr.TemplateSpectra()
+        cccsums, no_chans, chans = func(
+            multichannel_templates, multichannel_stream, stack=stack)
+        for _ in range(2):
+            cccsums_prep, no_chans_prep, chans_prep = func(
+                multichannel_templates, multichannel_stream, stack=stack,
+                template_spectra=template_spectra)
+            assert np.allclose(cccsums, cccsums_prep, atol=1e-5)
+            assert np.array_equal(no_chans, no_chans_prep)
+            assert chans == chans_prep
+        assert len(template_spectra) == len(multichannel_stream)
+
+    def test_gappy_prepared(self, multichannel_templates,
+                            gappy_multichannel_stream):
+        func = corr.get_stream_xcorr("fftw")
+        cccsums, _, _ = func(multichannel_templates, gappy_multichannel_stream)
+        cccsums_prep, _, _ = func(
+            multichannel_templates, gappy_multichannel_stream,
+            template_spectra=corr.TemplateSpectra())
+        assert np.allclose(cccsums, cccsums_prep, atol=1e-5)
+
+    def test_spectra_per_fft_len(self, multichannel_templates,
+                                 multichannel_stream):
+        func = corr.get_stream_xcorr("fftw")
+        template_spectra = corr.TemplateSpectra()
+        func(multichannel_templates, multichannel_stream,
+             template_spectra=template_spectra)
+        nbytes = template_spectra.nbytes
+        cccsums, _, _ = func(multichannel_templates, multichannel_stream,
+                             fft_len=2 ** 12)
+        cccsums_prep, _, _ = func(
+            multichannel_templates, multichannel_stream, fft_len=2 ** 12,
+            template_spectra=template_spectra)
+        assert np.allclose(cccsums, cccsums_prep, atol=1e-5)
+        assert len(template_spectra) == 2 * len(multichannel_stream)
+        assert template_spectra.nbytes > nbytes
+
+    def test_max_bytes(self, multichannel_templates, multichannel_stream):
+        func = corr.get_stream_xcorr("fftw")
+        template_spectra = corr.TemplateSpectra()
+        cccsums, _, _ = func(multichannel_templates, multichannel_stream,
+                             template_spectra=template_spectra)
+        max_bytes = template_spectra.nbytes
+        template_spectra = corr.TemplateSpectra(max_bytes=max_bytes)
+        for templates in (multichannel_templates[1:],
+                          multichannel_templates):
+            cccsums_prep, _, _ = func(
+                templates, multichannel_stream,
+                template_spectra=template_spectra)
+        assert np.allclose(cccsums, cccsums_prep, atol=1e-5)
+        # Only the most recent set of spectra fits
+        assert 0 < template_spectra.nbytes <= max_bytes
+        assert len(template_spectra) == len(multichannel_stream)
+        # Spectra that do not fit are not stored
+        template_spectra = corr.TemplateSpectra(max_bytes=max_bytes // 2)
+        cccsums_prep, _, _ = func(
+            multichannel_templates, multichannel_stream,
+            template_spectra=template_spectra)
+        assert np.allclose(cccsums, cccsums_prep, atol=1e-5)
+        assert template_spectra.nbytes == 0
+        template_spectra = corr.TemplateSpectra()
+        func(multichannel_templates, multichannel_stream,
+             template_spectra=template_spectra)
+        template_spectra.clear()
+        assert template_spectra.nbytes == 0
+
+    def test_stored_spectra_used_in_place(self, multichannel_templates,
+                                          multichannel_stream):
+        template_spectra = corr.TemplateSpectra()
+        _, template_array, _, seed_ids = corr._get_array_dicts(
+            multichannel_templates, multichannel_stream, stack=True)
+        first = template_spectra.get(template_array, seed_ids, 2 ** 13)
+        second = template_spectra.get(
+            {key: value.copy() for key, value in template_array.items()},
+            seed_ids, 2 ** 13)
+        assert all(a is b for a, b in zip(first, second))
+        # Changed templates are not matched
+        template_array[seed_ids[0]][0, 0] += 1
+        third = template_spectra.get(template_array, seed_ids, 2 ** 13)
+        assert third[0] is not first[0]
+
+
+class TestSparseCorrelation:
+    """ Tests for only correlating channels used by each template """
+    @pytest.fixture(scope='class')
+    def sparse_templates(self, multichannel_templates):
+        """ Templates using one station each, filled with nan-channels """
+        return [Stream([tr.copy() for tr in template
+                        if tr.stats.station == stas[i % len(stas)]])
+                for i, template in enumerate(multichannel_templates)]
+
+    @pytest.fixture(scope='class')
+    def filled_templates(self, sparse_templates, multichannel_stream):
+        _, templates = _prep_data_for_correlation(
+            stream=multichannel_stream.copy(),
+            templates=[template.copy() for template in sparse_templates])
+        return templates
+
+    def test_sparse_rows(self):
+        assert corr._n_sparse_rows(0, 20) == 0
+        assert corr._n_sparse_rows(3, 20) == 4
+        assert corr._n_sparse_rows(4, 20) == 4
+        assert corr._n_sparse_rows(17, 20) == 20
+        templates = np.random.randn(5, 10)
+        templates[[0, 2, 3]] = np.nan
+        rows, index = corr._sparse_template_rows(templates)
+        assert rows.shape == (2, 10)
+        assert np.array_equal(index, [1, 4])
+
+    @pytest.mark.parametrize("prepared", [True, False])
+    def test_sparse_matches_individual(self, sparse_templates,
+                                       filled_templates, multichannel_stream,
+                                       prepared):
+        func = corr.get_stream_xcorr("fftw")
+        kwargs = dict()
+        if prepared:
+            kwargs.update({"template_spectra": corr.TemplateSpectra()})
+        cccsums, no_chans, _ = func(
+            filled_templates, multichannel_stream, **kwargs)
+        for i, template in enumerate(sparse_templates):
+            cccsum, no_chan, _ = func([template], multichannel_stream)
+            assert np.allclose(cccsums[i], cccsum[0], atol=1e-5)
+            assert no_chans[i] == no_chan[0] == len(template)
+
+    def test_sparse_unstacked(self, filled_templates, multichannel_stream):
+        func = corr.get_stream_xcorr("fftw")
+        cccsums, no_chans, _ = func(filled_templates, multichannel_stream)
+        cccs, no_chans_unstacked, _ = func(
+            filled_templates, multichannel_stream, stack=False)
+        assert np.allclose(cccsums, np.nansum(cccs, axis=1), atol=1e-5)
+        assert np.array_equal(no_chans, no_chans_unstacked)
+
+
+class TestRunningMeanVar:
+    """ Tests for the tiled running mean and variance """
+    @staticmethod
+    def _expected(data, window_len):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            data.astype(np.float64), window_len)
+        return windows.mean(axis=-1), windows.var(axis=-1)
+
+    @pytest.mark.parametrize("tile_len", [None, 1, 7, 100000])
+    def test_matches_numpy(self, tile_len):
+        data = np.random.RandomState(42).randn(10000).astype(np.float32)
+        mean, var = corr.running_mean_var(data, 200, tile_len=tile_len)
+        expected_mean, expected_var = self._expected(data, 200)
+        assert np.allclose(mean, expected_mean, atol=1e-10)
+        assert np.allclose(var, expected_var, atol=1e-10)
+
+    def test_long_offset_data(self):
+        """ Check that rounding errors do not accumulate """
+        data = (np.random.RandomState(42).randn(2000000) +
+                1e4).astype(np.float32)
+        mean, var = corr.running_mean_var(data, 100)
+        expected_mean, expected_var = self._expected(data, 100)
+        assert np.allclose(mean, expected_mean, rtol=1e-10)
+        assert np.allclose(var, expected_var, atol=1e-6)
+
+    def test_window_too_long(self):
+        with pytest.raises(ValueError):
+            corr.running_mean_var(np.zeros(10, dtype=np.float32), 11)
+
+
+class TestOverlapSave:
+    """ Tests for the overlap-save streaming correlator """
+    @pytest.fixture
+    def arrays(self):
+        random = np.random.RandomState(42)
+        seed_ids = ["NZ.A..HHZ_0", "NZ.B..HHZ_0", "NZ.C..HHZ_0"]
+        data = random.randn(len(seed_ids), 20000).astype(np.float32)
+        template_array = {
+            seed_id: random.randn(4, 200).astype(np.float32)
+            for seed_id in seed_ids}
+        # Embed a template in the data
+        for i, seed_id in enumerate(seed_ids):
+            data[i, 5000 + 10 * i:5200 + 10 * i] += template_array[
+                seed_id][0] * 5
+        pad_array = {seed_id: [10 * i, 0, 3 * i, 20]
+                     for i, seed_id in enumerate(seed_ids)}
+        return template_array, pad_array, seed_ids, data
+
+    def _full(self, template_array, pad_array, seed_ids, data):
+        cccsums, _ = corr.fftw_multi_normxcorr(
+            template_array=copy.deepcopy(template_array),
+            stream_array={seed_id: data[i].copy()
+                          for i, seed_id in enumerate(seed_ids)},
+            pad_array=pad_array, seed_ids=seed_ids, cores_inner=1,
+            stack=True, fft_len=2 ** 13)
+        return cccsums
+
+    @pytest.mark.parametrize("block_len", [50, 1000, 7777, 30000])
+    def test_blocks_match_full(self, arrays, block_len):
+        template_array, pad_array, seed_ids, data = arrays
+        expected = self._full(template_array, pad_array, seed_ids, data)
+        blocks = (data[:, i:i + block_len]
+                  for i in range(0, data.shape[1], block_len))
+        cccsums = np.concatenate(list(corr.fftw_overlap_save_normxcorr(
+            template_array, pad_array, seed_ids, blocks, cores_inner=1)),
+            axis=1)
+        assert cccsums.shape == expected.shape
+        assert np.allclose(cccsums, expected, atol=1e-5)
+        assert cccsums[0].argmax() == 5000
+
+    def test_dict_blocks(self, arrays):
+        template_array, pad_array, seed_ids, data = arrays
+        expected = self._full(template_array, pad_array, seed_ids, data)
+        blocks = ({seed_id: data[j, i:i + 4000]
+                   for j, seed_id in enumerate(seed_ids)}
+                  for i in range(0, data.shape[1], 4000))
+        cccsums = np.concatenate(list(corr.fftw_overlap_save_normxcorr(
+            template_array, pad_array, seed_ids, blocks)), axis=1)
+        assert np.allclose(cccsums, expected, atol=1e-5)
+
+    def test_bad_block_raises(self, arrays):
+        template_array, pad_array, seed_ids, data = arrays
+        with pytest.raises(ValueError):
+            list(corr.fftw_overlap_save_normxcorr(
+                template_array, pad_array, seed_ids, [data[0:2]]))
+
+
+class TestStreamBuffer:
+    """ Tests for writing the stream data into one contiguous buffer """
+    def test_dict_values_share_buffer(self, multichannel_templates,
+                                      multichannel_stream):
+        stream_dict, _, _, seed_ids = corr._get_array_dicts(
+            multichannel_templates, multichannel_stream.copy(), stack=True)
+        stacked = corr._stack_stream_array(stream_dict, seed_ids)
+        assert stacked.shape == (
+            len(seed_ids), multichannel_stream[0].stats.npts)
+        assert stacked.flags.c_contiguous
+        for i, seed_id in enumerate(seed_ids):
+            assert np.shares_memory(stacked, stream_dict[seed_id])
+            assert np.array_equal(stacked[i], stream_dict[seed_id])
+
+    def test_unordered_dict_is_copied(self, multichannel_templates,
+                                      multichannel_stream):
+        stream_dict, _, _, seed_ids = corr._get_array_dicts(
+            multichannel_templates, multichannel_stream.copy(), stack=True)
+        stacked = corr._stack_stream_array(stream_dict, seed_ids[::-1])
+        assert not np.shares_memory(stacked, stream_dict[seed_ids[0]])
+        assert np.array_equal(stacked[0], stream_dict[seed_ids[-1]])
+
+    def test_memmap_buffer(self, multichannel_templates, multichannel_stream,
+                           tmpdir):
+        stream = multichannel_stream.copy()
+        expected = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, stream, cores=1)[0]
+        stream_buffer = np.memmap(
+            str(tmpdir.join("stream.dat")), dtype=np.float32, mode="w+",
+            shape=(len(multichannel_templates[0]), stream[0].stats.npts))
+        cccsums = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, stream, cores=1,
+            stream_buffer=stream_buffer)[0]
+        assert np.allclose(cccsums, expected, atol=1e-6)
+        assert np.abs(stream_buffer).max() > 0
+
+    def test_bad_buffer_shape(self, multichannel_templates,
+                              multichannel_stream):
+        with pytest.raises(ValueError):
+            corr._get_array_dicts(
+                multichannel_templates, multichannel_stream.copy(),
+                stack=True, stream_buffer=np.empty((1, 10), np.float32))
+
+    def test_gain_removed(self):
+        seed_ids = ["NZ.A..HHZ_0", "NZ.B..HHZ_0"]
+        random = np.random.RandomState(42)
+        buffer = random.randn(2, 1000).astype(np.float32)
+        buffer[0] *= 1e-6
+        stream_array = {seed_id: buffer[i]
+                        for i, seed_id in enumerate(seed_ids)}
+        original = buffer.copy()
+        template_array = {seed_id: random.randn(2, 100).astype(np.float32)
+                          for seed_id in seed_ids}
+        corr.fftw_multi_normxcorr(
+            template_array=template_array, stream_array=stream_array,
+            pad_array={seed_id: [0, 0] for seed_id in seed_ids},
+            seed_ids=seed_ids, cores_inner=1)
+        assert np.allclose(buffer, original, rtol=1e-6)
+
+
+class TestReducedOutput:
+    """ Tests for the int16 and max outputs of the fftw backend """
+    @pytest.fixture
+    def arrays(self):
+        random = np.random.RandomState(42)
+        seed_ids = ["NZ.A..HHZ_0", "NZ.B..HHZ_0", "NZ.C..HHZ_0"]
+        stream_array = {seed_id: random.randn(5000).astype(np.float32)
+                        for seed_id in seed_ids}
+        template_array = {seed_id: random.randn(4, 200).astype(np.float32)
+                          for seed_id in seed_ids}
+        template_array[seed_ids[1]][2] = np.nan
+        pad_array = {seed_id: [0, 0, 0, 0] for seed_id in seed_ids}
+        return template_array, stream_array, pad_array, seed_ids
+
+    def _correlate(self, arrays, **kwargs):
+        template_array, stream_array, pad_array, seed_ids = arrays
+        return corr.fftw_multi_normxcorr(
+            template_array=template_array, stream_array=stream_array,
+            pad_array=pad_array, seed_ids=seed_ids, cores_inner=1,
+            stack=False, **kwargs)
+
+    def test_int16(self, arrays):
+        full, used_chans = self._correlate(arrays)
+        quantised, used_chans_quantised = self._correlate(
+            arrays, output="int16")
+        assert quantised.dtype == np.int16
+        assert quantised.shape == full.shape
+        assert np.allclose(quantised / corr.INT16_SCALE, full,
+                           atol=1 / corr.INT16_SCALE)
+        assert np.array_equal(used_chans, used_chans_quantised)
+
+    def test_max(self, arrays):
+        full, _ = self._correlate(arrays)
+        maxima, _ = self._correlate(arrays, output="max")
+        assert isinstance(maxima, corr.CorrelationMaxima)
+        assert np.array_equal(maxima.max_cc, full.max(axis=-1))
+        assert np.array_equal(maxima.lag, full.argmax(axis=-1))
+
+    def test_max_lag_windows(self, arrays):
+        full, _ = self._correlate(arrays)
+        lag_windows = [(0, 100), (1000, 1500), (4700, 4801)]
+        maxima, _ = self._correlate(
+            arrays, output="max", lag_windows=lag_windows)
+        assert maxima.max_cc.shape == full.shape[0:2] + (3, )
+        for i, (start, stop) in enumerate(lag_windows):
+            window = full[..., start:stop]
+            assert np.array_equal(maxima.max_cc[..., i], window.max(axis=-1))
+            assert np.array_equal(maxima.lag[..., i], window.argmax(axis=-1))
+
+    def test_stacked_reduced_output_raises(self, arrays):
+        template_array, stream_array, pad_array, seed_ids = arrays
+        with pytest.raises(NotImplementedError):
+            corr.fftw_multi_normxcorr(
+                template_array=template_array, stream_array=stream_array,
+                pad_array=pad_array, seed_ids=seed_ids, cores_inner=1,
+                stack=True, output="max")
+
+    def test_bad_lag_windows(self, arrays):
+        with pytest.raises(ValueError):
+            self._correlate(arrays, output="max", lag_windows=[(0, 10000)])
+
+    def test_stream_xcorr_max(self, multichannel_templates,
+                              multichannel_stream):
+        func = corr.get_stream_xcorr('fftw')
+        full, no_chans, chans = func(
+            multichannel_templates, multichannel_stream.copy(), stack=False,
+            cores=1)
+        maxima, max_no_chans, max_chans = func(
+            multichannel_templates, multichannel_stream.copy(), stack=False,
+            cores=1, output="max")
+        assert np.array_equal(no_chans, max_no_chans)
+        assert chans == max_chans
+        assert np.array_equal(maxima.max_cc, full.max(axis=-1))
+
+
+class TestTimeDomainMax:
+    """ Tests for the time-domain maximum correlation backend """
+    @pytest.fixture
+    def arrays(self):
+        random = np.random.RandomState(42)
+        stream = random.randn(2500).astype(np.float32)
+        templates = random.randn(5, 500).astype(np.float32)
+        templates[1] = stream[100:600] * 3 + 10
+        templates[3] = np.nan
+        return templates, stream
+
+    def _full(self, templates, stream):
+        seed_id = "NZ.A..HHZ_0"
+        ccc, used_chans = corr.fftw_multi_normxcorr(
+            template_array={seed_id: templates},
+            stream_array={seed_id: stream.copy()},
+            pad_array={seed_id: [0] * len(templates)}, seed_ids=[seed_id],
+            cores_inner=1, stack=False)
+        return ccc[:, 0], used_chans[0]
+
+    def test_matches_fftw(self, arrays):
+        templates, stream = arrays
+        full, used_chans = self._full(templates, stream)
+        maxima, max_used_chans = corr.time_max_normxcorr(
+            templates, stream, [0] * len(templates))
+        assert np.array_equal(used_chans, max_used_chans)
+        assert np.allclose(maxima.max_cc, full.max(axis=-1), atol=1e-5)
+        assert np.array_equal(maxima.lag, full.argmax(axis=-1))
+        assert maxima.lag[1] == 100
+        assert maxima.max_cc[3] == 0
+
+    def test_stream_offset(self, arrays):
+        templates, stream = arrays
+        maxima, _ = corr.time_max_normxcorr(
+            templates, stream, [0] * len(templates))
+        offset_maxima, _ = corr.time_max_normxcorr(
+            templates, stream.astype(np.float64) + 1e6,
+            [0] * len(templates))
+        assert np.allclose(offset_maxima.max_cc, maxima.max_cc, atol=1e-4)
+        assert np.array_equal(offset_maxima.lag, maxima.lag)
+
+    def test_lag_windows(self, arrays):
+        templates, stream = arrays
+        full, _ = self._full(templates, stream)
+        lag_windows = [(0, 50), (80, 121), (1990, 2001)]
+        maxima, _ = corr.time_max_normxcorr(
+            templates, stream, [0] * len(templates), lag_windows=lag_windows,
+            cores=2)
+        assert maxima.max_cc.shape == (len(templates), 3)
+        for i, (start, stop) in enumerate(lag_windows):
+            window = full[:, start:stop]
+            assert np.allclose(
+                maxima.max_cc[:, i], window.max(axis=-1), atol=1e-5)
+            assert np.array_equal(maxima.lag[:, i], window.argmax(axis=-1))
+
+    def test_bad_lag_windows(self, arrays):
+        templates, stream = arrays
+        with pytest.raises(ValueError):
+            corr.time_max_normxcorr(
+                templates, stream, [0] * len(templates),
+                lag_windows=[(0, 3000)])
+
+    def test_pads_not_supported(self, arrays):
+        templates, stream = arrays
+        with pytest.raises(NotImplementedError):
+            corr.time_max_normxcorr(
+                templates, stream, [1] * len(templates))
+
+    def test_stream_xcorr(self, multichannel_templates, multichannel_stream):
+        maxima, no_chans, chans = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, multichannel_stream.copy(), stack=False,
+            cores=1, output="max")
+        for concurrency in corr.XCORR_STREAM_METHODS:
+            func = corr.get_stream_xcorr('time_domain_max', concurrency)
+            time_maxima, time_no_chans, time_chans = func(
+                multichannel_templates, multichannel_stream.copy(),
+                stack=False)
+            assert np.allclose(time_maxima.max_cc, maxima.max_cc, atol=1e-5)
+            assert np.array_equal(time_maxima.lag, maxima.lag)
+            assert np.array_equal(time_no_chans, no_chans)
+            assert time_chans == chans
+
+    def test_stack_not_supported(self, multichannel_templates,
+                                 multichannel_stream):
+        with pytest.raises(NotImplementedError):
+            corr.get_stream_xcorr('time_domain_max')(
+                multichannel_templates, multichannel_stream.copy())
+
+
+class TestTimeDomainBlocked:
+    """ Tests for the template-blocked time-domain correlation """
+    @pytest.mark.parametrize("n_templates", [1, 4, 7])
+    def test_matches_fftw(self, n_templates):
+        random = np.random.RandomState(13)
+        stream = random.randn(5001).astype(np.float32)
+        templates = random.randn(n_templates, 150).astype(np.float32)
+        templates[0] = stream[200:350] * 2 + 5
+        pads = [0] + [3] * (n_templates - 1)
+        time_ccc, _ = corr.time_multi_normxcorr(
+            templates.copy(), stream.copy(), pads, threaded=True, cores=2)
+        fftw_ccc, _ = corr.fftw_normxcorr(
+            templates.copy(), stream.copy(), pads)
+        assert np.allclose(time_ccc, fftw_ccc, atol=1e-5)
+        assert time_ccc[0].argmax() == 200
+
+    def test_nan_template_and_flat_data(self):
+        random = np.random.RandomState(13)
+        stream = random.randn(3000).astype(np.float32)
+        stream[1000:2000] = 1.0
+        templates = random.randn(5, 100).astype(np.float32)
+        templates[2] = np.nan
+        ccc, _ = corr.time_multi_normxcorr(templates, stream, [0] * 5)
+        assert np.all(ccc[2] == 0)
+        assert np.all(ccc[:, 1000:1901] == 0)
+        assert np.all(np.isfinite(ccc))
+
+
+class TestSharedMemoryMultiprocess:
+    """ Tests for multiprocess correlations through shared memory """
+    @pytest.mark.parametrize("stack", [True, False])
+    def test_matches_serial(self, multichannel_templates, multichannel_stream,
+                            stack):
+        serial = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, multichannel_stream.copy(), stack=stack,
+            cores=1)
+        shared = corr.get_stream_xcorr('fftw', 'multiprocess')(
+            multichannel_templates, multichannel_stream.copy(), stack=stack,
+            cores=2)
+        assert np.allclose(serial[0], shared[0], atol=1e-6)
+        assert np.array_equal(serial[1], shared[1])
+        assert serial[2] == shared[2]
+
+    @pytest.mark.parametrize("cores", [3, 64])
+    def test_partial_sums(self, multichannel_templates, multichannel_stream,
+                          cores):
+        """ Channels split unevenly between workers, or one each. """
+        serial = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, multichannel_stream.copy(), cores=1)
+        shared = corr.get_stream_xcorr('fftw', 'multiprocess')(
+            multichannel_templates, multichannel_stream.copy(), cores=cores,
+            accumulate_float64=True)
+        assert shared[0].dtype == np.float64
+        assert shared[0].shape == serial[0].shape
+        assert np.allclose(serial[0], shared[0], atol=1e-5)
+        assert np.array_equal(serial[1], shared[1])
+        assert serial[2] == shared[2]
+        corr.close_shared_pools()
+
+    def test_pool_persists(self, multichannel_templates, multichannel_stream):
+        corr.close_shared_pools()
+        func = corr.get_stream_xcorr('fftw', 'multiprocess')
+        func(multichannel_templates, multichannel_stream.copy(), cores=2)
+        pool = corr._SHARED_POOLS[2]
+        func(multichannel_templates, multichannel_stream.copy(), cores=2)
+        assert corr._SHARED_POOLS[2] is pool
+        corr.close_shared_pools()
+        assert len(corr._SHARED_POOLS) == 0
+
+
+class TestCoreSplit:
+    """ Tests for splitting cores between outer and inner parallelism """
+    nodes = [list(range(64)), list(range(64, 128))]
+
+    def test_single_node(self):
+        split = corr.plan_core_split(
+            cores=8, n_channels=30, numa_nodes=[list(range(8))])
+        assert split == corr.CoreSplit(1, 8, None)
+
+    def test_inner_threads_capped(self):
+        split = corr.plan_core_split(
+            cores=48, n_channels=30, numa_nodes=[list(range(48))])
+        assert split.outer == 3
+        assert split.inner == 16
+        assert split.cpus is None
+
+    def test_numa_nodes(self, caplog):
+        with caplog.at_level(logging.INFO):
+            split = corr.plan_core_split(
+                cores=100, n_channels=30, numa_nodes=self.nodes)
+        assert split.outer == 8
+        assert split.inner == 12
+        assert [cpus[0] for cpus in split.cpus] == [0, 64] * 4
+        assert "8 outer x 12 inner" in caplog.text
+
+    def test_fits_on_one_node(self):
+        split = corr.plan_core_split(
+            cores=32, n_channels=30, numa_nodes=self.nodes)
+        assert split == corr.CoreSplit(2, 16, None)
+
+    def test_cores_outer(self):
+        split = corr.plan_core_split(
+            cores=2, n_channels=3, cores_outer=4, numa_nodes=self.nodes)
+        assert split.outer == 3
+        assert split.inner == 2
+
+    def test_parse_cpulist(self):
+        assert corr._parse_cpulist("0-3,8,10-11\n") == {
+            0, 1, 2, 3, 8, 10, 11}
+
+    def test_outer_matches_inner(self, multichannel_templates,
+                                 multichannel_stream):
+        func = corr.get_stream_xcorr('fftw')
+        for stack in [True, False]:
+            inner = func(multichannel_templates, multichannel_stream.copy(),
+                         stack=stack, cores=1)
+            outer = func(multichannel_templates, multichannel_stream.copy(),
+                         stack=stack, cores=1, cores_outer=3)
+            assert np.allclose(inner[0], outer[0], atol=1e-6)
+            assert np.array_equal(inner[1], outer[1])
+            assert inner[2] == outer[2]
+
+
+class TestNumpyBatched:
+    """ Tests for the batched numpy correlation backend """
+    @pytest.mark.parametrize("stack", [True, False])
+    def test_batches_and_segments(self, multichannel_templates,
+                                  gappy_multichannel_stream, monkeypatch,
+                                  stack):
+        fftw = corr.get_stream_xcorr('fftw')(
+            multichannel_templates, gappy_multichannel_stream.copy(),
+            stack=stack, cores=1)
+        # Force several template batches and short data segments
+        monkeypatch.setattr(corr, "NUMPY_BATCH_BYTES", 2 ** 20)
+        batched = corr.get_stream_xcorr('numpy_batched')(
+            multichannel_templates, gappy_multichannel_stream.copy(),
+            stack=stack, fft_len=2 ** 11)
+        # fftw running variance is less precise at the edges of the gap
+        assert np.allclose(fftw[0], batched[0], atol=1e-4)
+        assert np.array_equal(fftw[1], batched[1])
+        assert fftw[2] == batched[2]
+
+    @pytest.mark.parametrize("stack", [True, False])
+    def test_channel_batches(self, multichannel_templates,
+                             multichannel_stream, monkeypatch, stack):
+        batched = corr.get_stream_xcorr('numpy_batched')(
+            multichannel_templates, multichannel_stream.copy(), stack=stack,
+            fft_len=2 ** 11)
+        # Too small for one template on all channels
+        monkeypatch.setattr(corr, "NUMPY_BATCH_BYTES", 2 ** 16)
+        split = corr.get_stream_xcorr('numpy_batched')(
+            multichannel_templates, multichannel_stream.copy(), stack=stack,
+            fft_len=2 ** 11)
+        assert np.allclose(batched[0], split[0], atol=1e-6)
+        assert np.array_equal(batched[1], split[1])
+
+    def test_quiet_after_loud(self):
+        random = np.random.RandomState(11)
+        # Large early amplitudes grow full-record sums of squares far past
+        # the variance of the quiet windows.
+        stream = np.concatenate([random.randn(100000) * 1e4,
+                                 random.randn(100000) * 1e-2])
+        templates = random.randn(2, 200)
+        templates[0] = stream[150000:150200]
+        ccc, _ = corr.numpy_batched_normxcorr(templates, stream, [0, 0])
+        quiet_ccc, _ = corr.numpy_batched_normxcorr(
+            templates, stream[100000:], [0, 0])
+        # Past the segment that straddles the change in amplitude
+        assert np.allclose(
+            ccc[:, 100000 + 2 ** 13:], quiet_ccc[:, 2 ** 13:], atol=1e-5)
+        assert ccc[0].argmax() == 150000
+
+    def test_nan_template(self):
+        random = np.random.RandomState(7)
+        stream = random.randn(3000).astype(np.float32)
+        templates = random.randn(3, 200).astype(np.float32)
+        templates[1] = np.nan
+        ccc, used_chans = corr.numpy_batched_normxcorr(
+            templates, stream, [0, 0, 4])
+        assert np.array_equal(used_chans, [True, False, True])
+        assert np.all(ccc[1] == 0)
+        assert np.all(ccc[2, -4:] == 0)
+
+
+class TestStackedAccumulation:
+    """ Tests for summing correlations over channels in-place """
+    @pytest.mark.parametrize("concurrency", ["stream_xcorr", "multithread"])
+    def test_dtypes(self, multichannel_templates, multichannel_stream,
+                    concurrency):
+        func = corr.get_stream_xcorr('numpy', concurrency)
+        cccsums, no_chans, _ = func(
+            multichannel_templates, multichannel_stream.copy(), cores=2)
+        cccsums_64, no_chans_64, _ = func(
+            multichannel_templates, multichannel_stream.copy(), cores=2,
+            accumulate_float64=True)
+        unstacked, _, _ = func(
+            multichannel_templates, multichannel_stream.copy(), cores=2,
+            stack=False)
+        assert cccsums.dtype == np.float32
+        assert cccsums_64.dtype == np.float64
+        assert unstacked.dtype == np.float32
+        assert np.allclose(cccsums, cccsums_64, atol=1e-5)
+        assert np.allclose(cccsums_64, unstacked.sum(axis=1), atol=1e-5)
+        assert np.array_equal(no_chans, no_chans_64)
+
+    @pytest.mark.superslow
+    def test_peak_memory(self):
+        """
+        Peak memory of stacking correlations for 500 templates and 100
+        channels of one day of 1 Hz data, using a correlation function that
+        does no work.
+        """
+        import tracemalloc
+
+        n_templates, n_channels, npts, template_len = 500, 100, 86400, 10
+        stream = Stream([Trace(
+            data=np.random.randn(npts).astype(np.float32),
+            header=dict(network="NZ", station="S{0:03d}".format(i),
+                        channel="HHZ", sampling_rate=1.0))
+            for i in range(n_channels)])
+        template = Stream([tr.slice(
+            tr.stats.starttime, tr.stats.starttime + template_len - 1)
+            for tr in stream])
+        templates = [template.copy() for _ in range(n_templates)]
+
+        def ones_xcorr(templates, stream, pads, *args, **kwargs):
+            return (np.ones((len(templates), len(stream) -
+                             templates.shape[1] + 1), dtype=np.float32),
+                    np.ones(len(templates), dtype=bool))
+
+        tracemalloc.start()
+        cccsums, _, _ = corr._general_serial(ones_xcorr)(templates, stream)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("Peak memory stacking {0} templates x {1} channels x {2} "
+              "samples: {3:.1f} MB for {4:.1f} MB of correlation sums".format(
+                  n_templates, n_channels, npts, peak / 1e6,
+                  cccsums.nbytes / 1e6))
+        assert np.all(cccsums == n_channels)
+        # The sums, one channel of correlations and the stream data
+        assert peak < 3 * cccsums.nbytes
+
+
+class TestEstimateCorrelationMemory:
+    def test_linear_in_templates(self):
+        shape = dict(n_channels=10, template_len=200, image_len=100000,
+                     fft_len=2 ** 13)
+        sizes = [corr.estimate_correlation_memory(n_templates=n, **shape)
+                 for n in range(4)]
+        steps = np.diff(sizes)
+        assert np.all(steps > 0)
+        assert np.all(steps == steps[0])
+
+    def test_against_fftw_allocation(self):
+        """ The estimate should cover the arrays the fftw backend makes. """
+        import tracemalloc
+
+        n_templates, n_channels, template_len, image_len = 50, 4, 200, 50000
+        templates = np.random.randn(
+            n_templates, template_len).astype(np.float32)
+        stream = np.random.randn(image_len).astype(np.float32)
+        template_dict = {"chan{0}".format(i): templates
+                         for i in range(n_channels)}
+        stream_dict = {"chan{0}".format(i): stream.copy()
+                       for i in range(n_channels)}
+        pad_dict = {"chan{0}".format(i): [0] * n_templates
+                    for i in range(n_channels)}
+        seed_ids = list(template_dict.keys())
+        tracemalloc.start()
+        corr.fftw_multi_normxcorr(
+            template_array=template_dict, stream_array=stream_dict,
+            pad_array=pad_dict, seed_ids=seed_ids, cores_inner=1,
+            fft_len=2 ** 13)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        estimate = corr.estimate_correlation_memory(
+            n_templates=n_templates, n_channels=n_channels,
+            template_len=template_len, image_len=image_len, fft_len=2 ** 13)
+        # tracemalloc does not see the C allocations, which are included
+        # in the estimate
+        assert peak < estimate
+
+
+class TestTuneFFTLen:
+    """ Tests for the fft length auto-tuner """
+    @pytest.fixture(autouse=True)
+    def cache_file(self, tmpdir, monkeypatch):
+        filename = str(tmpdir.join("config", "fft_len.json"))
+        monkeypatch.setenv("EQCORRSCAN_FFT_LEN_CACHE", filename)
+        yield filename
+        corr._FFT_LEN_CACHES.pop(filename, None)
+
+    def test_tune_and_cache(self, cache_file):
+        assert corr.get_tuned_fft_len(100, 3, 2, 1) is None
+        best = corr.tune_fft_len(100, 3, 2, cores=1, stream_len=5000,
+                                 candidates=[256, 512, 1024], n_repeats=1)
+        assert best in (256, 512, 1024)
+        assert corr.get_tuned_fft_len(100, 3, 2, 1) == best
+        assert os.path.isfile(cache_file)
+        # Read back from file
+        corr._FFT_LEN_CACHES.pop(cache_file)
+        assert corr.get_tuned_fft_len(100, 3, 2, 1) == best
+        assert corr.get_tuned_fft_len(100, 3, 2, 2) is None
+
+    def test_no_save(self, cache_file):
+        corr.tune_fft_len(100, 3, 1, cores=1, stream_len=5000,
+                          candidates=[512], n_repeats=1, save=False)
+        assert corr.get_tuned_fft_len(100, 3, 1, 1) is None
+        assert not os.path.isfile(cache_file)
+
+    def test_short_candidates(self):
+        with pytest.raises(ValueError):
+            corr.tune_fft_len(1000, 3, candidates=[256, 512])
+
+    def test_default_uses_tuned(self, cache_file):
+        assert corr._default_fft_len(100, 50000, 3, 2, 1) == 2 ** 13
+        corr._read_fft_len_cache(cache_file)[
+            corr._fft_len_key(100, 3, 2, 1)] = 1024
+        assert corr._default_fft_len(100, 50000, 3, 2, 1) == 1024
+        # Never longer than needed for the data
+        assert corr._default_fft_len(100, 500, 3, 2, 1) == next_fast_len(599)
@@ -10,7 +10,9 @@ from obspy.core.event import Catalog, Event, Origin
 
 from eqcorrscan.utils.findpeaks import (
     find_peaks2_short, coin_trig, multi_find_peaks, find_peaks_compiled,
-    _multi_find_peaks_c, _find_peaks_c, decluster, decluster_distance_time)
+    _multi_find_peaks_c, _find_peaks_c, decluster, decluster_distance_time,
+    _multi_decluster, find_peaks_fused, median_abs)
+from eqcorrscan.utils.clustering import dist_mat_km
 from eqcorrscan.utils.timer import time_func
 
 
@@ -100,6 +102,65 @@ class TestDeclustering:
             threshold=0)
         assert len(peaks) == len(peaks_out)
 
+    @pytest.mark.parametrize("trig_int,hypocentral_separation,threshold", [
+        (100, 10.0, 0), (20, 30.0, 0.5), (100, 0.0, 0), (0, 5.0, 0)])
+    def test_dist_time_matches_distance_matrix(
+            self, trig_int, hypocentral_separation, threshold):
+        """ Check against declustering with a full distance matrix. """
+        random = np.random.RandomState(42)
+        locations = [Origin(latitude=random.uniform(-41, -40),
+                            longitude=random.uniform(175, 176),
+                            depth=random.uniform(0, 20000))
+                     for _ in range(20)]
+        catalog = Catalog([Event(origins=[locations[i]])
+                           for i in random.randint(0, 20, 500)])
+        peaks = random.randn(500).astype(np.float32)
+        index = random.randint(0, 25000, 500)
+        peaks_out = decluster_distance_time(
+            peaks, index, trig_int, catalog, hypocentral_separation,
+            threshold=threshold)
+        # Greedy declustering with the dense distance matrix
+        order = np.abs(peaks).argsort()[::-1]
+        distances = dist_mat_km(Catalog([catalog[i] for i in order]))
+        kept = []
+        for i, position in enumerate(order):
+            if abs(peaks[position]) < threshold:
+                break
+            if not any(abs(index[position] - index[order[j]]) <= trig_int
+                       and distances[i, j] < hypocentral_separation
+                       for j in kept):
+                kept.append(i)
+        assert peaks_out == [(peaks[order[i]], index[order[i]])
+                             for i in kept]
+
+    @pytest.mark.parametrize("trig_int,threshold,scale", [
+        (0, 0, 1), (5, 0, 1), (300, 5, 1), (300, 0, int(1e10))])
+    def test_sweep_matches_pairwise(self, trig_int, threshold, scale):
+        """ Check the sorted-sweep gives the same result as pairwise. """
+        random = np.random.RandomState(42)
+        peaks = (random.randn(5000) * 10).astype(np.float32)
+        # Include repeated indexes and values
+        index = random.randint(0, 50000, 5000) * scale
+        peaks[100:110] = peaks[0]
+        peaks_out = decluster(
+            peaks, index, trig_int * scale, threshold=threshold)
+        pairwise_out = decluster(
+            peaks, index, trig_int * scale, threshold=threshold, sweep=False)
+        assert peaks_out == pairwise_out
+
+    def test_multi_sweep_matches_pairwise(self):
+        random = np.random.RandomState(42)
+        peaks = [random.randn(length).astype(np.float32)
+                 for length in (1, 100, 10000)]
+        indices = [np.arange(len(_peaks)) for _peaks in peaks]
+        thresholds = [0.0, 0.5, 1.0]
+        peaks_out = _multi_decluster(
+            peaks, indices, trig_int=20, thresholds=thresholds, cores=2)
+        pairwise_out = _multi_decluster(
+            peaks, indices, trig_int=20, thresholds=thresholds, cores=2,
+            sweep=False)
+        assert peaks_out == pairwise_out
+
 
 class TestStandardPeakFinding:
     """ Run peak finding against a standard cc array """
@@ -170,6 +231,76 @@ class TestStandardPeakFinding:
         assert len(full_peak_array_py) == 69
 
 
+class TestFusedPeakFinding:
+    @pytest.fixture(scope='class')
+    def arrays(self):
+        random = np.random.RandomState(42)
+        return (random.randn(10, 20000) ** 3).astype(np.float32)
+
+    @staticmethod
+    def _split(arrays, rows, samples, values):
+        return [[(value, sample) for row, sample, value in zip(
+            rows, samples, values) if row == i] for i in range(len(arrays))]
+
+    @pytest.mark.parametrize("full_peaks", [False, True])
+    def test_matches_multi_find_peaks(self, arrays, full_peaks):
+        thresholds = [8 * np.median(np.abs(arr)) for arr in arrays]
+        peaks = multi_find_peaks(
+            arrays, thresholds, trig_int=50, parallel=True,
+            full_peaks=full_peaks, cores=2)
+        rows, samples, values, fused_thresholds = find_peaks_fused(
+            arrays, [8] * len(arrays), trig_int=50, mad=True,
+            full_peaks=full_peaks, cores=2)
+        assert np.all(fused_thresholds == np.array(thresholds))
+        assert self._split(arrays, rows, samples, values) == peaks
+
+    def test_median_even_and_odd(self):
+        for length in (5, 6):
+            arr = np.arange(length, dtype=np.float32).reshape(1, length) - 2
+            thresholds = find_peaks_fused(arr, [1], trig_int=1, mad=True)[3]
+            assert thresholds[0] == np.median(np.abs(arr))
+
+    @pytest.mark.parametrize("length", [1, 2, 5, 6, 20001])
+    def test_approximate_median(self, arrays, length):
+        arr = arrays[:, 0:length]
+        exact = np.median(np.abs(arr), axis=1)
+        assert np.all(median_abs(arr, cores=2) == exact.astype(np.float32))
+        for n_bins in (1, 16, 1024):
+            approx = median_abs(arr, approximate=True, n_bins=n_bins)
+            # Bound plus float32 rounding
+            bound = np.abs(arr).max(axis=1) / (2 * n_bins ** 2) + 1e-6 * exact
+            assert np.all(np.abs(approx - exact) <= bound)
+
+    def test_approximate_median_zeros(self):
+        arr = np.zeros((2, 100), dtype=np.float32)
+        assert np.all(median_abs(arr, approximate=True) == 0)
+
+    def test_approximate_mad_thresholds(self, arrays):
+        _, _, _, exact = find_peaks_fused(
+            arrays, [8] * len(arrays), trig_int=50, mad=True)
+        _, _, _, approx = find_peaks_fused(
+            arrays, [8] * len(arrays), trig_int=50, mad=True,
+            approximate=True)
+        bound = 8 * np.abs(arrays).max(axis=1) / (2 * 1024 ** 2)
+        assert np.all(np.abs(approx - exact) <= bound + 1e-6 * exact)
+        with pytest.raises(ValueError):
+            median_abs(arrays, approximate=True, n_bins=0)
+
+    def test_many_peaks(self):
+        """ More peaks than the initial space allocated for each row. """
+        arr = np.zeros((2, 100000), dtype=np.float32)
+        arr[:, ::20] = np.arange(5000)
+        rows, samples, values, _ = find_peaks_fused(
+            arr, [0.5, 0.5], trig_int=5)
+        assert len(rows) == 2 * 4999
+        assert np.all(samples[0:4999] == np.arange(20, 100000, 20))
+
+    def test_no_peaks(self, arrays):
+        rows, samples, values, _ = find_peaks_fused(
+            arrays, [1e10] * len(arrays), trig_int=50)
+        assert len(rows) == len(samples) == len(values) == 0
+
+
 class TestEdgeCases:
     """ A selection of weird datasets to find peaks in. """
     datasets = []
@@ -258,6 +389,59 @@ class TestCoincidenceTrigger:
                              moveout=3, min_trig=2, trig_int=1)
         assert triggers, [(0.45, 100)]
 
+    @staticmethod
+    def _pairwise_coin_trig(peaks, stachans, samp_rate, moveout, min_trig,
+                            trig_int):
+        """ The original pairwise coincidence trigger. """
+        triggers = [(peak[1], peak[0], '.'.join(stachan))
+                    for stachan, _peaks in zip(stachans, peaks)
+                    for peak in _peaks]
+        coincidence_triggers = []
+        for i, master in enumerate(triggers):
+            coincidence, trig_time, trig_val = 1, master[0], master[1]
+            for slave in triggers[i + 1:]:
+                if abs(slave[0] - master[0]) <= (moveout * samp_rate) and \
+                   slave[2] != master[2]:
+                    coincidence += 1
+                    if slave[0] < master[0]:
+                        trig_time = slave[0]
+                    trig_val += slave[1]
+            if coincidence >= min_trig:
+                coincidence_triggers.append(
+                    (trig_val / coincidence, trig_time))
+        coincidence_triggers.sort(key=lambda tup: tup[0], reverse=True)
+        output = []
+        for coincidence_trigger in coincidence_triggers:
+            if all(abs(coincidence_trigger[1] - peak[1]) >=
+                   trig_int * samp_rate for peak in output):
+                output.append(coincidence_trigger)
+        output.sort(key=lambda tup: tup[1])
+        return output
+
+    @pytest.mark.parametrize("moveout,trig_int", [
+        (0, 0), (0.5, 0.1), (3, 1), (7.3, 2.35)])
+    def test_matches_pairwise(self, moveout, trig_int):
+        random = np.random.RandomState(42)
+        for _ in range(50):
+            peaks = [[(float(random.choice([0.3, 0.5, random.rand()])),
+                       int(random.randint(0, 400)))
+                      for _ in range(random.randint(0, 15))]
+                     for _ in range(random.randint(1, 8))]
+            # Repeat some station-channels
+            stachans = [('s{0}'.format(i % 5), 'Z') for i in range(len(peaks))]
+            for samp_rate, min_trig in ((1, 1), (10, 2), (2.5, 3)):
+                kwargs = dict(samp_rate=samp_rate, moveout=moveout,
+                              min_trig=min_trig, trig_int=trig_int)
+                assert coin_trig(peaks, stachans, **kwargs) == \
+                    self._pairwise_coin_trig(peaks, stachans, **kwargs)
+
+    def test_no_triggers(self):
+        assert coin_trig([[], []], [('a', 'Z'), ('b', 'Z')], samp_rate=10,
+                         moveout=3, min_trig=2, trig_int=1) == []
+        assert coin_trig([[(0.5, 100)], [(0.4, 800)]],
+                         [('a', 'Z'), ('b', 'Z')], samp_rate=10, moveout=3,
+                         min_trig=2, trig_int=1) == []
+
 
 @pytest.mark.serial
 class TestPeakFindSpeeds:
@@ -462,3 +646,42 @@ class TestPeakFindSpeeds:
         assert len(serial_peaks) == len(parallel_peaks)
         for i in range(len(serial_peaks)):
             assert serial_peaks[i] == parallel_peaks[i]
+
+
+@pytest.mark.serial
+class TestDeclusterSpeeds:
+    """ Compare the sorted-sweep and pairwise declustering routines. """
+    n_peaks = 50000
+
+    @pytest.fixture(scope='class')
+    def sparse_peaks(self):
+        """ Mostly isolated peaks, the worst case for pairwise """
+        random = np.random.RandomState(42)
+        peaks = random.randn(self.n_peaks).astype(np.float32)
+        index = random.randint(0, 1000 * self.n_peaks, self.n_peaks)
+        return peaks, index
+
+    def test_sparse_timings(self, sparse_peaks):
+        peaks, index = sparse_peaks
+        sweep_out = time_func(
+            decluster, "sweep-decluster", peaks=peaks, index=index,
+            trig_int=600)
+        pairwise_out = time_func(
+            decluster, "pairwise-decluster", peaks=peaks, index=index,
+            trig_int=600, sweep=False)
+        assert sweep_out == pairwise_out
+
+    def test_full_peaks_timings(self):
+        """ Every sample is a candidate when using full_peaks """
+        random = np.random.RandomState(42)
+        arr = random.randn(8, self.n_peaks).astype(np.float32)
+        indices = [np.arange(self.n_peaks) for _ in arr]
+        thresholds = [0.1 for _ in arr]
+        sweep_out = time_func(
+            _multi_decluster, "sweep-multi-decluster", peaks=arr,
+            indices=indices, trig_int=10, thresholds=thresholds, cores=2)
+        pairwise_out = time_func(
+            _multi_decluster, "pairwise-multi-decluster", peaks=arr,
+            indices=indices, trig_int=10, thresholds=thresholds, cores=2,
+            sweep=False)
+        assert sweep_out == pairwise_out
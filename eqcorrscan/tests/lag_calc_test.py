@@ -218,6 +218,18 @@ class SimpleRealDataTests(unittest.TestCase):
                 self.assertTrue(np.allclose(
                     chan_ccc, fftw_chan_ccc, atol=.00001))
 
+    def test_correlation_maxima(self):
+        """Check that output="max" matches the full correlations"""
+        ccc, chans = _concatenate_and_correlate(
+            streams=self.detect_streams, template=self.template, cores=1)
+        maxima, max_chans = _concatenate_and_correlate(
+            streams=self.detect_streams, template=self.template, cores=1,
+            output="max")
+        self.assertEqual(chans, max_chans)
+        self.assertEqual(maxima.max_cc.shape, ccc.shape[0:2])
+        self.assertTrue(np.allclose(maxima.max_cc, ccc.max(axis=-1)))
+        self.assertTrue(np.array_equal(maxima.lag, ccc.argmax(axis=-1)))
+
 
 class ShortTests(unittest.TestCase):
     @classmethod
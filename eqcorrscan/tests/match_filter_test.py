@@ -18,10 +18,16 @@ from eqcorrscan.core.match_filter import (
     write_catalog, extract_from_stream, Tribe, Template, Party, Family,
     read_party, read_tribe, _spike_test)
 from eqcorrscan.core.match_filter.matched_filter import (
-    match_filter, MatchFilterError)
-from eqcorrscan.core.match_filter.helpers import get_waveform_client
+    match_filter, MatchFilterError, _memory_group_size, _prefetch,
+    _group_detect)
+from eqcorrscan.core.match_filter.helpers import (
+    get_waveform_client, CorrelationCache, temporary_directory,
+    read_cccsums)
+from eqcorrscan.core.match_filter.realtime import (
+    RealTimeTribe, stream_packets, _RingBuffer)
 from eqcorrscan.utils import pre_processing, catalog_utils
-from eqcorrscan.utils.correlate import fftw_normxcorr, numpy_normxcorr
+from eqcorrscan.utils.correlate import (
+    fftw_normxcorr, numpy_normxcorr, TemplateSpectra)
 from eqcorrscan.utils.catalog_utils import filter_picks
 
 
@@ -173,6 +179,546 @@ class TestSynthData(unittest.TestCase):
                      plotvar=False)
 
 
+class TestCorrelationCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random = np.random.RandomState(42)
+        cls.template = read()
+        cls.stream = read()
+        for tr in cls.stream:
+            data = tr.data
+            tr.data = random.randn(10000) * 5
+            tr.data[100: 100 + len(data)] = data
+            tr.data[6000: 6000 + len(data)] = data * 0.5
+
+    def _run(self, cache, threshold=8, stream=None):
+        calls = []
+
+        def counting_xcorr(templates, stream, pads, *args, **kwargs):
+            calls.append(len(templates))
+            return numpy_normxcorr(templates, stream, pads)
+
+        detections = match_filter(
+            template_names=['1'], template_list=[self.template],
+            st=stream or self.stream, threshold=threshold,
+            threshold_type='MAD', trig_int=1, xcorr_func=counting_xcorr,
+            correlation_cache=cache)
+        return detections, len(calls)
+
+    def test_cache_hit(self):
+        with temporary_directory() as cache_dir:
+            cache = CorrelationCache(cache_dir)
+            detections, n_calls = self._run(cache)
+            self.assertEqual(len(detections), 2)
+            self.assertGreater(n_calls, 0)
+            cached_detections, n_calls = self._run(cache)
+            self.assertEqual(n_calls, 0)
+            for detection, cached_detection in zip(
+                    detections, cached_detections):
+                self.assertEqual(
+                    detection.detect_time, cached_detection.detect_time)
+                self.assertEqual(
+                    detection.detect_val, cached_detection.detect_val)
+                self.assertEqual(detection.chans, cached_detection.chans)
+            # Re-thresholding uses the same correlations
+            _, n_calls = self._run(cache, threshold=20)
+            self.assertEqual(n_calls, 0)
+
+    def test_cache_miss_on_changed_data(self):
+        with temporary_directory() as cache_dir:
+            cache = CorrelationCache(cache_dir)
+            self._run(cache)
+            stream = self.stream.copy()
+            stream[0].data[10] += 1
+            _, n_calls = self._run(cache, stream=stream)
+            self.assertGreater(n_calls, 0)
+            self.assertEqual(
+                len([f for f in os.listdir(cache_dir)
+                     if f.endswith(".npy")]), 2)
+
+    def test_key_resolves_backend(self):
+        from eqcorrscan.utils.correlate import set_xcorr
+
+        def key(**kwargs):
+            return CorrelationCache.key(
+                template_names=['1'], templates=[self.template],
+                stream=self.stream, **kwargs)
+
+        self.assertEqual(key(), key(xcorr_func="fftw"))
+        self.assertEqual(key(xcorr_func=numpy_normxcorr),
+                         key(xcorr_func="numpy"))
+        self.assertNotEqual(key(xcorr_func="numpy"),
+                            key(xcorr_func="time_domain"))
+        self.assertNotEqual(
+            key(xcorr_func="numpy"),
+            key(xcorr_func="numpy", concurrency="multiprocess"))
+        default_key = key()
+        with set_xcorr("numpy"):
+            self.assertNotEqual(key(), default_key)
+
+    def test_group_detect_skips_processing(self):
+        from unittest import mock
+        from eqcorrscan.core.match_filter import matched_filter
+
+        template = Template(
+            name="a", st=self.template.copy().filter(
+                "bandpass", freqmin=2, freqmax=8),
+            lowcut=2.0, highcut=8.0, samp_rate=100.0, filt_order=4,
+            process_length=50, prepick=0.1)
+        calls = []
+
+        def counting_xcorr(templates, stream, pads, *args, **kwargs):
+            calls.append(len(templates))
+            return numpy_normxcorr(templates, stream, pads)
+
+        def detect(threshold, cache=None, lowcut=2.0):
+            template.lowcut = lowcut
+            return _group_detect(
+                templates=[template], stream=self.stream, threshold=threshold,
+                threshold_type='MAD', trig_int=1, overlap=None,
+                parallel_process=False, xcorr_func=counting_xcorr,
+                correlation_cache=cache)
+
+        with temporary_directory() as cache_dir:
+            cache = CorrelationCache(cache_dir)
+            detect(8, cache)
+            self.assertGreater(len(calls), 0)
+            calls.clear()
+            with mock.patch.object(
+                    matched_filter, "_shortproc",
+                    wraps=matched_filter._shortproc) as shortproc:
+                party = detect(20, cache)
+            shortproc.assert_not_called()
+            self.assertEqual(len(calls), 0)
+            expected = detect(20)
+            self.assertGreater(len(expected[0]), 0)
+            self.assertEqual(len(party[0]), len(expected[0]))
+            for detection, expected_detection in zip(
+                    party[0], expected[0]):
+                self.assertEqual(
+                    detection.detect_time, expected_detection.detect_time)
+                self.assertAlmostEqual(
+                    detection.detect_val, expected_detection.detect_val, 4)
+                self.assertEqual(
+                    [pick.time for pick in detection.event.picks],
+                    [pick.time for pick in expected_detection.event.picks])
+            # Changing the processing misses the cache
+            calls.clear()
+            detect(20, cache, lowcut=3.0)
+            self.assertGreater(len(calls), 0)
+
+    def test_group_detect_partial_hit(self):
+        from unittest import mock
+        from eqcorrscan.core.match_filter import matched_filter
+
+        templates = [
+            Template(name=name, st=self.template.copy(), lowcut=lowcut,
+                     highcut=highcut, samp_rate=100.0, filt_order=4,
+                     process_length=50, prepick=0.1)
+            for name, lowcut, highcut in [("a", 2.0, 8.0), ("b", 1.0, 5.0)]]
+        with temporary_directory() as cache_dir:
+            cache = CorrelationCache(cache_dir)
+            kwargs = dict(
+                stream=self.stream, threshold=8, threshold_type='MAD',
+                trig_int=1, overlap=None, parallel_process=False,
+                xcorr_func="numpy", correlation_cache=cache)
+            _group_detect(templates=templates[0:1], **kwargs)
+            with mock.patch.object(
+                    matched_filter, "_shortproc",
+                    wraps=matched_filter._shortproc) as shortproc:
+                party = _group_detect(templates=templates, **kwargs)
+            # Two chunks, filtered only for the group not in the cache
+            self.assertEqual(shortproc.call_count, 2)
+            for call in shortproc.call_args_list:
+                self.assertEqual(call.kwargs["filters"], [(1.0, 5.0, 4)])
+        uncached = _group_detect(
+            templates=templates, **dict(kwargs, correlation_cache=None))
+        for family, uncached_family in zip(
+                sorted(party, key=lambda f: f.template.name),
+                sorted(uncached, key=lambda f: f.template.name)):
+            self.assertEqual(
+                [d.detect_time for d in family],
+                [d.detect_time for d in uncached_family])
+
+    def test_cccsums_memory_mapped(self):
+        with temporary_directory() as cache_dir:
+            cache = CorrelationCache(cache_dir)
+            cccsums = np.random.randn(3, 100).astype(np.float32)
+            chans = [[("A", "Z")], [("A", "Z"), ("B", "Z")], []]
+            cache.put("abc", cccsums, [1, 2, 0], chans)
+            self.assertIn("abc", cache)
+            cached, no_chans, cached_chans = cache.get("abc")
+            self.assertIsInstance(cached, np.memmap)
+            self.assertTrue(np.array_equal(cached, cccsums))
+            self.assertEqual(no_chans, [1, 2, 0])
+            self.assertEqual(cached_chans, chans)
+            self.assertIsNone(cache.get("def"))
+
+
+class TestReturnCccsums(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random = np.random.RandomState(42)
+        cls.template = read()
+        cls.stream = read()
+        for tr in cls.stream:
+            data = tr.data
+            tr.data = random.randn(10000) * 5
+            tr.data[100: 100 + len(data)] = data
+
+    def test_mmap_output(self):
+        with temporary_directory() as cccsum_dir:
+            detections = match_filter(
+                template_names=['a', 'b'],
+                template_list=[self.template, self.template[0:2]],
+                st=self.stream, threshold=8, threshold_type='MAD',
+                trig_int=1, return_cccsums="mmap:" + cccsum_dir)
+            cccsums = read_cccsums(cccsum_dir)
+            self.assertEqual(sorted(cccsums.keys()), ['a', 'b'])
+            for name, no_chans in [('a', 3), ('b', 2)]:
+                self.assertEqual(len(cccsums[name]), 1)
+                tr = cccsums[name][0]
+                self.assertIsInstance(tr.data, np.memmap)
+                self.assertEqual(len(tr.data), 10000 - 3000 + 1)
+                self.assertEqual(
+                    tr.stats.starttime, self.stream[0].stats.starttime)
+                self.assertEqual(tr.stats.no_chans, no_chans)
+                detection = [d for d in detections
+                             if d.template_name == name][0]
+                self.assertAlmostEqual(
+                    detection.detect_val, tr.data[100], places=4)
+                self.assertEqual(detection.chans, tr.stats.chans)
+
+    def test_approximate_mad(self):
+        detections = {
+            threshold_type: match_filter(
+                template_names=['a'], template_list=[self.template],
+                st=self.stream, threshold=8, threshold_type=threshold_type,
+                trig_int=1)
+            for threshold_type in ('MAD', 'MAD_approx')}
+        self.assertGreater(len(detections['MAD']), 0)
+        self.assertEqual(
+            len(detections['MAD']), len(detections['MAD_approx']))
+        for exact, approx in zip(detections['MAD'],
+                                 detections['MAD_approx']):
+            self.assertEqual(exact.detect_time, approx.detect_time)
+            self.assertEqual(exact.detect_val, approx.detect_val)
+            self.assertEqual(approx.threshold_type, 'MAD_approx')
+            self.assertAlmostEqual(
+                exact.threshold / approx.threshold, 1.0, places=4)
+
+    def test_bad_return_cccsums(self):
+        with self.assertRaises(MatchFilterError):
+            match_filter(
+                template_names=['a'], template_list=[self.template],
+                st=self.stream, threshold=8, threshold_type='MAD',
+                trig_int=1, return_cccsums="bob")
+
+
+class TestMemoryGroupSize(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        st = read()
+        cls.templates = [
+            Template(name=str(i), st=st, lowcut=2.0, highcut=8.0,
+                     samp_rate=100.0, filt_order=4, process_length=3600,
+                     prepick=0.1) for i in range(10)]
+
+    def test_groups_fit_limit(self):
+        size, predicted = _memory_group_size(
+            self.templates, memory_limit=2 ** 40, cores=1)
+        self.assertEqual(size, 10)
+        one, one_predicted = _memory_group_size(
+            self.templates, memory_limit=2 ** 40, group_size=1, cores=1)
+        self.assertEqual(one, 1)
+        # Six templates fit, balanced to two groups of five
+        limit = (one_predicted + (predicted - one_predicted) / 9 * 5.5)
+        size, predicted = _memory_group_size(
+            self.templates, memory_limit=limit, cores=1)
+        self.assertEqual(size, 5)
+        self.assertLess(predicted, limit)
+
+    def test_limit_too_small(self):
+        size, _ = _memory_group_size(
+            self.templates, memory_limit=1, cores=1)
+        self.assertEqual(size, 1)
+
+    def test_stored_spectra_counted(self):
+        kwargs = dict(templates=self.templates, memory_limit=2 ** 40,
+                      group_size=1, cores=1)
+        _, without = _memory_group_size(template_spectra=None, **kwargs)
+        _, stored = _memory_group_size(template_spectra=True, **kwargs)
+        # Spectra of all ten templates are kept between chunks
+        n_freqs = 2 ** 13 // 2 + 1
+        self.assertEqual(stored - without, 10 * 3 * n_freqs * 8)
+        _, capped = _memory_group_size(
+            template_spectra=TemplateSpectra(max_bytes=1000), **kwargs)
+        self.assertEqual(capped - without, 1000)
+
+
+class TestPipelinedProcessing(unittest.TestCase):
+    def test_prefetch_order(self):
+        self.assertEqual(list(_prefetch(iter(range(10)))), list(range(10)))
+
+    def test_prefetch_overlaps(self):
+        import time
+
+        def slow_producer():
+            for i in range(4):
+                time.sleep(0.2)
+                yield i
+
+        tic = time.time()
+        for _ in _prefetch(slow_producer()):
+            time.sleep(0.2)
+        # Serial would take 1.6 s
+        self.assertLess(time.time() - tic, 1.4)
+
+    def test_prefetch_bounded(self):
+        produced = []
+
+        def producer():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        items = _prefetch(producer(), buffer_size=1)
+        next(items)
+        import time
+        time.sleep(0.3)
+        # One consumed, one buffered and one waiting to be buffered
+        self.assertLessEqual(len(produced), 3)
+        items.close()
+
+    def test_prefetch_error(self):
+        def failing_producer():
+            yield 1
+            raise ValueError("bad chunk")
+
+        items = _prefetch(failing_producer())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_group_detect_chunks(self):
+        random = np.random.RandomState(42)
+        template_st = read()
+        template_st.filter("bandpass", freqmin=2, freqmax=8)
+        stream = read()
+        for tr in stream:
+            data = tr.data
+            tr.data = random.randn(30000) * 5
+            for start in (1000, 11000, 21000):
+                tr.data[start: start + len(data)] = data
+        template = Template(
+            name="a", st=template_st, lowcut=2.0, highcut=8.0,
+            samp_rate=100.0, filt_order=4, process_length=100, prepick=0.0)
+        party = _group_detect(
+            templates=[template], stream=stream, threshold=0.8,
+            threshold_type='av_chan_corr', trig_int=2, overlap=None,
+            parallel_process=False)
+        detect_times = sorted(d.detect_time for d in party[0])
+        self.assertEqual(len(detect_times), 3)
+        for detect_time, start in zip(detect_times, (1000, 11000, 21000)):
+            self.assertAlmostEqual(
+                detect_time - stream[0].stats.starttime, start / 100.0,
+                delta=0.2)
+
+    def test_group_detect_parallel_pool(self):
+        """ Processing pool is started once, outside the prefetch thread. """
+        import threading
+        from unittest import mock
+        from eqcorrscan.core.match_filter import matched_filter
+
+        random = np.random.RandomState(42)
+        template_st = read()
+        template_st.filter("bandpass", freqmin=2, freqmax=8)
+        stream = read()
+        for tr in stream:
+            data = tr.data
+            tr.data = random.randn(30000) * 5
+            tr.data[11000: 11000 + len(data)] = data
+        template = Template(
+            name="a", st=template_st, lowcut=2.0, highcut=8.0,
+            samp_rate=100.0, filt_order=4, process_length=100, prepick=0.0)
+        pool_threads = []
+        _pool = matched_filter.Pool
+
+        def recording_pool(*args, **kwargs):
+            pool_threads.append(threading.current_thread())
+            return _pool(*args, **kwargs)
+
+        with mock.patch.object(matched_filter, "Pool", recording_pool), \
+                mock.patch.object(pre_processing, "Pool") as chunk_pool:
+            party = _group_detect(
+                templates=[template], stream=stream, threshold=0.8,
+                threshold_type='av_chan_corr', trig_int=2, overlap=None,
+                parallel_process=True, process_cores=2)
+        self.assertEqual(pool_threads, [threading.current_thread()])
+        chunk_pool.assert_not_called()
+        self.assertEqual(len(party[0]), 1)
+
+
+class TestSharedProcessing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random = np.random.RandomState(42)
+        cls.stream = read()
+        raw = read()
+        for tr in cls.stream:
+            tr.data = random.randn(30000) * 5
+            for start in (1000, 11000, 21000):
+                tr.data[start: start + 3000] = raw.select(id=tr.id)[0].data
+        cls.templates = []
+        for name, lowcut, highcut in [("a", 2.0, 8.0), ("b", 1.0, 5.0)]:
+            st = raw.copy().filter(
+                "bandpass", freqmin=lowcut, freqmax=highcut, corners=4,
+                zerophase=True)
+            cls.templates.append(Template(
+                name=name, st=st, lowcut=lowcut, highcut=highcut,
+                samp_rate=100.0, filt_order=4, process_length=100,
+                prepick=0.0))
+
+    def _detect(self, templates):
+        return _group_detect(
+            templates=templates, stream=self.stream, threshold=0.5,
+            threshold_type='av_chan_corr', trig_int=2, overlap=None,
+            parallel_process=False)
+
+    def test_matches_separate_processing(self):
+        shared = self._detect(self.templates)
+        self.assertEqual(len(shared.families), 2)
+        for template in self.templates:
+            separate = self._detect([template])
+            shared_family = shared.select(template.name)
+            self.assertEqual(len(shared_family), 3)
+            self.assertEqual(
+                [(d.detect_time, d.detect_val) for d in shared_family],
+                [(d.detect_time, d.detect_val) for d in separate[0]])
+
+    def test_different_sampling_rate(self):
+        template = self.templates[1].copy()
+        template.samp_rate = 50.0
+        with self.assertRaises(MatchFilterError):
+            self._detect([self.templates[0], template])
+
+
+class TestRealTimeTribe(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        random = np.random.RandomState(42)
+        starttime = UTCDateTime(2020, 1, 1)
+        cls.stream = Stream([
+            Trace(random.randn(10000), header=dict(
+                network="NZ", station=station, channel="HHZ",
+                sampling_rate=50.0, starttime=starttime))
+            for station in ("A", "B", "C")])
+        processed = pre_processing.shortproc(
+            cls.stream.copy(), lowcut=2.0, highcut=8.0, filt_order=4,
+            samp_rate=50.0)
+        template_st = Stream()
+        for i, tr in enumerate(processed):
+            template_st += tr.slice(starttime + 60 + i * 0.5,
+                                    starttime + 63 + i * 0.5).copy()
+            template_st[-1].data = template_st[-1].data[0:100]
+        cls.template = Template(
+            name="a", st=template_st, lowcut=2.0, highcut=8.0,
+            samp_rate=50.0, filt_order=4, process_length=200, prepick=0.1)
+        # Add a repeat of the template waveform
+        for i, tr in enumerate(cls.stream):
+            start = int((90 + i * 0.5) * 50)
+            tr.data[start: start + 100] += 3 * tr.data[
+                3000 + i * 25: 3100 + i * 25]
+
+    def _batch(self, threshold, threshold_type):
+        party = Tribe([self.template]).detect(
+            stream=self.stream.copy(), threshold=threshold,
+            threshold_type=threshold_type, trig_int=2.0, daylong=False,
+            parallel_process=False)
+        return [(d.detect_time, d.detect_val) for d in party[0]]
+
+    def test_matches_batch(self):
+        rt_tribe = RealTimeTribe(
+            templates=[self.template], threshold=0.5,
+            threshold_type="av_chan_corr", trig_int=2.0, buffer_length=60)
+        detections = list(rt_tribe.run(
+            stream_packets(self.stream, packet_length=0.5), step_length=2.0))
+        self.assertEqual(len(detections), 3)
+        batch = self._batch(0.5, "av_chan_corr")
+        for detection, (detect_time, detect_val) in zip(detections, batch):
+            self.assertEqual(detection.detect_time, detect_time)
+            self.assertAlmostEqual(detection.detect_val, detect_val, 5)
+            self.assertIsNotNone(detection.event)
+
+    def test_latency_and_metrics(self):
+        rt_tribe = RealTimeTribe(
+            templates=[self.template], threshold=8.0, threshold_type="MAD",
+            trig_int=2.0, buffer_length=60, processing_pad=2.0)
+        for packet in stream_packets(self.stream, packet_length=1.0):
+            rt_tribe.append(packet)
+            for detection in rt_tribe.step():
+                # Detections are returned within pad + template + trig_int
+                self.assertLessEqual(
+                    rt_tribe.endtime - detection.detect_time, 7.0 + 1.0)
+        self.assertEqual(len(rt_tribe.metrics), 200)
+        self.assertTrue(all(m.latency < 8.0 for m in rt_tribe.metrics))
+        self.assertEqual(
+            sum(m.detections for m in rt_tribe.metrics),
+            len(self._batch(8.0, "MAD")))
+        # Only new samples are correlated once the buffer is running
+        self.assertEqual(rt_tribe.metrics[-1].samples, 50)
+        # ffts are sized to one second steps (plus the template span), not
+        # the 60 s buffer
+        fft_lens = {key[1] for key, _ in
+                    rt_tribe._template_spectra._spectra.values()}
+        self.assertLessEqual(max(fft_lens), 512)
+
+    def test_approximate_mad(self):
+        rt_tribe = RealTimeTribe(
+            templates=[self.template], threshold=8.0,
+            threshold_type="MAD_approx", trig_int=2.0, buffer_length=60)
+        detections = list(rt_tribe.run(
+            stream_packets(self.stream, packet_length=1.0)))
+        self.assertEqual([d.detect_time for d in detections],
+                         [d[0] for d in self._batch(8.0, "MAD")])
+
+    def test_overlapping_and_gappy_packets(self):
+        packets = list(stream_packets(self.stream, packet_length=0.7))
+        packets.insert(10, packets[9])
+        packets = [packet for i, packet in enumerate(packets) if i != 60]
+        rt_tribe = RealTimeTribe(
+            templates=[self.template], threshold=0.5,
+            threshold_type="av_chan_corr", trig_int=2.0, buffer_length=60)
+        detections = list(rt_tribe.run(packets, step_length=1.0))
+        self.assertEqual([d.detect_time for d in detections],
+                         [d[0] for d in self._batch(0.5, "av_chan_corr")])
+
+    def test_reset(self):
+        rt_tribe = RealTimeTribe(
+            templates=[self.template], threshold=0.5,
+            threshold_type="av_chan_corr", trig_int=2.0, buffer_length=60)
+        first = list(rt_tribe.run(stream_packets(self.stream, 2.0)))
+        rt_tribe.reset()
+        self.assertEqual(len(rt_tribe.metrics), 0)
+        second = list(rt_tribe.run(stream_packets(self.stream, 2.0)))
+        self.assertEqual([d.detect_time for d in first],
+                         [d.detect_time for d in second])
+
+    def test_ring_buffer(self):
+        ring = _RingBuffer(capacity=5)
+        ring.append(np.arange(3))
+        ring.append(np.arange(3, 8))
+        self.assertEqual(ring.first, 3)
+        self.assertTrue(np.all(ring.get(0, 8) == np.arange(3, 8)))
+        self.assertTrue(np.all(ring.get(4, 6) == np.arange(4, 6)))
+        ring.skip_to(10)
+        self.assertEqual(len(ring), 0)
+
+    def test_bad_threshold_type(self):
+        with self.assertRaises(MatchFilterError):
+            RealTimeTribe(templates=[self.template], threshold_type="bob")
+
+
 @pytest.mark.network
 class TestGeoNetCase(unittest.TestCase):
     @classmethod
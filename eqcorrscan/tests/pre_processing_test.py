@@ -11,7 +11,8 @@ from copy import deepcopy
 from obspy import read, Trace, UTCDateTime, Stream
 
 from eqcorrscan.utils.pre_processing import (
-    process, dayproc, shortproc, _check_daylong, _prep_data_for_correlation)
+    process, dayproc, shortproc, _check_daylong, _prep_data_for_correlation,
+    _shortproc, _process_filters)
 
 
 class TestPreProcessing(unittest.TestCase):
@@ -318,6 +319,37 @@ class TestPreProcessing(unittest.TestCase):
         self.assertTrue(np.all(
             processed.trim(self.gap_starttime, self.gap_endtime).data) == 0)
 
+    def test_shared_resampling(self):
+        """ Processing with several filters matches processing each. """
+        filters = [(0.1, 0.4, 3), (None, 0.2, 2), (0.1, 0.4, 3)]
+        processed = _shortproc(
+            st=self.short_stream.copy(), filters=filters, samp_rate=1,
+            starttime=self.instart, endtime=self.inend)
+        self.assertEqual(len(processed), len(filters))
+        for (lowcut, highcut, filt_order), st in zip(filters, processed):
+            expected = shortproc(
+                st=self.short_stream.copy(), lowcut=lowcut, highcut=highcut,
+                filt_order=filt_order, samp_rate=1, starttime=self.instart,
+                endtime=self.inend)
+            self.assertEqual(len(st), len(expected))
+            for tr, expected_tr in zip(st, expected):
+                self.assertEqual(tr.stats, expected_tr.stats)
+                self.assertTrue(np.array_equal(tr.data, expected_tr.data))
+
+    def test_shared_resampling_gappy(self):
+        """ Gaps are re-zeroed for every filter. """
+        filters = [(0.1, 0.4, 3), (None, 0.3, 2)]
+        processed = _process_filters(
+            tr=self.gappy_trace.copy(), filters=filters, samp_rate=1,
+            length=3600)
+        for (lowcut, highcut, filt_order), tr in zip(filters, processed):
+            expected = process(
+                tr=self.gappy_trace.copy(), lowcut=lowcut, highcut=highcut,
+                filt_order=filt_order, samp_rate=1, length=3600)
+            self.assertTrue(np.array_equal(tr.data, expected.data))
+            self.assertTrue(np.all(
+                tr.trim(self.gap_starttime, self.gap_endtime).data == 0))
+
 
 class TestDataPrep(unittest.TestCase):
     @classmethod
@@ -20,7 +20,8 @@ from scipy.spatial.distance import squareform
 
 from eqcorrscan.utils import stacking
 from eqcorrscan.utils.archive_read import read_data
-from eqcorrscan.utils.correlate import get_array_xcorr, get_stream_xcorr
+from eqcorrscan.utils.correlate import (
+    get_array_xcorr, get_stream_xcorr, CorrelationMaxima)
 from eqcorrscan.utils.pre_processing import _prep_data_for_correlation
 
 Logger = logging.getLogger(__name__)
@@ -80,11 +81,18 @@ def cross_chan_correlation(st1, streams, shift_len=0.0, xcorr_func='fftw',
         template_names=list(range(len(streams))), force_stream_epoch=False)
     # Run the correlations
     multichannel_normxcorr = get_stream_xcorr(xcorr_func, concurrency)
+    # Only the maxima are needed, backends that support it (e.g. "fftw")
+    # return these rather than the full correlograms.
+    kwargs.setdefault("output", "max")
     [cccsums, no_chans, _] = multichannel_normxcorr(
         templates=streams, stream=st1, cores=cores, stack=False, **kwargs)
-    # Find maximas, sum and divide by no_chans
-    coherances = cccsums.max(axis=-1).sum(axis=-1) / no_chans
-    positions = cccsums.argmax(axis=-1)
+    if isinstance(cccsums, CorrelationMaxima):
+        cccsums, positions = cccsums.max_cc, cccsums.lag
+    else:
+        positions = cccsums.argmax(axis=-1)
+        cccsums = cccsums.max(axis=-1)
+    # Sum maximas and divide by no_chans
+    coherances = cccsums.sum(axis=-1) / no_chans
     # positions should probably have half the length of the correlogram
     # subtracted, and possibly be converted to seconds?
     _coherances = np.empty(n_streams)
@@ -97,7 +105,7 @@ def cross_chan_correlation(st1, streams, shift_len=0.0, xcorr_func='fftw',
     return _coherances, _positions
 
 
-def distance_matrix(stream_list, shift_len=0.0, cores=1):
+def distance_matrix(stream_list, shift_len=0.0, cores=1, xcorr_func='fftw'):
     """
     Compute distance matrix for waveforms based on cross-correlations.
 
@@ -114,6 +122,11 @@ def distance_matrix(stream_list, shift_len=0.0, cores=1):
     :param shift_len: How many seconds for templates to shift
     :type cores: int
     :param cores: Number of cores to parallel process using, defaults to 1.
+    :type xcorr_func: str, callable
+    :param xcorr_func:
+        The method for performing correlations. Accepts either a string or
+        callable. See :func:`eqcorrscan.utils.correlate.register_array_xcorr`
+        for more details. "time_domain_max" is faster for short shifts.
 
     :returns: distance matrix
     :rtype: :class:`numpy.ndarray`
@@ -132,7 +145,7 @@ def distance_matrix(stream_list, shift_len=0.0, cores=1):
     for i, master in enumerate(stream_list):
         dist_list, _ = cross_chan_correlation(
             st1=master.copy(), streams=stream_list,
-            shift_len=shift_len, xcorr_func='fftw', cores=cores)
+            shift_len=shift_len, xcorr_func=xcorr_func, cores=cores)
         dist_mat[i] = 1 - dist_list
     assert np.allclose(dist_mat, dist_mat.T, atol=0.00001)
     # Force perfect symmetry
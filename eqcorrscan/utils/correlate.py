@@ -21,10 +21,20 @@ than the Numpy routine.
 import contextlib
 import copy
 import ctypes
+import glob
+import json
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from multiprocessing import Pool as ProcessPool, cpu_count
 from multiprocessing.pool import ThreadPool
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # pragma: no cover
+    # Python < 3.8
+    shared_memory = None
 
 import numpy as np
 from future.utils import native_str
@@ -56,6 +66,19 @@ XCOR_ARRAY_METHODS = ('array_xcorr')
 # Gain shift for low-variance stabilization
 MULTIPLIER = 1e8
 
+# Scale used to quantise correlations for output="int16"
+INT16_SCALE = 32767
+
+# Per-channel correlation maxima returned for output="max"
+CorrelationMaxima = namedtuple("CorrelationMaxima", ["max_cc", "lag"])
+
+# Split of cores between outer (channel) and inner (fft) parallelism
+CoreSplit = namedtuple("CoreSplit", ["outer", "inner", "cpus"])
+
+# Inner (fft) threads per channel group above which the "fftw" backend splits
+# channels between groups of threads
+MAX_INNER_THREADS = 16
+
 
 class CorrelationError(Exception):
     """ Error handling for correlation functions. """
@@ -172,6 +195,20 @@ def pool_boy(Pool, traces, **kwargs):
     pool.join()
 
 
+def _cccsum_array(n_templates, n_channels, ccc_length, stack,
+                  accumulate_float64=False):
+    """
+    Allocate the output array for stacked or unstacked correlations.
+
+    Stacked correlations are summed into this array in-place, in float64 if
+    `accumulate_float64`, otherwise float32.
+    """
+    if stack:
+        dtype = np.float64 if accumulate_float64 else np.float32
+        return np.zeros((n_templates, ccc_length), dtype=dtype)
+    return np.zeros((n_templates, n_channels, ccc_length), dtype=np.float32)
+
+
 def _pool_normxcorr(templates, stream, stack, pool, func, *args, **kwargs):
     chans = [[] for _i in range(len(templates))]
     array_dict_tuple = _get_array_dicts(templates, stream, stack=stack)
@@ -181,15 +218,25 @@ def _pool_normxcorr(templates, stream, stack, pool, func, *args, **kwargs):
               for sid in seed_ids)
     # get cc results and used chans into their own lists
     results = [pool.apply_async(func, param) for param in params]
+    cccsums, tr_chans = None, []
     try:
-        xcorrs, tr_chans = zip(*(res.get() for res in results))
+        for chan_no in range(len(results)):
+            tr_cc, tr_chan = results[chan_no].get()
+            # Release each result once it has been summed
+            results[chan_no] = None
+            if cccsums is None:
+                cccsums = _cccsum_array(
+                    len(templates), len(seed_ids), tr_cc.shape[-1], stack,
+                    kwargs.get("accumulate_float64", False))
+            if stack:
+                cccsums += tr_cc
+            else:
+                cccsums[:, chan_no] = tr_cc
+            del tr_cc
+            tr_chans.append(tr_chan)
     except KeyboardInterrupt as e:  # pragma: no cover
         pool.terminate()
         raise e
-    if stack:
-        cccsums = np.sum(xcorrs, axis=0)
-    else:
-        cccsums = np.asarray(xcorrs).swapaxes(0, 1)
     no_chans = np.sum(np.array(tr_chans).astype(np.int), axis=0)
     for seed_id, tr_chan in zip(seed_ids, tr_chans):
         for chan, state in zip(chans, tr_chan):
@@ -205,40 +252,214 @@ def _general_multithread(func):
     def multithread(templates, stream, stack=True, *args, **kwargs):
         with pool_boy(ThreadPool, len(stream), **kwargs) as pool:
             return _pool_normxcorr(
-                templates, stream, stack=stack, pool=pool, func=func)
+                templates, stream, stack=stack, pool=pool, func=func,
+                **kwargs)
 
     return multithread
 
 
 def _general_multiprocess(func):
     def multiproc(templates, stream, stack=True, *args, **kwargs):
+        if shared_memory is not None and \
+                len({tr.stats.npts for tr in stream}) == 1:
+            n_cores = kwargs.get('cores', cpu_count()) or cpu_count()
+            processes = min(n_cores, len(templates[0]))
+            pool = _get_shared_pool(processes)
+            return _shared_memory_normxcorr(
+                templates, stream, stack=stack, pool=pool, func=func,
+                processes=processes, **kwargs)
         with pool_boy(ProcessPool, len(stream), **kwargs) as pool:
             return _pool_normxcorr(
-                templates, stream, stack=stack, pool=pool, func=func)
+                templates, stream, stack=stack, pool=pool, func=func,
+                **kwargs)
 
     return multiproc
 
 
+# ---------------------- shared-memory process pools
+
+_SHARED_POOLS = {}  # Persistent process pools keyed by number of processes
+
+
+def _get_shared_pool(processes):
+    """ Get (or start) a persistent process pool with `processes` workers """
+    pool = _SHARED_POOLS.get(processes)
+    if pool is None:
+        # Workers must share the parent's resource tracker, otherwise each
+        # worker tracks (and warns about) the blocks it attaches to.
+        resource_tracker.ensure_running()
+        pool = ProcessPool(processes)
+        _SHARED_POOLS[processes] = pool
+    return pool
+
+
+def close_shared_pools():
+    """
+    Close the persistent process pools used for "multiprocess" correlations.
+
+    Process pools are kept between calls so that workers are not restarted
+    for every chunk of data. Pools are also closed when Python exits.
+    """
+    while _SHARED_POOLS:
+        _, pool = _SHARED_POOLS.popitem()
+        pool.close()
+        pool.join()
+
+
+def _shared_array(shape, dtype=np.float32):
+    """ Allocate a zeroed array in a new shared memory block """
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array[:] = 0
+    return block, array
+
+
+def _release_shared(block, unlink=False):
+    try:
+        block.close()
+    except BufferError:  # pragma: no cover
+        # Arrays still reference the block, it is closed when they are freed
+        pass
+    if unlink:
+        block.unlink()
+
+
+def _shared_memory_worker(func, indexes, slot, blocks, pads, stack):
+    """
+    Correlate channels of data held in shared memory.
+
+    :param func: Array correlation function
+    :param indexes: Channel indexes to correlate
+    :param slot:
+        Index of the partial sum (in the output) that stacked correlations
+        for these channels are added to.
+    :param blocks:
+        (name, shape, dtype) of the stream, template and output
+        shared-memory blocks
+    :param pads: Pads for each channel
+    :param stack:
+        Whether to add correlations to the partial sum, or write them to
+        the output at the channel index.
+    """
+    shared = [shared_memory.SharedMemory(name=name) for name, _, _ in blocks]
+    tr_chans = []
+    try:
+        stream, templates, ccc = (
+            np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            for block, (_, shape, dtype) in zip(shared, blocks))
+        for index, pad in zip(indexes, pads):
+            tr_cc, _tr_chans = func(templates[index], stream[index], pad)
+            if stack:
+                ccc[slot] += tr_cc
+            else:
+                ccc[index] = tr_cc
+            del tr_cc
+            tr_chans.append(_tr_chans)
+        del stream, templates, ccc
+    finally:
+        for block in shared:
+            _release_shared(block)
+    return tr_chans
+
+
+def _shared_memory_normxcorr(templates, stream, stack, pool, func,
+                             processes=1, **kwargs):
+    """
+    Correlate channels in a process pool, passing data through shared memory.
+
+    The stream, templates and correlations are held in shared memory blocks
+    and workers are only sent the names of the blocks and the channel
+    indexes, rather than pickling the arrays for every channel. Channels are
+    split between `processes` tasks: when stacking each task adds its
+    correlations to its own partial sum, so memory scales with the number
+    of processes rather than the number of channels.
+    """
+    chans = [[] for _i in range(len(templates))]
+    n_chans = len(templates[0])
+    npts = stream[0].stats.npts
+    template_len = len(templates[0][0])
+    ccc_len = npts - template_len + 1
+    n_tasks = max(min(processes, n_chans), 1)
+    shared = []
+    try:
+        stream_block, stream_buffer = _shared_array((n_chans, npts))
+        shared.append(stream_block)
+        array_dict_tuple = _get_array_dicts(
+            templates, stream, stack=stack, stream_buffer=stream_buffer)
+        stream_dict, template_dict, pad_dict, seed_ids = array_dict_tuple
+        template_block, template_array = _shared_array(
+            (n_chans, len(templates), template_len))
+        shared.append(template_block)
+        for i, seed_id in enumerate(seed_ids):
+            template_array[i] = template_dict[seed_id]
+        if stack:
+            ccc_block, ccc = _shared_array(
+                (n_tasks, len(templates), ccc_len),
+                dtype=np.float64 if kwargs.get(
+                    "accumulate_float64", False) else np.float32)
+        else:
+            ccc_block, ccc = _shared_array((n_chans, len(templates), ccc_len))
+        shared.append(ccc_block)
+        blocks = [(block.name, array.shape, array.dtype.str)
+                  for block, array in zip(
+                      shared, (stream_buffer, template_array, ccc))]
+        task_indexes = [list(range(slot, n_chans, n_tasks))
+                        for slot in range(n_tasks)]
+        results = [
+            pool.apply_async(
+                _shared_memory_worker,
+                (func, indexes, slot, blocks,
+                 [pad_dict[seed_ids[i]] for i in indexes], stack))
+            for slot, indexes in enumerate(task_indexes)]
+        try:
+            task_chans = [res.get() for res in results]
+        except KeyboardInterrupt as e:  # pragma: no cover
+            pool.terminate()
+            for key in [k for k, v in _SHARED_POOLS.items() if v is pool]:
+                _SHARED_POOLS.pop(key)
+            raise e
+        tr_chans = [None] * n_chans
+        for indexes, _tr_chans in zip(task_indexes, task_chans):
+            for i, _tr_chan in zip(indexes, _tr_chans):
+                tr_chans[i] = _tr_chan
+        if stack:
+            cccsums = np.sum(ccc, axis=0)
+        else:
+            cccsums = ccc.swapaxes(0, 1).copy()
+        del stream_dict, stream_buffer, template_array, ccc
+    finally:
+        for block in shared:
+            _release_shared(block, unlink=True)
+    no_chans = np.sum(np.array(tr_chans).astype(np.int), axis=0)
+    for seed_id, tr_chan in zip(seed_ids, tr_chans):
+        for chan, state in zip(chans, tr_chan):
+            if state:
+                chan.append((seed_id.split('.')[1],
+                             seed_id.split('.')[-1].split('_')[0]))
+    return cccsums, no_chans, chans
+
+
 def _general_serial(func):
     def stream_xcorr(templates, stream, stack=True, *args, **kwargs):
         no_chans = np.zeros(len(templates))
         chans = [[] for _ in range(len(templates))]
         array_dict_tuple = _get_array_dicts(templates, stream, stack=stack)
         stream_dict, template_dict, pad_dict, seed_ids = array_dict_tuple
-        if stack:
-            cccsums = np.zeros([len(templates),
-                                len(stream[0]) - len(templates[0][0]) + 1])
-        else:
-            cccsums = np.zeros([len(templates), len(seed_ids),
-                                len(stream[0]) - len(templates[0][0]) + 1])
+        cccsums = _cccsum_array(
+            len(templates), len(seed_ids),
+            len(stream[0]) - len(templates[0][0]) + 1, stack,
+            kwargs.get("accumulate_float64", False))
         for chan_no, seed_id in enumerate(seed_ids):
             tr_cc, tr_chans = func(template_dict[seed_id],
                                    stream_dict[seed_id],
                                    pad_dict[seed_id])
             if stack:
-                cccsums = np.sum([cccsums, tr_cc], axis=0)
+                cccsums += tr_cc
             else:
                 cccsums[:, chan_no] = tr_cc
+            # Free this channel before correlating the next
+            del tr_cc
             no_chans += tr_chans.astype(np.int)
             for chan, state in zip(chans, tr_chans):
                 if state:
@@ -427,12 +648,224 @@ def _centered(arr, newshape):
     return arr[tuple(myslice)]
 
 
+# Maximum size in bytes of the spectral products in the "numpy_batched"
+# backend, templates are correlated in batches to stay below this
+NUMPY_BATCH_BYTES = 2 ** 28
+
+
+def _numpy_batched_normxcorr(templates, stream, pads, stack=True,
+                             fft_len=None):
+    """
+    Correlate all channels at once using numpy ffts.
+
+    :type templates: np.ndarray
+    :param templates: Templates (n_templates, n_channels, template_len)
+    :type stream: np.ndarray
+    :param stream: Continuous data (n_channels, npts)
+    :type pads: np.ndarray
+    :param pads: Pad for each template and channel (n_templates, n_channels)
+    :type stack: bool
+    :param stack: Whether to sum the correlations over channels
+    :type fft_len: int
+    :param fft_len: Length of segments of data to transform.
+
+    :return:
+        Correlations (n_templates, ccc_length) if stacked, otherwise
+        (n_templates, n_channels, ccc_length) and used channels
+        (n_templates, n_channels).
+
+    .. Note::
+        The data are split into overlapping segments of `fft_len` and the
+        segments of all channels are transformed in one call (as are the
+        templates). Templates are multiplied with the data spectra in batches
+        such that the products take no more than `NUMPY_BATCH_BYTES`, the
+        channels are split into batches too when the products for one
+        template would exceed this. The budget does not cover the data,
+        their spectra and windowed statistics, which scale with the number
+        of channels and the length of the data.
+    """
+    n_templates, n_channels, template_len = templates.shape
+    npts = stream.shape[-1]
+    ccc_length = npts - template_len + 1
+    assert ccc_length > 0, "Template must be shorter than stream"
+    used_chans = ~np.isnan(templates).any(axis=-1)
+    if fft_len is None:
+        fft_len = min(max(2 ** 13, next_fast_len(4 * template_len)),
+                      next_fast_len(template_len + npts - 1))
+    if fft_len < template_len:
+        Logger.warning(
+            f"FFT length of {fft_len} is shorter than the template, setting to"
+            f" {next_fast_len(template_len + npts - 1)}")
+        fft_len = next_fast_len(template_len + npts - 1)
+    step = fft_len - template_len + 1
+    n_segments = -(-ccc_length // step)
+
+    # Overlapping segments of all channels
+    stream = stream.astype(np.float64)
+    stream -= stream.mean(axis=-1, keepdims=True)
+    padded = np.zeros((n_channels, (n_segments - 1) * step + fft_len))
+    padded[:, :npts] = stream
+    segments = np.lib.stride_tricks.as_strided(
+        padded, shape=(n_channels, n_segments, fft_len),
+        strides=(padded.strides[0], step * padded.strides[1],
+                 padded.strides[1]), writeable=False)
+
+    # Windowed mean and standard deviation of the data. The `step` windows
+    # starting in each segment lie within that segment, so cumulative sums
+    # are taken per segment, about the segment mean, rather than along the
+    # whole record where the differences of large sums lose precision.
+    anchor = segments.mean(axis=-1, keepdims=True)
+    local = segments - anchor
+    cumsum = np.zeros((n_channels, n_segments, fft_len + 1))
+    np.cumsum(local, axis=-1, out=cumsum[..., 1:])
+    mean = (cumsum[..., template_len:] - cumsum[..., :step]) / template_len
+    np.cumsum(local ** 2, axis=-1, out=cumsum[..., 1:])
+    var = (cumsum[..., template_len:] - cumsum[..., :step]) / \
+        template_len - mean ** 2
+    mean += anchor
+    mean = mean.reshape(n_channels, -1)[:, :ccc_length]
+    var = var.reshape(n_channels, -1)[:, :ccc_length]
+    del local, cumsum
+    # Flat windows (e.g. zero-filled gaps) have no changes in value
+    changes = np.zeros((n_channels, npts + 1))
+    np.cumsum(np.diff(stream, axis=-1) != 0, axis=-1, out=changes[:, 2:])
+    changes = changes[:, template_len:] - changes[:, 1:-template_len + 1]
+    inv_std = np.zeros_like(var)
+    normal = (var > 0) & (changes > 0)
+    inv_std[normal] = 1.0 / np.sqrt(var[normal])
+    del changes, var
+
+    # Spectra of the segments
+    stream_fft = np.fft.rfft(segments, axis=-1)
+    del padded, segments
+
+    # Normalised and flipped templates
+    norm = ((templates - templates.mean(axis=-1, keepdims=True)) / (
+        templates.std(axis=-1, keepdims=True) * template_len))
+    norm[~np.isfinite(norm)] = 0.0
+    norm_sum = norm.sum(axis=-1)
+    template_fft = np.fft.rfft(norm[..., ::-1], fft_len, axis=-1)
+
+    if stack:
+        cccs = np.zeros((n_templates, ccc_length), dtype=np.float32)
+    else:
+        cccs = np.zeros((n_templates, n_channels, ccc_length),
+                        dtype=np.float32)
+    # Bytes of the product and its inverse for one template and channel
+    channel_bytes = (stream_fft[0].nbytes + n_segments * fft_len * 8)
+    channel_batch = min(max(int(NUMPY_BATCH_BYTES // channel_bytes), 1),
+                        n_channels)
+    batch_size = max(int(
+        NUMPY_BATCH_BYTES // (channel_batch * channel_bytes)), 1)
+    for start in range(0, n_templates, batch_size):
+        batch = slice(start, min(start + batch_size, n_templates))
+        if stack:
+            stacked = np.zeros((batch.stop - batch.start, ccc_length))
+        for chan_start in range(0, n_channels, channel_batch):
+            chans = slice(chan_start,
+                          min(chan_start + channel_batch, n_channels))
+            res = np.fft.irfft(
+                template_fft[batch, chans, np.newaxis] *
+                stream_fft[np.newaxis, chans],
+                fft_len, axis=-1)[..., template_len - 1:]
+            res = res.reshape(res.shape[0], res.shape[1], -1)[
+                ..., :ccc_length]
+            res = (res - norm_sum[batch, chans, np.newaxis] * mean[chans]
+                   ) * inv_std[chans]
+            batch_pads = pads[batch, chans]
+            for i, j in zip(*np.nonzero(batch_pads)):
+                pad = batch_pads[i, j]
+                res[i, j, :-pad] = res[i, j, pad:]
+                res[i, j, -pad:] = 0.0
+            if stack:
+                stacked += res.sum(axis=1)
+            else:
+                cccs[batch, chans] = res
+        if stack:
+            cccs[batch] = stacked
+    return cccs, used_chans
+
+
+@register_array_xcorr('numpy_batched')
+def numpy_batched_normxcorr(templates, stream, pads, *args, **kwargs):
+    """
+    Compute the normalized cross-correlation using batched numpy ffts.
+
+    Pure numpy implementation that does not need the compiled libutils. Used
+    through the stream interface all channels are correlated together.
+
+    :param templates: 2D Array of templates
+    :type templates: np.ndarray
+    :param stream: 1D array of continuous data
+    :type stream: np.ndarray
+    :param pads: List of ints of pad lengths in the same order as templates
+    :type pads: list
+
+    :return: np.ndarray of cross-correlations
+    :return: np.ndarray channels used
+    """
+    ccc, used_chans = _numpy_batched_normxcorr(
+        templates[:, np.newaxis], stream[np.newaxis],
+        np.asarray(pads)[:, np.newaxis], stack=False,
+        fft_len=kwargs.get("fft_len"))
+    return ccc[:, 0], used_chans[:, 0]
+
+
+@numpy_batched_normxcorr.register('stream_xcorr')
+@numpy_batched_normxcorr.register('multithread')
+@numpy_batched_normxcorr.register('multiprocess')
+@numpy_batched_normxcorr.register('concurrent')
+def _numpy_batched_stream_xcorr(templates, stream, stack=True, *args,
+                                **kwargs):
+    """
+    Correlate all channels of a stream at once with batched numpy ffts.
+
+    :type templates: list
+    :param templates:
+        A list of templates, where each one should be an obspy.Stream object
+        containing multiple traces of seismic data and the relevant header
+        information.
+    :type stream: obspy.core.stream.Stream
+    :param stream:
+        A single Stream object to be correlated with the templates.
+
+    :returns:
+        New list of :class:`numpy.ndarray` objects.  These will contain
+        the correlation sums for each template for this day of data.
+    :rtype: list
+    :returns:
+        list of ints as number of channels used for each cross-correlation.
+    :rtype: list
+    :returns:
+        list of list of tuples of station, channel for all cross-correlations.
+    :rtype: list
+    """
+    chans = [[] for _i in range(len(templates))]
+    array_dict_tuple = _get_array_dicts(templates, stream, stack=stack)
+    stream_dict, template_dict, pad_dict, seed_ids = array_dict_tuple
+    cccsums, used_chans = _numpy_batched_normxcorr(
+        templates=np.stack([template_dict[x] for x in seed_ids], axis=1),
+        stream=np.array([stream_dict[x] for x in seed_ids]),
+        pads=np.array([pad_dict[x] for x in seed_ids]).T, stack=stack,
+        fft_len=kwargs.get("fft_len"))
+    no_chans = used_chans.sum(axis=1)
+    for seed_id, tr_chan in zip(seed_ids, used_chans.T):
+        for chan, state in zip(chans, tr_chan):
+            if state:
+                chan.append((seed_id.split('.')[1],
+                             seed_id.split('.')[-1].split('_')[0]))
+    return cccsums, no_chans, chans
+
+
 @register_array_xcorr('time_domain')
 def time_multi_normxcorr(templates, stream, pads, threaded=False, *args,
                          **kwargs):
     """
     Compute cross-correlations in the time-domain using C routine.
 
+    Windows of the stream are normalised using a running mean and variance,
+    and several templates are correlated in each pass through the data.
+
     :param templates: 2D Array of templates
     :type templates: np.ndarray
     :param stream: 1D array of continuous data
@@ -449,47 +882,47 @@ def time_multi_normxcorr(templates, stream, pads, threaded=False, *args,
 
     utilslib = _load_cdll('libutils')
 
-    argtypes = [
-        np.ctypeslib.ndpointer(dtype=np.float32, ndim=1,
+    utilslib.multi_normxcorr_time_blocked.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32,
                                flags=native_str('C_CONTIGUOUS')),
-        ctypes.c_int, ctypes.c_int,
+        ctypes.c_long, ctypes.c_long,
         np.ctypeslib.ndpointer(dtype=np.float32, ndim=1,
                                flags=native_str('C_CONTIGUOUS')),
-        ctypes.c_int,
-        np.ctypeslib.ndpointer(dtype=np.float32, ndim=1,
-                               flags=native_str('C_CONTIGUOUS'))]
-    restype = ctypes.c_int
-    if threaded:
-        func = utilslib.multi_normxcorr_time_threaded
-        argtypes.append(ctypes.c_int)
-    else:
-        func = utilslib.multi_normxcorr_time
-    func.argtypes = argtypes
-    func.restype = restype
+        ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_int]
+    utilslib.multi_normxcorr_time_blocked.restype = ctypes.c_int
     # Need to de-mean everything
     templates_means = templates.mean(axis=1).astype(np.float32)[:, np.newaxis]
     stream_mean = stream.mean().astype(np.float32)
     templates = templates.astype(np.float32) - templates_means
     stream = stream.astype(np.float32) - stream_mean
+    # Check that stream is non-zero and above variance threshold
+    if not np.all(stream == 0) and np.var(stream) < 1e-8:
+        # Apply gain, stream is a copy so no need to remove it afterwards
+        stream *= MULTIPLIER
+        Logger.warning("Low variance found for, applying gain "
+                       "to stabilise correlations")
     template_len = templates.shape[1]
     n_templates = templates.shape[0]
     image_len = stream.shape[0]
     ccc_length = image_len - template_len + 1
     assert ccc_length > 0, "Template must be shorter than stream"
-    ccc = np.ascontiguousarray(
-        np.empty(ccc_length * n_templates), np.float32)
-    t_array = np.ascontiguousarray(templates.flatten(), np.float32)
-    time_args = [t_array, template_len, n_templates,
-                 np.ascontiguousarray(stream, np.float32), image_len, ccc]
-    if threaded:
-        time_args.append(kwargs.get('cores', cpu_count()))
-    func(*time_args)
-    ccc[np.isnan(ccc)] = 0.0
-    ccc = ccc.reshape((n_templates, image_len - template_len + 1))
+    ccc = np.zeros((n_templates, ccc_length), np.float32)
+    ret = utilslib.multi_normxcorr_time_blocked(
+        np.ascontiguousarray(np.nan_to_num(templates), np.float32),
+        template_len, n_templates, np.ascontiguousarray(stream, np.float32),
+        image_len, ccc, kwargs.get('cores', cpu_count()) if threaded else 1)
+    if ret < 0:
+        raise MemoryError("Memory allocation failed in correlation C-code")
+    elif ret > 0:
+        Logger.critical(
+            'Out-of-range correlation in C-code, see WARNING from C-code.'
+            'You are STRONGLY RECOMMENDED to check your data for spikes, '
+            'clipping or non-physical artifacts')
     for i in range(len(pads)):
         ccc[i] = np.append(ccc[i], np.zeros(pads[i]))[pads[i]:]
-    templates += templates_means
-    stream += stream_mean
     return ccc, used_chans
 
 
@@ -559,10 +992,8 @@ def fftw_normxcorr(templates, stream, pads, threaded=False, *args, **kwargs):
     n_templates = templates.shape[0]
     fftshape = kwargs.get("fft_len")
     if fftshape is None:
-        # In testing, 2**13 consistently comes out fastest - setting to
-        # default. https://github.com/eqcorrscan/EQcorrscan/pull/285
-        fftshape = min(
-            2 ** 13, next_fast_len(template_length + stream_length - 1))
+        fftshape = _default_fft_len(
+            template_length, stream_length, n_templates, 1, 1)
     if fftshape < template_length:
         Logger.warning(
             "FFT length of {0} is shorter than the template, setting to "
@@ -655,18 +1086,19 @@ def _time_threaded_normxcorr(templates, stream, stack=True, *args, **kwargs):
     ccc_length = max(
         len(stream[0]) - len(templates[0][0]) + 1,
         len(templates[0][0]) - len(stream[0]) + 1)
-    if stack:
-        cccsums = np.zeros([len(templates), ccc_length])
-    else:
-        cccsums = np.zeros([len(templates), len(seed_ids), ccc_length])
+    cccsums = _cccsum_array(
+        len(templates), len(seed_ids), ccc_length, stack,
+        kwargs.get("accumulate_float64", False))
     for chan_no, seed_id in enumerate(seed_ids):
         tr_cc, tr_chans = time_multi_normxcorr(
             template_dict[seed_id], stream_dict[seed_id], pad_dict[seed_id],
             True)
         if stack:
-            cccsums = np.sum([cccsums, tr_cc], axis=0)
+            cccsums += tr_cc
         else:
             cccsums[:, chan_no] = tr_cc
+        # Free this channel before correlating the next
+        del tr_cc
         no_chans += tr_chans.astype(np.int)
         for chan, state in zip(chans, tr_chans):
             if state:
@@ -675,6 +1107,316 @@ def _time_threaded_normxcorr(templates, stream, stack=True, *args, **kwargs):
     return cccsums, no_chans, chans
 
 
+@register_array_xcorr('time_domain_max')
+def time_max_normxcorr(templates, stream, pads, lag_windows=None, cores=1,
+                       *args, **kwargs):
+    """
+    Compute the maximum cross-correlation and its lag in the time-domain.
+
+    Only the lags within `lag_windows` are computed, and only the maximum
+    correlation and its index are kept, which is much faster than computing
+    the full correlogram when the number of lags is small (e.g. when
+    computing correlations with a short allowed shift).
+
+    :param templates: 2D Array of templates
+    :type templates: np.ndarray
+    :param stream: 1D array of continuous data
+    :type stream: np.ndarray
+    :param pads: List of ints of pad lengths in the same order as templates
+    :type pads: list
+    :param lag_windows:
+        List of (start, stop) sample-indexes of the correlations to find the
+        maximum within. Defaults to all correlations.
+    :type lag_windows: list
+    :param cores: Number of threads to use.
+    :type cores: int
+
+    :return:
+        :class:`CorrelationMaxima` of the maximum correlation and its index
+        (n_templates, ) or, if `lag_windows` is given,
+        (n_templates, n_windows), with the index relative to the start of
+        the window.
+    :return: np.ndarray channels used
+
+    .. Note::
+        Only zero pads are supported: the maxima are not meaningful for
+        stacking.
+    """
+    if np.any(np.asarray(pads) != 0):
+        raise NotImplementedError("Non-zero pads are not supported")
+    used_chans = ~np.isnan(templates).any(axis=1)
+    utilslib = _load_cdll('libutils')
+    utilslib.multi_normxcorr_time_max.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long, ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=ctypes.c_long,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=ctypes.c_long,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=ctypes.c_long,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_int]
+    utilslib.multi_normxcorr_time_max.restype = ctypes.c_int
+    n_templates, template_len = templates.shape
+    image_len = stream.shape[0]
+    ccc_length = image_len - template_len + 1
+    assert ccc_length > 0, "Template must be shorter than stream"
+    if lag_windows is None:
+        windows = np.array([[0, ccc_length]])
+    else:
+        windows = np.asarray(lag_windows, dtype=ctypes.c_long)
+    window_starts = np.ascontiguousarray(windows[:, 0], dtype=ctypes.c_long)
+    window_lens = np.ascontiguousarray(
+        windows[:, 1] - windows[:, 0], dtype=ctypes.c_long)
+    # Need to de-mean everything, the data are normalised in C but a large
+    # offset would lose precision in the float32 products.
+    templates = np.nan_to_num(templates.astype(np.float32))
+    templates = np.ascontiguousarray(
+        templates - templates.mean(axis=1, keepdims=True), dtype=np.float32)
+    stream = np.ascontiguousarray(stream - stream.mean(), dtype=np.float32)
+    # Check that stream is non-zero and above variance threshold
+    if not np.all(stream == 0) and np.var(stream) < 1e-8:
+        # Apply gain, stream is a copy so no need to remove it afterwards
+        stream *= MULTIPLIER
+        Logger.warning("Low variance found for, applying gain "
+                       "to stabilise correlations")
+    max_cc = np.zeros((n_templates, len(windows)), dtype=np.float32)
+    lag = np.zeros((n_templates, len(windows)), dtype=ctypes.c_long)
+    ret = utilslib.multi_normxcorr_time_max(
+        templates, template_len, n_templates, stream, image_len,
+        window_starts, window_lens, len(windows),
+        np.ascontiguousarray(used_chans, dtype=np.intc), max_cc, lag, cores)
+    if ret < 0:
+        raise ValueError("lag_windows must be within the {0} correlations, "
+                         "or memory allocation failed".format(ccc_length))
+    elif ret > 0:
+        Logger.critical(
+            'Out-of-range correlation in C-code, see WARNING from C-code.'
+            'You are STRONGLY RECOMMENDED to check your data for spikes, '
+            'clipping or non-physical artifacts')
+    if lag_windows is None:
+        max_cc, lag = max_cc[:, 0], lag[:, 0]
+    return CorrelationMaxima(max_cc=max_cc, lag=lag), used_chans
+
+
+@time_max_normxcorr.register('stream_xcorr')
+@time_max_normxcorr.register('multithread')
+@time_max_normxcorr.register('multiprocess')
+@time_max_normxcorr.register('concurrent')
+def _time_max_stream_xcorr(templates, stream, stack=True, *args, **kwargs):
+    """
+    Compute the maximum correlation and its lag for each template and channel.
+
+    Only `stack=False` is supported. Accepts the `lag_windows` and `cores`
+    arguments of :func:`time_max_normxcorr`.
+
+    :type templates: list
+    :param templates:
+        A list of templates, where each one should be an obspy.Stream object
+        containing multiple traces of seismic data and the relevant header
+        information.
+    :type stream: obspy.core.stream.Stream
+    :param stream:
+        A single Stream object to be correlated with the templates.
+
+    :returns:
+        :class:`CorrelationMaxima` of arrays (n_templates, n_channels) or
+        (n_templates, n_channels, n_windows) if `lag_windows` is given.
+    :rtype: :class:`CorrelationMaxima`
+    :returns:
+        list of ints as number of channels used for each cross-correlation.
+    :rtype: list
+    :returns:
+        list of list of tuples of station, channel for all cross-correlations.
+    :rtype: list
+    """
+    if stack:
+        raise NotImplementedError(
+            "time_domain_max only supports stack=False")
+    output = kwargs.pop("output", "max")
+    if output != "max":
+        raise NotImplementedError(
+            "time_domain_max only supports output='max'")
+    lag_windows = kwargs.get("lag_windows")
+    cores = kwargs.get("cores") or 1
+    no_chans = np.zeros(len(templates), dtype=int)
+    chans = [[] for _ in range(len(templates))]
+    array_dict_tuple = _get_array_dicts(templates, stream, stack=stack)
+    stream_dict, template_dict, pad_dict, seed_ids = array_dict_tuple
+    shape = (len(templates), len(seed_ids))
+    if lag_windows is not None:
+        shape += (len(lag_windows), )
+    cccs = CorrelationMaxima(max_cc=np.zeros(shape, dtype=np.float32),
+                             lag=np.zeros(shape, dtype=ctypes.c_long))
+    for chan_no, seed_id in enumerate(seed_ids):
+        tr_cc, tr_chans = time_max_normxcorr(
+            template_dict[seed_id], stream_dict[seed_id], pad_dict[seed_id],
+            lag_windows=lag_windows, cores=cores)
+        cccs.max_cc[:, chan_no] = tr_cc.max_cc
+        cccs.lag[:, chan_no] = tr_cc.lag
+        no_chans += tr_chans.astype(np.int)
+        for chan, state in zip(chans, tr_chans):
+            if state:
+                chan.append((seed_id.split('.')[1],
+                             seed_id.split('.')[-1].split('_')[0]))
+    return cccs, no_chans, chans
+
+
+# ---------------------- core scheduling
+
+
+def _parse_cpulist(cpulist):
+    """ Parse a linux cpulist string (e.g. "0-3,8,10-11") to a set of ints """
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def get_numa_nodes():
+    """
+    Get the CPUs available to this process on each NUMA node.
+
+    Read from `/sys/devices/system/node` on Linux, all available CPUs are
+    returned as a single node on other systems.
+
+    :rtype: list
+    :return: List of sorted lists of CPU ids, one per NUMA node.
+    """
+    try:
+        available = os.sched_getaffinity(0)
+    except AttributeError:  # pragma: no cover
+        # Not available on OSX or Windows
+        return [list(range(cpu_count()))]
+    node_paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    nodes = []
+    for path in sorted(node_paths, key=lambda p: int(
+            os.path.basename(os.path.dirname(p))[4:])):
+        with open(path, "r") as f:
+            cpus = _parse_cpulist(f.read()) & available
+        if len(cpus):
+            nodes.append(sorted(cpus))
+    return nodes or [sorted(available)]
+
+
+def plan_core_split(cores=None, n_channels=None, cores_outer=None,
+                    numa_nodes=None):
+    """
+    Split cores between outer (channel) and inner (fft) parallelism.
+
+    When `cores_outer` is not given channels are split into enough groups
+    that no group uses more than `MAX_INNER_THREADS` inner threads, and
+    into at least one group per NUMA node spanned by `cores`. When the cores
+    span more than one NUMA node each group is given the CPUs of one node
+    to pin its threads to.
+
+    :type cores: int
+    :param cores:
+        Total number of cores to use if `cores_outer` is not given, otherwise
+        the number of inner threads per outer group. Defaults to
+        `OMP_NUM_THREADS` if set, otherwise all available cores.
+    :type n_channels: int
+    :param n_channels:
+        Number of channels to correlate - there are never more outer groups
+        than channels.
+    :type cores_outer: int
+    :param cores_outer: Number of outer groups of threads.
+    :type numa_nodes: list
+    :param numa_nodes:
+        List of lists of CPUs on each NUMA node, defaults to
+        :func:`get_numa_nodes`.
+
+    :rtype: :class:`CoreSplit`
+    :return:
+        Number of outer groups, number of inner threads per group and the
+        CPUs to pin each group to (None if threads are not pinned).
+    """
+    if cores is None:
+        cores = int(os.getenv("OMP_NUM_THREADS", cpu_count()))
+    numa_nodes = numa_nodes or get_numa_nodes()
+    if cores_outer is not None:
+        outer, inner = cores_outer, cores
+        cores = outer * inner
+    else:
+        outer = -(-cores // MAX_INNER_THREADS)
+    # Fill NUMA nodes in order
+    n_nodes, node_cores = 0, 0
+    while node_cores < cores and n_nodes < len(numa_nodes):
+        node_cores += len(numa_nodes[n_nodes])
+        n_nodes += 1
+    n_nodes = max(n_nodes, 1)
+    if cores_outer is None:
+        # At least one group per node, and the same number on each node
+        outer = -(-max(outer, n_nodes) // n_nodes) * n_nodes
+    if n_channels is not None:
+        outer = max(min(outer, n_channels), 1)
+    if cores_outer is None:
+        inner = max(cores // outer, 1)
+    cpus = None
+    if n_nodes > 1 and outer >= n_nodes and hasattr(os, "sched_setaffinity"):
+        cpus = [numa_nodes[i % n_nodes] for i in range(outer)]
+    Logger.info(
+        "Using {0} outer x {1} inner threads across {2} NUMA node(s){3}"
+        .format(outer, inner, n_nodes, ", pinned" if cpus else ""))
+    return CoreSplit(outer, inner, cpus)
+
+
+def _outer_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
+                           core_split, stack=True, *args, **kwargs):
+    """
+    Correlate groups of channels concurrently with fftw_multi_normxcorr.
+
+    Channels are split into `core_split.outer` contiguous groups which are
+    correlated in separate threads (the C-code releases the GIL), each using
+    `core_split.inner` threads and pinned to `core_split.cpus` if given.
+    """
+    bounds = np.linspace(
+        0, len(seed_ids), core_split.outer + 1).round().astype(int)
+    groups = [seed_ids[start:end]
+              for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def _correlate_group(group_index):
+        if core_split.cpus is not None:
+            # Threads started by this thread (e.g. OpenMP) inherit this
+            os.sched_setaffinity(0, core_split.cpus[group_index])
+        group = groups[group_index]
+        return fftw_multi_normxcorr(
+            template_array={x: template_array[x] for x in group},
+            stream_array={x: stream_array[x] for x in group},
+            pad_array={x: pad_array[x] for x in group}, seed_ids=group,
+            cores_inner=core_split.inner, stack=stack, *args, **kwargs)
+
+    with pool_boy(ThreadPool, len(groups), cores=len(groups)) as pool:
+        results = pool.map(_correlate_group, range(len(groups)))
+    cccs, used_chans = zip(*results)
+    used_chans = [chan for group in used_chans for chan in group]
+    if isinstance(cccs[0], CorrelationMaxima):
+        return CorrelationMaxima(
+            *(np.concatenate(arrays, axis=1) for arrays in zip(*cccs))), \
+            used_chans
+    if stack:
+        cccsums = cccs[0]
+        for ccc in cccs[1:]:
+            cccsums += ccc
+        return cccsums, used_chans
+    return np.concatenate(cccs, axis=1), used_chans
+
+
 @fftw_normxcorr.register('stream_xcorr')
 @fftw_normxcorr.register('multithread')
 @fftw_normxcorr.register('concurrent')
@@ -703,22 +1445,29 @@ def _fftw_stream_xcorr(templates, stream, stack=True, *args, **kwargs):
     :rtype: list
     """
     # number of threads:
-    #   default to using inner threads
-    #   if `cores` or `cores_outer` passed in then use that
-    #   else if OMP_NUM_THREADS set use that
-    #   otherwise use all available
-    num_cores_inner = kwargs.pop('cores', None)
-    if num_cores_inner is None:
-        num_cores_inner = int(os.getenv("OMP_NUM_THREADS", cpu_count()))
-
+    #   if `cores_outer` passed in then use that many groups of channels, with
+    #   `cores` inner threads each
+    #   else split `cores` (or OMP_NUM_THREADS if set, otherwise all
+    #   available) between groups of channels, see plan_core_split
     chans = [[] for _i in range(len(templates))]
-    array_dict_tuple = _get_array_dicts(templates, stream, stack=stack)
+    array_dict_tuple = _get_array_dicts(
+        templates, stream, stack=stack,
+        stream_buffer=kwargs.pop('stream_buffer', None))
     stream_dict, template_dict, pad_dict, seed_ids = array_dict_tuple
     assert set(seed_ids)
-    cccsums, tr_chans = fftw_multi_normxcorr(
-        template_array=template_dict, stream_array=stream_dict,
-        pad_array=pad_dict, seed_ids=seed_ids, cores_inner=num_cores_inner,
-        stack=stack, *args, **kwargs)
+    core_split = plan_core_split(
+        cores=kwargs.pop('cores', None), n_channels=len(seed_ids),
+        cores_outer=kwargs.pop('cores_outer', None))
+    if core_split.outer > 1:
+        cccsums, tr_chans = _outer_multi_normxcorr(
+            template_array=template_dict, stream_array=stream_dict,
+            pad_array=pad_dict, seed_ids=seed_ids, core_split=core_split,
+            stack=stack, *args, **kwargs)
+    else:
+        cccsums, tr_chans = fftw_multi_normxcorr(
+            template_array=template_dict, stream_array=stream_dict,
+            pad_array=pad_dict, seed_ids=seed_ids,
+            cores_inner=core_split.inner, stack=stack, *args, **kwargs)
     no_chans = np.sum(np.array(tr_chans).astype(np.int), axis=0)
     for seed_id, tr_chan in zip(seed_ids, tr_chans):
         for chan, state in zip(chans, tr_chan):
@@ -744,7 +1493,30 @@ def fftw_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
 
     rtype: np.ndarray, list
     :return: 3D Array of cross-correlations and list of used channels.
+
+    .. Note::
+        Pass a :class:`TemplateSpectra` as the `template_spectra` keyword
+        argument to re-use the template ffts between calls with the same
+        templates.
+
+    .. Note::
+        With `stack=False` the full (n_templates, n_channels, ccc_length)
+        float32 output can be very large. Pass `output="int16"` to get
+        correlations quantised to int16 (scaled by `INT16_SCALE`), or
+        `output="max"` to get a :class:`CorrelationMaxima` of the maximum
+        correlation and its index (n_templates, n_channels) for each
+        channel. `lag_windows`, a list of (start, stop) sample-index pairs,
+        can be given with `output="max"` to get the maxima within each
+        window (n_templates, n_channels, n_windows) with the index relative
+        to the start of each window. Channels are correlated one at a time
+        so that only one channel of float32 correlations is held in memory.
     """
+    output = kwargs.pop("output", "full")
+    if output != "full":
+        return _reduced_multi_normxcorr(
+            template_array=template_array, stream_array=stream_array,
+            pad_array=pad_array, seed_ids=seed_ids, cores_inner=cores_inner,
+            stack=stack, output=output, *args, **kwargs)
     utilslib = _load_cdll('libutils')
 
     utilslib.multi_normxcorr_fftw.argtypes = [
@@ -787,30 +1559,38 @@ def fftw_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
     '''
 
     # pre processing
+    template_spectra = kwargs.get("template_spectra")
     used_chans = []
     template_len = template_array[seed_ids[0]].shape[1]
     for seed_id in seed_ids:
         used_chans.append(~np.isnan(template_array[seed_id]).any(axis=1))
-        template_array[seed_id] = (
-            (template_array[seed_id] -
-             template_array[seed_id].mean(axis=-1, keepdims=True)) / (
-                template_array[seed_id].std(axis=-1, keepdims=True) *
-                template_len))
-        template_array[seed_id] = np.nan_to_num(template_array[seed_id])
     n_channels = len(seed_ids)
     n_templates = template_array[seed_ids[0]].shape[0]
     image_len = stream_array[seed_ids[0]].shape[0]
-    # In testing, 2**13 consistently comes out fastest - setting to
-    # default. https://github.com/eqcorrscan/EQcorrscan/pull/285
-    fft_len = kwargs.get(
-        "fft_len", min(2 ** 13, next_fast_len(template_len + image_len - 1)))
+    fft_len = kwargs.get("fft_len")
+    if fft_len is None:
+        fft_len = _default_fft_len(
+            template_len, image_len, n_templates, n_channels, cores_inner)
     if fft_len < template_len:
         Logger.warning(
             f"FFT length of {fft_len} is shorter than the template, setting to"
             f" {next_fast_len(template_len + image_len - 1)}")
         fft_len = next_fast_len(template_len + image_len - 1)
-    template_array = np.ascontiguousarray(
-        [template_array[x] for x in seed_ids], dtype=np.float32)
+    if template_spectra is None and any(
+            _n_sparse_rows(used.sum(), n_templates) < n_templates
+            for used in used_chans):
+        # Only correlate the templates that use each channel
+        template_spectra = TemplateSpectra()
+    if template_spectra is not None:
+        # Groups of channels may be correlated concurrently
+        with _TEMPLATE_SPECTRA_LOCK:
+            spectra, norm_sums, chan_offsets, template_index = \
+                template_spectra.get(template_array=template_array,
+                                     seed_ids=seed_ids, fft_len=fft_len)
+    else:
+        template_array = np.ascontiguousarray(
+            [_normalise_templates(template_array[x]) for x in seed_ids],
+            dtype=np.float32)
     multipliers = {}
     for x in seed_ids:
         # Check that stream is non-zero and above variance threshold
@@ -822,8 +1602,8 @@ def fftw_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
             multipliers.update({x: MULTIPLIER})
         else:
             multipliers.update({x: 1})
-    stream_array = np.ascontiguousarray([stream_array[x] for x in seed_ids],
-                                        dtype=np.float32)
+    stream_dict = stream_array
+    stream_array = _stack_stream_array(stream_dict, seed_ids)
     ccc_length = image_len - template_len + 1
     assert ccc_length > 0, "Template must be shorter than stream"
     if stack:
@@ -834,16 +1614,31 @@ def fftw_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
     used_chans_np = np.ascontiguousarray(used_chans, dtype=np.intc)
     pad_array_np = np.ascontiguousarray(
         [pad_array[seed_id] for seed_id in seed_ids], dtype=np.intc)
+    if template_spectra is not None:
+        # Used channels and pads for each row of the sparse layout
+        row_chans = np.repeat(np.arange(n_channels), np.diff(chan_offsets))
+        used_rows = np.ascontiguousarray(template_index >= 0, dtype=np.intc)
+        pad_rows = np.ascontiguousarray(
+            pad_array_np[row_chans, np.maximum(template_index, 0)] *
+            used_rows, dtype=np.intc)
     variance_warnings = np.ascontiguousarray(
         np.zeros(n_channels), dtype=np.intc)
     missed_correlations = np.ascontiguousarray(
         np.zeros(n_channels), dtype=np.intc)
 
     # call C function
-    ret = utilslib.multi_normxcorr_fftw(
-        template_array, n_templates, template_len, n_channels, stream_array,
-        image_len, cccs, fft_len, used_chans_np, pad_array_np,
-        cores_inner, variance_warnings, missed_correlations, int(stack))
+    if template_spectra is not None:
+        ret = _multi_normxcorr_fftw_prepared(
+            spectra, norm_sums, chan_offsets, template_index, n_templates,
+            template_len, n_channels, stream_array, image_len, cccs, fft_len,
+            used_rows, pad_rows, cores_inner, variance_warnings,
+            missed_correlations, int(stack))
+    else:
+        ret = utilslib.multi_normxcorr_fftw(
+            template_array, n_templates, template_len, n_channels,
+            stream_array, image_len, cccs, fft_len, used_chans_np,
+            pad_array_np, cores_inner, variance_warnings,
+            missed_correlations, int(stack))
     if ret < 0:
         raise MemoryError("Memory allocation failed in correlation C-code")
     elif ret > 0:
@@ -864,10 +1659,791 @@ def fftw_multi_normxcorr(template_array, stream_array, pad_array, seed_ids,
                 f"Low variance found in {variance_warning} places for "
                 f"{seed_ids[i]}, check result.")
     # Remove gain
-    for i, x in enumerate(seed_ids):
-        stream_array[i] *= multipliers[x]
+    for x in seed_ids:
+        if multipliers[x] != 1:
+            stream_dict[x] /= multipliers[x]
+    return cccs, used_chans
+
+
+def _reduced_multi_normxcorr(template_array, stream_array, pad_array,
+                             seed_ids, cores_inner, stack, output,
+                             lag_windows=None, *args, **kwargs):
+    """
+    Correlate channel-by-channel, keeping only a reduced product.
+
+    See :func:`fftw_multi_normxcorr` for details of the `output` options.
+    """
+    if stack:
+        raise NotImplementedError(
+            "Output {0} is only supported for stack=False".format(output))
+    if output not in ("int16", "max"):
+        raise ValueError("Unknown output: {0}".format(output))
+    if lag_windows is not None and output != "max":
+        raise NotImplementedError("lag_windows requires output='max'")
+    n_channels = len(seed_ids)
+    n_templates = template_array[seed_ids[0]].shape[0]
+    template_len = template_array[seed_ids[0]].shape[1]
+    ccc_length = (stream_array[seed_ids[0]].shape[0] - template_len + 1)
+    if output == "int16":
+        cccs = np.zeros((n_templates, n_channels, ccc_length), dtype=np.int16)
+    else:
+        shape = (n_templates, n_channels)
+        if lag_windows is not None:
+            lag_windows = np.asarray(lag_windows, dtype=int)
+            if lag_windows.min() < 0 or lag_windows.max() > ccc_length:
+                raise ValueError(
+                    "lag_windows must be within the {0} correlations".format(
+                        ccc_length))
+            shape += (len(lag_windows), )
+        cccs = CorrelationMaxima(
+            max_cc=np.zeros(shape, dtype=np.float32),
+            lag=np.zeros(shape, dtype=int))
+    used_chans = []
+    for i, seed_id in enumerate(seed_ids):
+        ccc, used = fftw_multi_normxcorr(
+            template_array={seed_id: template_array[seed_id]},
+            stream_array={seed_id: stream_array[seed_id]},
+            pad_array={seed_id: pad_array[seed_id]}, seed_ids=[seed_id],
+            cores_inner=cores_inner, stack=False, *args, **kwargs)
+        ccc = ccc[:, 0]
+        used_chans.extend(used)
+        if output == "int16":
+            np.round(np.clip(ccc, -1, 1) * INT16_SCALE, out=ccc)
+            cccs[:, i] = ccc
+        elif lag_windows is None:
+            cccs.lag[:, i] = ccc.argmax(axis=-1)
+            cccs.max_cc[:, i] = np.take_along_axis(
+                ccc, cccs.lag[:, i, np.newaxis], axis=-1)[:, 0]
+        else:
+            for j, (start, stop) in enumerate(lag_windows):
+                window = ccc[:, start:stop]
+                cccs.lag[:, i, j] = window.argmax(axis=-1)
+                cccs.max_cc[:, i, j] = np.take_along_axis(
+                    window, cccs.lag[:, i, j, np.newaxis], axis=-1)[:, 0]
     return cccs, used_chans
 
+
+def _stack_stream_array(stream_array, seed_ids):
+    """
+    Stack stream arrays into one C-contiguous float32 array.
+
+    If the arrays are already consecutive rows of one C-contiguous float32
+    array (as made by :func:`_get_array_dicts`) that array is returned
+    without copying.
+
+    :type stream_array: dict
+    :param stream_array: Dictionary of 1D arrays keyed by seed_id
+    :type seed_ids: list
+    :param seed_ids: Seed-ids in the order to be stacked.
+
+    :return: 2D array (n_channels, npts)
+    """
+    rows = [stream_array[seed_id] for seed_id in seed_ids]
+    if (len(rows) == 1 and rows[0].dtype == np.float32 and
+            rows[0].flags.c_contiguous):
+        return rows[0][np.newaxis]
+    base = rows[0].base
+    if (isinstance(base, np.ndarray) and base.dtype == np.float32 and
+            base.flags.c_contiguous and
+            base.shape == (len(rows), rows[0].shape[0])):
+        start = base.__array_interface__['data'][0]
+        if all(row.base is base and row.__array_interface__['data'][0] ==
+               start + i * row.nbytes for i, row in enumerate(rows)):
+            return base
+    return np.ascontiguousarray(rows, dtype=np.float32)
+
+
+def _normalise_templates(templates):
+    """
+    Normalise templates for the frequency-domain correlation routines.
+
+    :type templates: np.ndarray
+    :param templates: 2D array of templates (n_templates, template_len)
+
+    :return: Normalised templates, with nan-channels set to zero.
+    """
+    template_len = templates.shape[1]
+    norm = ((templates - templates.mean(axis=-1, keepdims=True)) / (
+        templates.std(axis=-1, keepdims=True) * template_len))
+    return np.nan_to_num(norm)
+
+
+def _multi_normxcorr_fftw_prepared(*args):
+    """ Call the C-function for correlating with pre-computed spectra. """
+    utilslib = _load_cdll('libutils')
+    utilslib.multi_normxcorr_fftw_prepared.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.complex64,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=ctypes.c_long,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long, ctypes.c_long, ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_int,
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.intc,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_int]
+    utilslib.multi_normxcorr_fftw_prepared.restype = ctypes.c_int
+    return utilslib.multi_normxcorr_fftw_prepared(*args)
+
+
+_TEMPLATE_SPECTRA_LOCK = threading.Lock()
+# Default limit on spectra stored between chunks by Tribe.detect
+TEMPLATE_SPECTRA_MAX_BYTES = 2 * 1024 ** 3
+
+
+class TemplateSpectra(object):
+    """
+    Cache of normalised template spectra for re-use across data chunks.
+
+    The "fftw" backend computes the ffts of the templates for every call,
+    even though the templates do not change between chunks of continuous
+    data. Passing a TemplateSpectra object as the `template_spectra` keyword
+    argument to the "fftw" stream_xcorr functions (or to
+    :meth:`eqcorrscan.core.match_filter.Tribe.detect`) stores the spectra
+    after the first chunk so that only the data need to be transformed for
+    subsequent chunks.
+
+    Spectra are stored for each set of templates, seed-ids and fft-length,
+    in the layout read by the C-code, so that stored spectra are used in
+    place. Templates are checked against a stored copy so that the same
+    object can safely be used for multiple template groups.
+
+    :type max_bytes: int
+    :param max_bytes:
+        Maximum memory (in bytes) to use for stored spectra. When exceeded
+        the least-recently used sets of spectra are discarded. Set to None
+        (default) for no limit.
+
+    .. Note::
+        Spectra take n_templates * (fft_len // 2 + 1) * 8 bytes per channel,
+        e.g. roughly 3.3 MB per channel for 100 templates with the default
+        fft_len of 2 ** 13. Only templates that use a channel (those without
+        NaN data for that channel) are stored, so heterogeneous template sets
+        take much less.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._spectra = OrderedDict()
+        self._next_id = 0
+
+    def __repr__(self):
+        return "TemplateSpectra(nchannels={0}, nbytes={1})".format(
+            len(self), self.nbytes)
+
+    def __len__(self):
+        return sum(len(key[0]) for key, _ in self._spectra.values())
+
+    @property
+    def nbytes(self):
+        """ Memory used by stored spectra in bytes. """
+        return sum(self._entry_nbytes(value)
+                   for _, value in self._spectra.values())
+
+    @staticmethod
+    def _entry_nbytes(value):
+        templates, arrays = value[0], value[1:]
+        return (sum(arr.nbytes for arr in templates) +
+                sum(arr.nbytes for arr in arrays))
+
+    def clear(self):
+        """ Remove all stored spectra. """
+        self._spectra.clear()
+
+    def get(self, template_array, seed_ids, fft_len):
+        """
+        Get the spectra for templates, computing them if needed.
+
+        :type template_array: dict
+        :param template_array:
+            Dictionary of un-normalised template arrays keyed by seed_id.
+        :type seed_ids: list
+        :param seed_ids: Seed-ids to get spectra for, in order.
+        :type fft_len: int
+        :param fft_len: Length of fft to use.
+
+        :return:
+            Array of spectra (n_rows, fft_len // 2 + 1), array of summed
+            normalised templates (n_rows), array of the first row for each
+            channel (n_channels + 1) and array of the template index for
+            each row (n_rows, -1 for padding rows). These are the stored
+            arrays and must not be modified.
+        """
+        n_templates, template_len = template_array[seed_ids[0]].shape
+        key = (tuple(seed_ids), fft_len, n_templates, template_len)
+        for entry_id, (entry_key, value) in self._spectra.items():
+            if entry_key == key and all(
+                    np.array_equal(stored, template_array[seed_id],
+                                   equal_nan=True)
+                    for stored, seed_id in zip(value[0], seed_ids)):
+                self._spectra.move_to_end(entry_id)
+                return value[1:]
+        Logger.debug("Computing spectra for {0} channels".format(
+            len(seed_ids)))
+        rows, indexes = zip(*[
+            _sparse_template_rows(template_array[seed_id])
+            for seed_id in seed_ids])
+        chan_offsets = np.cumsum(
+            [0] + [len(index) for index in indexes], dtype=ctypes.c_long)
+        spectra, norm_sums = _prepare_template_spectra(
+            np.ascontiguousarray(np.concatenate(rows), dtype=np.float32),
+            chan_offsets, fft_len)
+        template_index = np.ascontiguousarray(
+            np.concatenate(indexes), dtype=np.intc)
+        value = (
+            [template_array[seed_id].copy() for seed_id in seed_ids],
+            spectra, norm_sums, chan_offsets, template_index)
+        self._spectra[self._next_id] = (key, value)
+        self._next_id += 1
+        if self.max_bytes is not None:
+            nbytes = self.nbytes
+            while nbytes > self.max_bytes and len(self._spectra):
+                nbytes -= self._entry_nbytes(
+                    self._spectra.popitem(last=False)[1][1])
+        return value[1:]
+
+
+def _n_sparse_rows(n_used, n_templates):
+    """
+    Number of rows to correlate for a channel used by n_used templates.
+
+    Rounded up to a power of two to limit the number of FFTW plans needed.
+    """
+    if n_used == 0:
+        return 0
+    return min(n_templates, 2 ** int(np.ceil(np.log2(n_used))))
+
+
+def _sparse_template_rows(templates):
+    """
+    Get the normalised templates to correlate for one channel.
+
+    :type templates: np.ndarray
+    :param templates:
+        2D array of un-normalised templates (n_templates, template_len),
+        templates that do not use this channel are filled with NaN.
+
+    :return:
+        Normalised templates (n_rows, template_len) and the index of the
+        template for each row (-1 for padding or unused rows).
+    """
+    n_templates = templates.shape[0]
+    used = np.flatnonzero(~np.isnan(templates).any(axis=1))
+    n_rows = _n_sparse_rows(len(used), n_templates)
+    if n_rows == n_templates:
+        index = np.full(n_templates, -1, dtype=np.intc)
+        index[used] = used
+        return _normalise_templates(templates), index
+    rows = np.zeros((n_rows, templates.shape[1]), dtype=np.float32)
+    index = np.full(n_rows, -1, dtype=np.intc)
+    rows[0:len(used)] = _normalise_templates(templates[used])
+    index[0:len(used)] = used
+    return rows, index
+
+
+def _prepare_template_spectra(templates, chan_offsets, fft_len):
+    """
+    Compute the spectra of normalised templates.
+
+    :type templates: np.ndarray
+    :param templates:
+        Normalised templates (n_rows, template_len), with the rows for each
+        channel contiguous.
+    :type chan_offsets: np.ndarray
+    :param chan_offsets:
+        Index of the first row of each channel (n_channels + 1), the last
+        element is the total number of rows.
+    :type fft_len: int
+    :param fft_len: Length of fft to use.
+
+    :return:
+        Spectra (n_rows, fft_len // 2 + 1) and summed templates (n_rows)
+    """
+    utilslib = _load_cdll('libutils')
+    utilslib.prepare_template_spectra.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=ctypes.c_long,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long, ctypes.c_long, ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.complex64,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS'))]
+    utilslib.prepare_template_spectra.restype = ctypes.c_int
+    n_rows, template_len = templates.shape
+    spectra = np.zeros((n_rows, fft_len // 2 + 1), dtype=np.complex64)
+    norm_sums = np.zeros(n_rows, dtype=np.float32)
+    ret = utilslib.prepare_template_spectra(
+        templates, chan_offsets, template_len, len(chan_offsets) - 1,
+        fft_len, spectra, norm_sums)
+    if ret != 0:
+        raise MemoryError("Memory allocation failed in correlation C-code")
+    return spectra, norm_sums
+
+
+def running_mean_var(data, window_len, tile_len=None):
+    """
+    Compute the running mean and variance of data.
+
+    Uses the same compiled routine used for normalisation in the "fftw"
+    backend. Statistics are computed in tiles: the first window in each tile
+    is computed directly using Welford's algorithm, and subsequent windows
+    are updated with a sliding-window update, which limits the accumulation
+    of rounding errors for long data.
+
+    :type data: np.ndarray
+    :param data: 1D array of data
+    :type window_len: int
+    :param window_len: Length of window (e.g. template length)
+    :type tile_len: int
+    :param tile_len:
+        Number of windows to compute per tile, defaults to the tile length
+        used internally for correlations.
+
+    :rtype: np.ndarray, np.ndarray
+    :return:
+        Mean and population variance (no N-1 correction) for each window,
+        each of length `len(data) - window_len + 1`.
+    """
+    utilslib = _load_cdll('libutils')
+    utilslib.running_mean_var.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32,
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long, ctypes.c_long, ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float64,
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=np.float64,
+                               flags=native_str('C_CONTIGUOUS'))]
+    utilslib.running_mean_var.restype = ctypes.c_int
+    n_windows = len(data) - window_len + 1
+    if window_len < 1 or n_windows < 1:
+        raise ValueError("window_len must be between 1 and len(data)")
+    mean = np.zeros(n_windows, dtype=np.float64)
+    var = np.zeros(n_windows, dtype=np.float64)
+    ret = utilslib.running_mean_var(
+        np.ascontiguousarray(data, dtype=np.float32), len(data), window_len,
+        tile_len or 0, mean, var)
+    if ret != 0:
+        raise MemoryError("Memory allocation failed in correlation C-code")
+    return mean, var
+
+
+def fftw_overlap_save_normxcorr(template_array, pad_array, seed_ids, blocks,
+                                cores_inner=None, template_spectra=None,
+                                **kwargs):
+    """
+    Correlate templates with an arbitrarily long stream of data blocks.
+
+    Uses an overlap-save scheme: the last `template_len - 1 + max(pads)`
+    samples of each block are kept and prepended to the next block, so that
+    memory use is constant regardless of the total length of data, and no
+    correlations are computed twice. Template spectra are computed once and
+    re-used for every block.
+
+    Concatenating the yielded cccsums gives the same result as correlating
+    the concatenated data in one go with :func:`fftw_multi_normxcorr` (with
+    `stack=True`).
+
+    :type template_array: dict
+    :param template_array:
+        Dictionary of 2D template arrays (n_templates, template_len) keyed by
+        seed_id.
+    :type pad_array: dict
+    :param pad_array:
+        Dictionary of lists of pads (in samples, n_templates long) keyed by
+        seed_id.
+    :type seed_ids: list
+    :param seed_ids: Seed-ids to correlate, in order.
+    :type blocks: iterable
+    :param blocks:
+        Iterable of data blocks. Each block is either a dictionary of 1D
+        arrays keyed by seed_id, or a 2D array (n_channels, block_len) in the
+        order of `seed_ids`. All channels of a block must be the same length,
+        blocks may be of different lengths.
+    :type cores_inner: int
+    :param cores_inner:
+        Number of threads to use for correlations, defaults to
+        `OMP_NUM_THREADS` if set, otherwise all available cores.
+    :type template_spectra: :class:`TemplateSpectra`
+    :param template_spectra:
+        Store for template spectra, a new one is created if not given.
+
+    :return:
+        Generator of 2D arrays of correlation sums (n_templates, n_out) for
+        consecutive sections of the data.
+
+    .. Note::
+        The default `fft_len` is fixed (rather than depending on the length
+        of data) so that template spectra can be re-used for every block.
+    """
+    if cores_inner is None:
+        cores_inner = int(os.getenv("OMP_NUM_THREADS", cpu_count()))
+    if template_spectra is None:
+        template_spectra = TemplateSpectra()
+    template_len = template_array[seed_ids[0]].shape[1]
+    kwargs.update({"fft_len": kwargs.get(
+        "fft_len", max(2 ** 13, next_fast_len(2 * template_len - 1)))})
+    pads = np.array([pad_array[seed_id] for seed_id in seed_ids])
+    if pads.min() < 0:
+        raise NotImplementedError("Negative pads are not supported")
+    overlap = template_len - 1 + pads.max()
+
+    def _correlate(data):
+        cccsums, _ = fftw_multi_normxcorr(
+            template_array=template_array,
+            stream_array={seed_id: data[i]
+                          for i, seed_id in enumerate(seed_ids)},
+            pad_array=pad_array, seed_ids=seed_ids, cores_inner=cores_inner,
+            stack=True, template_spectra=template_spectra, **kwargs)
+        return cccsums
+
+    buffer = np.empty((len(seed_ids), 0), dtype=np.float32)
+    for block in blocks:
+        if isinstance(block, dict):
+            block = [block[seed_id] for seed_id in seed_ids]
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim != 2 or block.shape[0] != len(seed_ids):
+            raise ValueError(
+                "Blocks must have one channel for each of the {0} "
+                "seed_ids".format(len(seed_ids)))
+        buffer = np.concatenate([buffer, block], axis=1)
+        n_out = buffer.shape[1] - overlap
+        if n_out <= 0:
+            continue
+        buffer = np.ascontiguousarray(buffer)
+        yield _correlate(buffer)[:, 0:n_out]
+        buffer = buffer[:, n_out:]
+    # Flush the remaining data, correlations within `max(pads)` of the end
+    # will not include all channels, as for fftw_multi_normxcorr.
+    if buffer.shape[1] >= template_len:
+        yield _correlate(np.ascontiguousarray(buffer))
+
+
+# ------------------------------- FFTW plan management
+
+FFTW_PLANNING_RIGORS = ('estimate', 'measure', 'patient', 'exhaustive')
+
+
+def set_fftw_planning(rigor='estimate'):
+    """
+    Set the planning rigor used for new FFTW plans.
+
+    Plans are cached in the C library by number of templates, fft length and
+    number of threads, so the cost of planning is only paid once for each
+    shape (and planning rigor). More rigorous planning can give faster
+    transforms, at the cost of a slower first call for each shape. Combine
+    with :func:`export_fftw_wisdom` and :func:`import_fftw_wisdom` to only
+    pay the planning cost once across runs.
+
+    :type rigor: str
+    :param rigor:
+        One of "estimate" (the default, FFTW_ESTIMATE), "measure",
+        "patient" or "exhaustive".
+
+    .. Note::
+        Planning with anything other than "estimate" is not deterministic:
+        plans depend on the timing of trial transforms, so results can
+        differ at the floating-point rounding level between runs.
+    """
+    rigor = rigor.lower()
+    if rigor not in FFTW_PLANNING_RIGORS:
+        raise ValueError("rigor must be one of {0}, not {1}".format(
+            FFTW_PLANNING_RIGORS, rigor))
+    utilslib = _load_cdll('libutils')
+    utilslib.set_fftw_planning.argtypes = [ctypes.c_int]
+    utilslib.set_fftw_planning.restype = ctypes.c_int
+    ret = utilslib.set_fftw_planning(FFTW_PLANNING_RIGORS.index(rigor))
+    if ret != 0:
+        raise CorrelationError("Could not set FFTW planning to {0}".format(
+            rigor))
+
+
+def clear_fftw_plan_cache():
+    """
+    Destroy all cached FFTW plans.
+
+    This must not be called while correlations are running in other threads.
+
+    :rtype: int
+    :return: Number of cached plan-sets destroyed.
+    """
+    utilslib = _load_cdll('libutils')
+    utilslib.clear_fftw_plan_cache.argtypes = []
+    utilslib.clear_fftw_plan_cache.restype = ctypes.c_int
+    return utilslib.clear_fftw_plan_cache()
+
+
+def _fftw_plan_cache_len():
+    """ Get the number of plan-sets currently cached. """
+    utilslib = _load_cdll('libutils')
+    utilslib.fftw_plan_cache_len.argtypes = []
+    utilslib.fftw_plan_cache_len.restype = ctypes.c_int
+    return utilslib.fftw_plan_cache_len()
+
+
+def import_fftw_wisdom(filename):
+    """
+    Import FFTW wisdom from a file written by :func:`export_fftw_wisdom`.
+
+    Wisdom is used by FFTW when creating new plans, so plans for shapes
+    covered by the wisdom are created quickly without re-measuring.
+
+    :type filename: str
+    :param filename: File to read wisdom from.
+
+    :rtype: bool
+    :return: Whether the wisdom was successfully imported.
+    """
+    if not os.path.isfile(filename):
+        Logger.warning("No FFTW wisdom file found at {0}".format(filename))
+        return False
+    utilslib = _load_cdll('libutils')
+    utilslib.import_fftw_wisdom.argtypes = [ctypes.c_char_p]
+    utilslib.import_fftw_wisdom.restype = ctypes.c_int
+    ret = utilslib.import_fftw_wisdom(filename.encode())
+    if ret != 1:
+        Logger.warning("Could not import FFTW wisdom from {0}".format(
+            filename))
+    return ret == 1
+
+
+def export_fftw_wisdom(filename):
+    """
+    Export accumulated FFTW wisdom to a file.
+
+    :type filename: str
+    :param filename: File to write wisdom to, will be overwritten.
+
+    .. Note::
+        Not all FFTW implementations support wisdom: the FFTW wrappers
+        provided by MKL do not, and an IOError will be raised.
+    """
+    utilslib = _load_cdll('libutils')
+    utilslib.export_fftw_wisdom.argtypes = [ctypes.c_char_p]
+    utilslib.export_fftw_wisdom.restype = ctypes.c_int
+    ret = utilslib.export_fftw_wisdom(filename.encode())
+    if ret != 1:
+        raise IOError("Could not write FFTW wisdom to {0}".format(filename))
+
+
+# ------------------------------- FFT length tuning
+
+# File used to store tuned fft lengths, can be overridden by setting the
+# EQCORRSCAN_FFT_LEN_CACHE environment variable.
+FFT_LEN_CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), ".eqcorrscan", "fft_len.json")
+
+_FFT_LEN_CACHES = {}  # Tuned fft lengths read from file, keyed by filename
+
+
+def _fft_len_cache_file():
+    return os.getenv("EQCORRSCAN_FFT_LEN_CACHE", FFT_LEN_CACHE_FILE)
+
+
+def _fft_len_key(template_len, n_templates, n_channels, cores):
+    return "{0}_{1}_{2}_{3}".format(
+        template_len, n_templates, n_channels, cores)
+
+
+def _read_fft_len_cache(filename):
+    """ Read (and keep) the tuned fft lengths from file. """
+    if filename not in _FFT_LEN_CACHES:
+        try:
+            with open(filename, "r") as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = dict()
+        _FFT_LEN_CACHES[filename] = cache
+    return _FFT_LEN_CACHES[filename]
+
+
+def get_tuned_fft_len(template_len, n_templates, n_channels=1, cores=1):
+    """
+    Get the fft length found by :func:`tune_fft_len` for a correlation shape.
+
+    :type template_len: int
+    :param template_len: Length of templates in samples
+    :type n_templates: int
+    :param n_templates: Number of templates
+    :type n_channels: int
+    :param n_channels: Number of channels
+    :type cores: int
+    :param cores: Number of threads used for correlations
+
+    :return: fft length, or None if this shape has not been tuned.
+    """
+    cache = _read_fft_len_cache(_fft_len_cache_file())
+    return cache.get(
+        _fft_len_key(template_len, n_templates, n_channels, cores))
+
+
+def tune_fft_len(template_len, n_templates, n_channels=1, cores=None,
+                 stream_len=100000, candidates=None, n_repeats=3, save=True):
+    """
+    Find the fastest fft length for correlations with the "fftw" backend.
+
+    Correlations of synthetic data are timed for each candidate fft length,
+    and the fastest is stored in a user config file
+    (`~/.eqcorrscan/fft_len.json` by default, or the file named by the
+    `EQCORRSCAN_FFT_LEN_CACHE` environment variable). The "fftw" backend
+    uses the stored value when `fft_len` is not given for correlations with
+    the same template length, number of templates, number of channels and
+    number of threads.
+
+    :type template_len: int
+    :param template_len: Length of templates in samples
+    :type n_templates: int
+    :param n_templates: Number of templates
+    :type n_channels: int
+    :param n_channels: Number of channels
+    :type cores: int
+    :param cores:
+        Number of threads to use for correlations, defaults to
+        `OMP_NUM_THREADS` if set, otherwise all available cores.
+    :type stream_len: int
+    :param stream_len: Length of synthetic data in samples.
+    :type candidates: list
+    :param candidates:
+        fft lengths to time, defaults to powers of two from twice the
+        template length up to 2 ** 17.
+    :type n_repeats: int
+    :param n_repeats: Number of times to time each candidate.
+    :type save: bool
+    :param save: Whether to store the result in the config file.
+
+    :return: The fastest fft length.
+    """
+    if cores is None:
+        cores = int(os.getenv("OMP_NUM_THREADS", cpu_count()))
+    full_len = next_fast_len(template_len + stream_len - 1)
+    if candidates is None:
+        candidates = [2 ** n for n in range(
+            int(np.ceil(np.log2(2 * template_len))), 18)]
+        candidates = sorted({min(c, full_len) for c in candidates})
+    candidates = [c for c in candidates if c >= template_len]
+    if len(candidates) == 0:
+        raise ValueError("No candidate fft lengths are longer than the "
+                         "template")
+    random = np.random.RandomState(42)
+    seed_ids = ["XX.S{0}..HHZ_0".format(i) for i in range(n_channels)]
+    template_array = {
+        seed_id: random.randn(n_templates, template_len).astype(np.float32)
+        for seed_id in seed_ids}
+    stream = random.randn(n_channels, stream_len).astype(np.float32)
+    pad_array = {seed_id: [0] * n_templates for seed_id in seed_ids}
+    timings = dict()
+    for fft_len in candidates:
+        run_times = []
+        # The first run includes planning, which is not timed
+        for i in range(n_repeats + 1):
+            tic = time.perf_counter()
+            fftw_multi_normxcorr(
+                template_array=template_array,
+                stream_array={seed_id: stream[j]
+                              for j, seed_id in enumerate(seed_ids)},
+                pad_array=pad_array, seed_ids=seed_ids, cores_inner=cores,
+                stack=True, fft_len=fft_len)
+            run_times.append(time.perf_counter() - tic)
+        timings[fft_len] = min(run_times[1:])
+        Logger.debug("fft_len {0}: {1:.4f}s".format(
+            fft_len, timings[fft_len]))
+    best = min(timings, key=timings.get)
+    Logger.info("Fastest fft_len for {0} templates of {1} samples on {2} "
+                "channels with {3} threads is {4}".format(
+                    n_templates, template_len, n_channels, cores, best))
+    if save:
+        filename = _fft_len_cache_file()
+        cache = _read_fft_len_cache(filename)
+        cache[_fft_len_key(template_len, n_templates, n_channels, cores)] = \
+            int(best)
+        if os.path.dirname(filename) and not os.path.isdir(
+                os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    return best
+
+
+def _default_fft_len(template_len, image_len, n_templates, n_channels,
+                     cores):
+    """ Tuned fft length if available, otherwise the fixed default. """
+    full_len = next_fast_len(template_len + image_len - 1)
+    fft_len = get_tuned_fft_len(template_len, n_templates, n_channels, cores)
+    if fft_len is None:
+        # In testing, 2**13 consistently comes out fastest - setting to
+        # default. https://github.com/eqcorrscan/EQcorrscan/pull/285
+        fft_len = 2 ** 13
+    return min(fft_len, full_len)
+
+
+def estimate_correlation_memory(n_templates, n_channels, template_len,
+                                image_len, fft_len=None, cores_outer=1,
+                                stack=True, template_spectra=True):
+    """
+    Estimate the peak memory used by a correlation with the "fftw" backend.
+
+    Counts the template and stream arrays, the output correlations, the
+    stored template spectra and the fft buffers (`fft_len` long for every
+    template) held by each concurrent group of channels.
+
+    :type n_templates: int
+    :param n_templates: Number of templates.
+    :type n_channels: int
+    :param n_channels: Number of channels.
+    :type template_len: int
+    :param template_len: Length of templates in samples.
+    :type image_len: int
+    :param image_len: Length of continuous data in samples.
+    :type fft_len: int
+    :param fft_len:
+        Length of fft used, defaults to the length the "fftw" backend uses.
+    :type cores_outer: int
+    :param cores_outer: Number of channels correlated concurrently.
+    :type stack: bool
+    :param stack: Whether correlations are stacked across channels.
+    :type template_spectra: bool
+    :param template_spectra: Whether template spectra are stored for re-use.
+
+    :return: Estimated peak memory in bytes.
+    :rtype: int
+    """
+    if fft_len is None:
+        fft_len = _default_fft_len(
+            template_len, image_len, n_templates, n_channels, 1)
+    fft_len = max(fft_len, template_len)
+    n_freqs = fft_len // 2 + 1
+    ccc_length = image_len - template_len + 1
+    float_size, complex_size = 4, 8
+    # Templates are held as read and as normalised
+    nbytes = 2 * n_templates * n_channels * template_len * float_size
+    nbytes += n_channels * image_len * float_size
+    if stack:
+        nbytes += n_templates * ccc_length * float_size
+    else:
+        nbytes += n_templates * n_channels * ccc_length * float_size
+    if template_spectra:
+        nbytes += n_templates * n_channels * n_freqs * complex_size
+    # Real (template_ext, ccc) and complex (outa, out) buffers per group
+    nbytes += cores_outer * n_templates * (
+        2 * fft_len * float_size + 2 * n_freqs * complex_size)
+    return int(nbytes)
+
+
 # ------------------------------- stream_xcorr functions
 
 
@@ -902,8 +2478,18 @@ def get_stream_xcorr(name_or_func=None, concurrency=None):
 # --------------------------- stream prep functions
 
 
-def _get_array_dicts(templates, stream, stack, copy_streams=True):
-    """ prepare templates and stream, return dicts """
+def _get_array_dicts(templates, stream, stack, copy_streams=True,
+                     stream_buffer=None):
+    """
+    prepare templates and stream, return dicts
+
+    If all channels of the stream are the same length the normalised stream
+    data are written into the rows of one (n_channels, npts) float32 array,
+    and the stream dict values are views of those rows, so that
+    :func:`fftw_multi_normxcorr` can pass the array to the C-code without
+    restacking it. `stream_buffer` can be given to use a pre-allocated (e.g.
+    memory-mapped or shared-memory) array of that shape instead.
+    """
     # Do some reshaping
     # init empty structures for data storage
     template_dict = {}
@@ -918,17 +2504,39 @@ def _get_array_dicts(templates, stream, stack, copy_streams=True):
     stream_start = min([tr.stats.starttime for tr in stream])
     # get seed ids, make sure these are collected on sorted streams
     seed_ids = [tr.id + '_' + str(i) for i, tr in enumerate(templates[0])]
+    # Look-up of the first trace for each id, rather than selecting from
+    # the stream for every channel
+    stream_traces = {}
+    for tr in stream:
+        stream_traces.setdefault(tr.id, tr)
+    stream_channels = [stream_traces[seed_id.split('_')[0]]
+                       for seed_id in seed_ids]
+    npts = {tr.stats.npts for tr in stream_channels}
+    if stream_buffer is not None:
+        if (stream_buffer.shape != (len(seed_ids), max(npts)) or
+                len(npts) > 1 or stream_buffer.dtype != np.float32):
+            raise ValueError(
+                "stream_buffer must be a float32 array of shape ({0}, {1}) "
+                "and all channels must be the same length".format(
+                    len(seed_ids), max(npts)))
+    elif len(npts) == 1:
+        stream_buffer = np.empty((len(seed_ids), npts.pop()),
+                                 dtype=np.float32)
     # pull common channels out of streams and templates and put in dicts
     for i, seed_id in enumerate(seed_ids):
         temps_with_seed = [template[i].data for template in templates]
         t_ar = np.array(temps_with_seed).astype(np.float32)
         template_dict.update({seed_id: t_ar})
-        stream_channel = stream.select(id=seed_id.split('_')[0])[0]
+        stream_channel = stream_channels[i]
         # Normalize data to ensure no float overflow
-        stream_data = stream_channel.data / (np.max(
-            np.abs(stream_channel.data)) / 1e5)
-        stream_dict.update(
-            {seed_id: stream_data.astype(np.float32)})
+        norm = np.max(np.abs(stream_channel.data)) / 1e5
+        if stream_buffer is not None:
+            stream_data = stream_buffer[i]
+            np.divide(stream_channel.data, norm, out=stream_data,
+                      casting='unsafe')
+        else:
+            stream_data = (stream_channel.data / norm).astype(np.float32)
+        stream_dict.update({seed_id: stream_data})
         stream_offset = int(
             round(stream_channel.stats.sampling_rate *
                   (stream_channel.stats.starttime - stream_start)))
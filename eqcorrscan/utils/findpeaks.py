@@ -18,11 +18,12 @@ from future.utils import native_str
 
 from eqcorrscan.utils.correlate import pool_boy
 from eqcorrscan.utils.libnames import _load_cdll
-from eqcorrscan.utils.clustering import dist_mat_km
 
 
 Logger = logging.getLogger(__name__)
 
+EARTH_RADIUS = 6371.009  # km, as used in distance_cluster.c
+
 
 def is_prime(number):
     """
@@ -302,7 +303,171 @@ def _multi_find_peaks_compiled(arrays, thresholds, trig_int, full_peaks,
     return out_peaks
 
 
-def _multi_decluster(peaks, indices, trig_int, thresholds, cores):
+def median_abs(arr, approximate=False, n_bins=1024, cores=None):
+    """
+    Compute the median absolute value of each row of an array in C.
+
+    The exact median partially sorts a copy of each row. The approximate
+    median instead histograms the absolute values into `n_bins` bins, then
+    histograms the bin holding the median into `n_bins` finer bins, which
+    needs a few passes over the data and no copy of it. The approximate
+    median is the centre of the fine bin, so it is within
+
+    .. math::
+
+        \\frac{max(abs(arr))}{2 \\times n\\_bins^2}
+
+    of the exact median (plus float32 rounding). For a cross-correlation
+    sum with a maximum of one hundred times its median absolute value, the
+    default of 1024 bins gives a relative error below 0.005%.
+
+    :type arr: numpy.ndarray
+    :param arr: 1 or 2-D array of data, one median is computed per row.
+    :type approximate: bool
+    :param approximate: Whether to use the histogram approximation.
+    :type n_bins: int
+    :param n_bins: Number of bins for each level of the histogram.
+    :type cores: int
+    :param cores: Number of threads to parallel across, defaults to one.
+
+    :return: Median absolute value of each row.
+    :rtype: numpy.ndarray
+
+    .. rubric:: Example
+
+    >>> arr = np.random.RandomState(42).randn(2, 100000).astype(np.float32)
+    >>> exact = median_abs(arr)
+    >>> approx = median_abs(arr, approximate=True)
+    >>> np.allclose(exact, np.median(np.abs(arr), axis=1))
+    True
+    >>> bound = np.abs(arr).max(axis=1) / (2 * 1024 ** 2)
+    >>> bool(np.all(np.abs(approx - exact) <= bound))
+    True
+    """
+    utilslib = _load_cdll('libutils')
+
+    arr = np.ascontiguousarray(arr, dtype=np.float32)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    n, length = arr.shape
+    if n_bins < 1:
+        raise ValueError("n_bins must be at least one")
+    medians = np.zeros(n, dtype=np.float32)
+    utilslib.multi_median_abs.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32, shape=(n, length),
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_long, ctypes.c_int, ctypes.c_int, ctypes.c_long,
+        np.ctypeslib.ndpointer(dtype=np.float32, shape=(n, ),
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_int]
+    utilslib.multi_median_abs.restype = ctypes.c_int
+    ret = utilslib.multi_median_abs(
+        arr, length, n, int(approximate), int(n_bins), medians, cores or 1)
+    if ret != 0:
+        raise MemoryError("Issue with c-routine, returned %i" % ret)
+    return medians
+
+
+def find_peaks_fused(arr, thresh, trig_int, mad=False, full_peaks=False,
+                     cores=None, approximate=False, n_bins=1024):
+    """
+    Threshold, find and decluster peaks in multiple arrays in one C pass.
+
+    Equivalent to :func:`multi_find_peaks` with the compiled peak finder,
+    but thresholds (including median absolute deviation thresholds) are
+    computed in C, and peaks are returned as compact arrays rather than
+    lists of tuples.
+
+    :type arr: numpy.ndarray
+    :param arr: 2-D array of data (e.g. correlation sums), one row each.
+    :type thresh: list
+    :param thresh:
+        Threshold for each row, or if `mad` is True, the multiple of the
+        median absolute value of each row to use as the threshold.
+    :type trig_int: int
+    :param trig_int:
+        The minimum difference in samples between triggers, if multiple
+        peaks within this window this code will find the highest.
+    :type mad: bool
+    :param mad: Whether `thresh` is a multiple of the median absolute value.
+    :type full_peaks: bool
+    :param full_peaks:
+        If True, will decluster within data-sections above the threshold,
+        rather than just taking the peak within that section.
+    :type cores: int
+    :param cores: Number of threads to parallel across, defaults to one.
+    :type approximate: bool
+    :param approximate:
+        Whether to approximate the median absolute value with a histogram
+        of `n_bins` bins, see :func:`median_abs` for the error bound.
+    :type n_bins: int
+    :param n_bins: Number of histogram bins for approximate medians.
+
+    :return:
+        Arrays of the row index, sample index and value of each peak
+        (ordered by row, then sample), and the threshold used for each row.
+    :rtype: tuple
+
+    .. rubric:: Example
+
+    >>> arr = np.zeros((2, 100), dtype=np.float32)
+    >>> arr[0, 40], arr[0, 42], arr[1, 60] = 20, 10, -30
+    >>> rows, samples, values, thresholds = find_peaks_fused(
+    ...     arr, thresh=[5, 5], trig_int=3)
+    >>> print(rows, samples, values)
+    [0 1] [40 60] [ 20. -30.]
+    """
+    utilslib = _load_cdll('libutils')
+
+    arr = np.ascontiguousarray(arr, dtype=np.float32)
+    if arr.ndim == 1:
+        arr = arr.reshape(1, -1)
+    n, length = arr.shape
+    thresholds = np.array(thresh, dtype=np.float64).reshape(n)
+    if mad and approximate and n_bins < 1:
+        raise ValueError("n_bins must be at least one")
+    cores = cores or 1
+    mad = 2 if mad and approximate else int(mad)
+    utilslib.multi_find_peaks_fused.restype = ctypes.c_int
+
+    capacity = max(min(length, 1024), 1)
+    while True:
+        _thresholds = np.ascontiguousarray(thresholds.copy())
+        counts = np.zeros(n, dtype=ctypes.c_long)
+        peak_indices = np.zeros(n * capacity, dtype=ctypes.c_long)
+        peak_values = np.zeros(n * capacity, dtype=np.float32)
+        utilslib.multi_find_peaks_fused.argtypes = [
+            np.ctypeslib.ndpointer(dtype=np.float32, shape=(n, length),
+                                   flags=native_str('C_CONTIGUOUS')),
+            ctypes.c_long, ctypes.c_int,
+            np.ctypeslib.ndpointer(dtype=np.float64, shape=(n, ),
+                                   flags=native_str('C_CONTIGUOUS')),
+            ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int,
+            ctypes.c_long,
+            np.ctypeslib.ndpointer(dtype=ctypes.c_long, shape=(n, ),
+                                   flags=native_str('C_CONTIGUOUS')),
+            np.ctypeslib.ndpointer(dtype=ctypes.c_long, shape=(n * capacity, ),
+                                   flags=native_str('C_CONTIGUOUS')),
+            np.ctypeslib.ndpointer(dtype=np.float32, shape=(n * capacity, ),
+                                   flags=native_str('C_CONTIGUOUS')),
+            ctypes.c_int]
+        ret = utilslib.multi_find_peaks_fused(
+            arr, length, n, _thresholds, mad, int(n_bins), int(trig_int) + 1,
+            int(full_peaks), capacity, counts, peak_indices, peak_values,
+            cores)
+        if ret != 0:
+            raise MemoryError("Issue with c-routine, returned %i" % ret)
+        if counts.max(initial=0) <= capacity:
+            break
+        # Rare: too many peaks in a row, re-run with enough space
+        capacity = int(counts.max())
+    keep = (np.arange(capacity) < counts[:, np.newaxis]).ravel()
+    rows = np.repeat(np.arange(n), counts)
+    return rows, peak_indices[keep], peak_values[keep], _thresholds
+
+
+def _multi_decluster(peaks, indices, trig_int, thresholds, cores,
+                     sweep=True):
     """
     Decluster peaks based on an enforced minimum separation.
 
@@ -316,6 +481,10 @@ def _multi_decluster(peaks, indices, trig_int, thresholds, cores):
     :param trig_int: Minimum trigger interval in samples
     :type thresholds: list
     :param thresholds: list of float of threshold values
+    :type sweep: bool
+    :param sweep:
+        Whether to use the O(n log n) sorted-sweep routine (default), or the
+        original routine that compares every peak to all kept peaks.
 
     :return: list of lists of tuples of (value, sample)
     """
@@ -333,10 +502,12 @@ def _multi_decluster(peaks, indices, trig_int, thresholds, cores):
     for var in [trig_int, lengths.max(), max_index]:
         if var == ctypes.c_long(var).value:
             long_type = ctypes.c_long
-            func = utilslib.multi_decluster
+            func = utilslib.multi_decluster_sweep if sweep else \
+                utilslib.multi_decluster
         elif var == ctypes.c_longlong(var).value:
             long_type = ctypes.c_longlong
-            func = utilslib.multi_decluster_ll
+            func = utilslib.multi_decluster_sweep_ll if sweep else \
+                utilslib.multi_decluster_ll
         else:
             # Note, could use numpy.gcd to try and find greatest common
             # divisor and make numbers smaller
@@ -422,61 +593,124 @@ def decluster_distance_time(peaks, index, trig_int, catalog,
     :param threshold: Minimum absolute peak value to retain it
 
     :return: list of tuples of (value, sample)
-    """
-    utilslib = _load_cdll('libutils')
 
+    .. Note::
+        Pairs of peaks within trig_int and hypocentral_separation of each
+        other are found using a KD-tree of event positions and peak times,
+        so memory scales with the number of close pairs rather than the
+        square of the number of peaks.
+    """
     length = peaks.shape[0]
     trig_int = int(trig_int)
 
-    for var in [index.max(), trig_int]:
-        if var == ctypes.c_long(var).value:
-            long_type = ctypes.c_long
-            func = utilslib.decluster_dist_time
-        elif var == ctypes.c_longlong(var).value:
-            long_type = ctypes.c_longlong
-            func = utilslib.decluster_dist_time_ll
-        else:
-            raise OverflowError("Maximum index larger than internal long long")
+    sorted_inds = np.abs(peaks).argsort()[::-1]
+    # Sort everything in the same way.
+    arr = np.ascontiguousarray(peaks[sorted_inds], dtype=np.float32)
+    inds = np.ascontiguousarray(index[sorted_inds], dtype=np.int64)
+    hypocentres = _hypocentres(catalog)[:, sorted_inds]
+
+    pairs = _close_pairs(
+        hypocentres=hypocentres, index=inds, trig_int=trig_int,
+        hypocentral_separation=hypocentral_separation)
+    # Neighbours of each peak, in compressed sparse row form
+    pairs = np.concatenate([pairs, pairs[:, ::-1]])
+    pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+    offsets = np.searchsorted(pairs[:, 0], np.arange(length + 1))
+    neighbours = pairs[:, 1]
+
+    # Take peaks from highest to lowest if no kept peak is close
+    out = np.zeros(length, dtype=bool)
+    for i in range(length):
+        if abs(arr[i]) < threshold:
+            break
+        if not out[neighbours[offsets[i]:offsets[i + 1]]].any():
+            out[i] = True
+
+    peaks_out = list(zip(arr[out], inds[out]))
+    return peaks_out
 
-    func.argtypes = [
-        np.ctypeslib.ndpointer(dtype=np.float32, shape=(length,),
-                               flags=native_str('C_CONTIGUOUS')),
-        np.ctypeslib.ndpointer(dtype=long_type, shape=(length,),
-                               flags=native_str('C_CONTIGUOUS')),
-        np.ctypeslib.ndpointer(dtype=np.float32, shape=(length * length,),
-                               flags=native_str('C_CONTIGUOUS')),
-        long_type, ctypes.c_float, long_type, ctypes.c_float,
-        np.ctypeslib.ndpointer(dtype=np.uint32, shape=(length,),
-                               flags=native_str('C_CONTIGUOUS'))]
-    func.restype = ctypes.c_int
 
-    sorted_inds = np.abs(peaks).argsort()
-    # Sort everything in the same way.
-    arr = peaks[sorted_inds[::-1]]
-    inds = index[sorted_inds[::-1]]
-    sorted_events = [catalog[i] for i in sorted_inds[::-1]]
-    distance_matrix = dist_mat_km(catalog=sorted_events)
+def _hypocentres(catalog):
+    """
+    Latitudes and longitudes (in radians) and depths (in km) of events.
 
-    arr = np.ascontiguousarray(arr, dtype=np.float32)
-    inds = np.ascontiguousarray(inds, dtype=long_type)
-    distance_matrix = np.ascontiguousarray(
-        distance_matrix.flatten(order="C"), dtype=np.float32)
-    out = np.zeros(len(arr), dtype=np.uint32)
+    :return: numpy.ndarray of shape (3, len(catalog))
+    """
+    hypocentres = np.empty((3, len(catalog)))
+    for i, event in enumerate(catalog):
+        origin = event.preferred_origin() or event.origins[0]
+        hypocentres[:, i] = (
+            origin.latitude, origin.longitude, origin.depth / 1000)
+    hypocentres[0:2] = np.radians(hypocentres[0:2])
+    return hypocentres
 
-    ret = func(
-        arr, inds, distance_matrix, long_type(length), np.float32(threshold),
-        long_type(trig_int), hypocentral_separation, out)
-    if ret != 0:
-        raise MemoryError("Issue with c-routine, returned %i" % ret)
 
-    peaks_out = list(zip(arr[out.astype(bool)], inds[out.astype(bool)]))
-    return peaks_out
+def _close_pairs(hypocentres, index, trig_int, hypocentral_separation):
+    """
+    Find pairs within trig_int and hypocentral_separation of each other.
+
+    Candidate pairs are found with a KD-tree of earth-centred (ECEF)
+    positions scaled by the separation and times scaled by trig_int, then
+    checked against the hypocentral distance used by
+    :func:`eqcorrscan.utils.clustering.dist_mat_km`. Straight-line
+    distances are never longer than hypocentral distances, so no close
+    pairs are missed.
+
+    :type hypocentres: numpy.ndarray
+    :param hypocentres: Output of `_hypocentres`.
+    :type index: numpy.ndarray
+    :param index: Times of peaks.
+    :type trig_int: int
+    :param trig_int: Maximum separation in time.
+    :type hypocentral_separation: float
+    :param hypocentral_separation: Distance (exclusive) in km.
 
+    :return: numpy.ndarray of shape (n_pairs, 2) of positions in index.
+    """
+    from scipy.spatial import cKDTree
+
+    if hypocentral_separation <= 0 or len(index) < 2:
+        return np.empty((0, 2), dtype=np.intp)
+    latitudes, longitudes, depths = hypocentres
+    radii = EARTH_RADIUS - depths
+    points = np.column_stack([
+        radii * np.cos(latitudes) * np.cos(longitudes),
+        radii * np.cos(latitudes) * np.sin(longitudes),
+        radii * np.sin(latitudes)]) / hypocentral_separation
+    times = index - index.min()
+    points = np.column_stack([points, times / max(trig_int, 1)])
+    pairs = cKDTree(points).query_pairs(
+        r=1.0, p=np.inf, output_type="ndarray")
+    i, j = pairs[:, 0], pairs[:, 1]
+    close = (np.abs(times[i] - times[j]) <= trig_int) & (
+        _hypocentral_distance(hypocentres[:, i], hypocentres[:, j]) <
+        hypocentral_separation)
+    return pairs[close]
+
+
+def _hypocentral_distance(hypocentres_1, hypocentres_2):
+    """
+    Distance in km between hypocentres as given by `_hypocentres`.
 
-def decluster(peaks, index, trig_int, threshold=0):
+    Uses the haversine formula for the distance at the surface and includes
+    the difference in depth.
+    """
+    lat_1, lon_1, depth_1 = hypocentres_1
+    lat_2, lon_2, depth_2 = hypocentres_2
+    central_angle = 2 * np.arcsin(np.sqrt(
+        np.sin((lat_1 - lat_2) / 2) ** 2 +
+        np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_1 - lon_2) / 2) ** 2))
+    return np.sqrt((EARTH_RADIUS * central_angle) ** 2 +
+                   (depth_1 - depth_2) ** 2)
+
+
+def decluster(peaks, index, trig_int, threshold=0, sweep=True):
     """
     Decluster peaks based on an enforced minimum separation.
 
+    Peaks are taken from largest to smallest absolute value, and kept if
+    there are no kept peaks within trig_int of them.
+
     :type peaks: np.array
     :param peaks: array of peak values
     :type index: np.ndarray
@@ -485,6 +719,10 @@ def decluster(peaks, index, trig_int, threshold=0):
     :param trig_int: Minimum trigger interval in samples
     :type threshold: float
     :param threshold: Minimum absolute peak value to retain it.
+    :type sweep: bool
+    :param sweep:
+        Whether to use the O(n log n) sorted-sweep routine (default), or the
+        original routine that compares every peak to all kept peaks.
 
     :return: list of tuples of (value, sample)
     """
@@ -496,10 +734,11 @@ def decluster(peaks, index, trig_int, threshold=0):
     for var in [index.max(), trig_int]:
         if var == ctypes.c_long(var).value:
             long_type = ctypes.c_long
-            func = utilslib.decluster
+            func = utilslib.decluster_sweep if sweep else utilslib.decluster
         elif var == ctypes.c_longlong(var).value:
             long_type = ctypes.c_longlong
-            func = utilslib.decluster_ll
+            func = utilslib.decluster_sweep_ll if sweep else \
+                utilslib.decluster_ll
         else:
             raise OverflowError("Maximum index larger than internal long long")
 
@@ -625,47 +864,121 @@ def coin_trig(peaks, stachans, samp_rate, moveout, min_trig, trig_int):
     >>> print(triggers)
     [(0.45, 100)]
     """
-    triggers = []
-    for stachan, _peaks in zip(stachans, peaks):
-        for peak in _peaks:
-            trigger = (peak[1], peak[0], '.'.join(stachan))
-            triggers.append(trigger)
-    coincidence_triggers = []
-    for i, master in enumerate(triggers):
-        slaves = triggers[i + 1:]
-        coincidence = 1
-        trig_time = master[0]
-        trig_val = master[1]
-        for slave in slaves:
-            if abs(slave[0] - master[0]) <= (moveout * samp_rate) and \
-               slave[2] != master[2]:
-                coincidence += 1
-                if slave[0] < master[0]:
-                    trig_time = slave[0]
-                trig_val += slave[1]
-        if coincidence >= min_trig:
-            coincidence_triggers.append((trig_val / coincidence,
-                                         trig_time))
-    # Sort by trigger-value, largest to smallest - remove duplicate detections
-    if coincidence_triggers:
-        coincidence_triggers.sort(key=lambda tup: tup[0], reverse=True)
-        output = [coincidence_triggers[0]]
-        for coincidence_trigger in coincidence_triggers[1:]:
-            add = True
-            for peak in output:
-                # If the event occurs within the trig_int time then do not add
-                # it, and break out of the inner loop.
-                if abs(coincidence_trigger[1] - peak[1]) < (trig_int *
-                                                            samp_rate):
-                    add = False
-                    break
-            if add:
-                output.append((coincidence_trigger[0],
-                               coincidence_trigger[1]))
-        output.sort(key=lambda tup: tup[1])
-        return output
-    else:
+    triggers = [(peak[1], peak[0], '.'.join(stachan))
+                for stachan, _peaks in zip(stachans, peaks)
+                for peak in _peaks]
+    if len(triggers) == 0:
+        return []
+    times = np.array([trigger[0] for trigger in triggers])
+    values = np.array([trigger[1] for trigger in triggers], dtype=np.float64)
+    _, stachan_ids = np.unique(
+        [trigger[2] for trigger in triggers], return_inverse=True)
+    # Each trigger (the master) is compared to all later triggers (slaves)
+    # from other station-channels within the moveout.
+    masters, slaves = _coincident_pairs(
+        times, stachan_ids, moveout * samp_rate)
+    coincidence = np.bincount(masters, minlength=len(triggers))
+    keep = coincidence >= min_trig
+    if not keep.any():
         return []
+    # Sum the master and then slave values in order
+    trig_vals = np.bincount(
+        masters, weights=values[slaves], minlength=len(triggers))
+    # The trigger time is the last earlier slave, or the master time
+    earlier = times[slaves] < times[masters]
+    last_earlier = np.full(len(triggers), -1)
+    np.maximum.at(last_earlier, masters[earlier], slaves[earlier])
+    trig_times = np.where(
+        last_earlier >= 0, times[last_earlier], times)[keep]
+    trig_vals = (trig_vals / coincidence)[keep]
+    # Take triggers from largest to smallest value, removing those within
+    # trig_int of a larger trigger
+    order = np.argsort(-trig_vals, kind="mergesort")
+    trig_vals, trig_times = trig_vals[order], trig_times[order]
+    min_separation = int(np.ceil(trig_int * samp_rate)) - 1
+    if min_separation >= 0:
+        kept = _decluster_in_order(trig_times, min_separation)
+        trig_vals, trig_times = trig_vals[kept], trig_times[kept]
+    order = np.argsort(trig_times, kind="mergesort")
+    return list(zip(trig_vals[order].tolist(), trig_times[order].tolist()))
+
+
+def _coincident_pairs(times, stachan_ids, moveout):
+    """
+    Find pairs of triggers that coincide within the moveout.
+
+    Pairs are found within a window swept over the triggers sorted by time,
+    rather than by comparing every pair of triggers.
+
+    :type times: numpy.ndarray
+    :param times: Trigger times in samples.
+    :type stachan_ids: numpy.ndarray
+    :param stachan_ids: Integer station-channel id of each trigger.
+    :type moveout: float
+    :param moveout: Allowable moveout in samples.
+
+    :return:
+        Arrays of the master and slave trigger indices of each pair,
+        including each trigger paired with itself, sorted by master then
+        slave. Slaves are later than masters in the input order, from a
+        different station-channel, and within the moveout (inclusive).
+    :rtype: tuple
+    """
+    time_order = np.argsort(times, kind="mergesort")
+    sorted_times = times[time_order]
+    # Search one sample beyond the moveout, the exact test is below
+    lower = np.searchsorted(sorted_times, sorted_times - moveout - 1, "left")
+    upper = np.searchsorted(sorted_times, sorted_times + moveout + 1, "right")
+    sizes = upper - lower
+    masters = np.repeat(np.arange(len(times)), sizes)
+    offsets = np.arange(len(masters)) - np.repeat(
+        np.cumsum(sizes) - sizes, sizes)
+    slaves = time_order[lower[masters] + offsets]
+    masters = time_order[masters]
+    coincident = (masters == slaves) | (
+        (slaves > masters) & (stachan_ids[slaves] != stachan_ids[masters]) &
+        (np.abs(times[slaves] - times[masters]) <= moveout))
+    masters, slaves = masters[coincident], slaves[coincident]
+    pair_order = np.lexsort((slaves, masters))
+    return masters[pair_order], slaves[pair_order]
+
+
+def _decluster_in_order(index, trig_int):
+    """
+    Decluster peaks that are already ordered from most to least important.
+
+    :type index: numpy.ndarray
+    :param index: Locations of peaks in samples.
+    :type trig_int: int
+    :param trig_int:
+        Peaks within trig_int (inclusive) of a more important kept peak are
+        removed.
+
+    :return: Boolean array of peaks to keep.
+    :rtype: numpy.ndarray
+    """
+    utilslib = _load_cdll('libutils')
+
+    length = len(index)
+    utilslib.decluster_sweep_ll.argtypes = [
+        np.ctypeslib.ndpointer(dtype=np.float32, shape=(length,),
+                               flags=native_str('C_CONTIGUOUS')),
+        np.ctypeslib.ndpointer(dtype=ctypes.c_longlong, shape=(length,),
+                               flags=native_str('C_CONTIGUOUS')),
+        ctypes.c_longlong, ctypes.c_float, ctypes.c_longlong,
+        np.ctypeslib.ndpointer(dtype=np.uint32, shape=(length,),
+                               flags=native_str('C_CONTIGUOUS'))]
+    utilslib.decluster_sweep_ll.restype = ctypes.c_int
+    # Equal values, all above the threshold, keep the given order
+    arr = np.ones(length, dtype=np.float32)
+    inds = np.ascontiguousarray(index, dtype=ctypes.c_longlong)
+    out = np.zeros(length, dtype=np.uint32)
+    ret = utilslib.decluster_sweep_ll(
+        arr, inds, ctypes.c_longlong(length), np.float32(0),
+        ctypes.c_longlong(trig_int), out)
+    if ret != 0:
+        raise MemoryError("Issue with c-routine, returned %i" % ret)
+    return out.astype(bool)
 
 
 if __name__ == "__main__":
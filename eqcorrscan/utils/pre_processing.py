@@ -180,9 +180,45 @@ def shortproc(st, lowcut, highcut, filt_order, samp_rate, parallel=False,
         st = Stream(st)
     else:
         tracein = False
+    # Work in place on the stream
+    st.traces = _shortproc(
+        st=st, filters=[(lowcut, highcut, filt_order)], samp_rate=samp_rate,
+        parallel=parallel, num_cores=num_cores, starttime=starttime,
+        endtime=endtime, seisan_chan_names=seisan_chan_names,
+        fill_gaps=fill_gaps, ignore_length=ignore_length,
+        ignore_bad_data=ignore_bad_data, fft_threads=fft_threads)[0].traces
+    if tracein:
+        st.merge()
+        return st[0]
+    return st
+
+
+def _shortproc(st, filters, samp_rate, parallel=False, num_cores=False,
+               starttime=None, endtime=None, seisan_chan_names=False,
+               fill_gaps=True, ignore_length=False, ignore_bad_data=False,
+               fft_threads=1, pool=None):
+    """
+    Short-processing with one or more sets of filter settings.
+
+    Data are trimmed, gap-filled, detrended and resampled once, then
+    filtered with each of `filters`.
+
+    :type st: obspy.core.stream.Stream
+    :param st: Stream to process
+    :type filters: list
+    :param filters: List of (lowcut, highcut, filt_order) tuples.
+    :type pool: multiprocessing.pool.Pool
+    :param pool: See :func:`_process_stream`.
+
+    Other arguments are as for :func:`shortproc`.
+
+    :return: List of processed streams, one for each of `filters`.
+    :rtype: list
+    """
     # Add sanity check for filter
-    if highcut and highcut >= 0.5 * samp_rate:
-        raise IOError('Highcut must be lower than the nyquist')
+    for _, highcut, _ in filters:
+        if highcut and highcut >= 0.5 * samp_rate:
+            raise IOError('Highcut must be lower than the nyquist')
     length = None
     clip = False
     if starttime is not None and endtime is not None:
@@ -203,41 +239,12 @@ def shortproc(st, lowcut, highcut, filt_order, samp_rate, parallel=False,
         if len(tr.data) == 0:
             st.remove(tr)
             Logger.warning('No data for {0} after trim'.format(tr.id))
-    if parallel:
-        if not num_cores:
-            num_cores = cpu_count()
-        if num_cores > len(st):
-            num_cores = len(st)
-        pool = Pool(processes=num_cores)
-        results = [pool.apply_async(process, (tr,), {
-            'lowcut': lowcut, 'highcut': highcut, 'filt_order': filt_order,
-            'samp_rate': samp_rate, 'starttime': starttime,
-            'clip': clip, 'seisan_chan_names': seisan_chan_names,
-            'fill_gaps': fill_gaps, 'length': length,
-            'ignore_length': ignore_length, 'fft_threads': fft_threads,
-            'ignore_bad_data': ignore_bad_data})
-                   for tr in st]
-        pool.close()
-        try:
-            stream_list = [p.get() for p in results]
-        except KeyboardInterrupt as e:  # pragma: no cover
-            pool.terminate()
-            raise e
-        pool.join()
-        st = Stream(stream_list)
-    else:
-        for i, tr in enumerate(st):
-            st[i] = process(
-                tr=tr, lowcut=lowcut, highcut=highcut, filt_order=filt_order,
-                samp_rate=samp_rate, starttime=starttime,
-                clip=clip, seisan_chan_names=seisan_chan_names,
-                fill_gaps=fill_gaps, length=length,
-                ignore_length=ignore_length, ignore_bad_data=ignore_bad_data,
-                fft_threads=fft_threads)
-    if tracein:
-        st.merge()
-        return st[0]
-    return st
+    return _process_stream(
+        st=st, filters=filters, parallel=parallel, num_cores=num_cores,
+        samp_rate=samp_rate, starttime=starttime, clip=clip,
+        seisan_chan_names=seisan_chan_names, fill_gaps=fill_gaps,
+        length=length, ignore_length=ignore_length, fft_threads=fft_threads,
+        ignore_bad_data=ignore_bad_data, pool=pool)
 
 
 def dayproc(st, lowcut, highcut, filt_order, samp_rate, starttime,
@@ -341,14 +348,50 @@ def dayproc(st, lowcut, highcut, filt_order, samp_rate, starttime,
     BP.JCNB.40.SP1 | 2012-03-26T00:00:00.000000Z - 2012-03-26T23:59:59.\
 950000Z | 20.0 Hz, 1728000 samples
     """
-    # Add sanity check for filter
     if isinstance(st, Trace):
         st = Stream(st)
         tracein = True
     else:
         tracein = False
-    if highcut and highcut >= 0.5 * samp_rate:
-        raise IOError('Highcut must be lower than the nyquist')
+    # Work in place on the stream
+    st.traces = _dayproc(
+        st=st, filters=[(lowcut, highcut, filt_order)], samp_rate=samp_rate,
+        starttime=starttime, parallel=parallel, num_cores=num_cores,
+        ignore_length=ignore_length, seisan_chan_names=seisan_chan_names,
+        fill_gaps=fill_gaps, ignore_bad_data=ignore_bad_data,
+        fft_threads=fft_threads)[0].traces
+    if tracein:
+        st.merge()
+        return st[0]
+    return st
+
+
+def _dayproc(st, filters, samp_rate, starttime, parallel=True,
+             num_cores=False, ignore_length=False, seisan_chan_names=False,
+             fill_gaps=True, ignore_bad_data=False, fft_threads=1,
+             pool=None):
+    """
+    Day-long processing with one or more sets of filter settings.
+
+    Data are gap-filled, detrended, trimmed and resampled once, then
+    filtered with each of `filters`.
+
+    :type st: obspy.core.stream.Stream
+    :param st: Stream to process
+    :type filters: list
+    :param filters: List of (lowcut, highcut, filt_order) tuples.
+    :type pool: multiprocessing.pool.Pool
+    :param pool: See :func:`_process_stream`.
+
+    Other arguments are as for :func:`dayproc`.
+
+    :return: List of processed streams, one for each of `filters`.
+    :rtype: list
+    """
+    # Add sanity check for filter
+    for _, highcut, _ in filters:
+        if highcut and highcut >= 0.5 * samp_rate:
+            raise IOError('Highcut must be lower than the nyquist')
     # Set the start-time to a day start - cope with
     if starttime is None:
         startdates = []
@@ -368,42 +411,65 @@ def dayproc(st, lowcut, highcut, filt_order, samp_rate, starttime,
         if not len(set(startdates)) == 1:
             raise NotImplementedError('Traces start on different days')
         starttime = UTCDateTime(startdates[0])
-    if parallel:
+    streams = _process_stream(
+        st=st, filters=filters, parallel=parallel, num_cores=num_cores,
+        samp_rate=samp_rate, starttime=starttime, clip=True,
+        ignore_length=ignore_length, length=86400,
+        seisan_chan_names=seisan_chan_names, fill_gaps=fill_gaps,
+        ignore_bad_data=ignore_bad_data, fft_threads=fft_threads, pool=pool)
+    for st in streams:
+        for tr in st:
+            if len(tr.data) == 0:
+                st.remove(tr)
+    return streams
+
+
+def _process_stream(st, filters, parallel, num_cores, pool=None, **kwargs):
+    """
+    Process all traces in a stream, in parallel or serial.
+
+    :type st: obspy.core.stream.Stream
+    :param st: Stream to process
+    :type filters: list
+    :param filters: List of (lowcut, highcut, filt_order) tuples.
+    :type parallel: bool
+    :param parallel: Whether to process traces in parallel.
+    :type num_cores: int
+    :param num_cores:
+        Number of processes to use, if False then all cores are used.
+    :type pool: multiprocessing.pool.Pool
+    :param pool:
+        Existing pool to process traces with when `parallel` is True. It
+        is left open for the caller to close. If None a pool of
+        `num_cores` processes is made for this call.
+    :param kwargs: Passed to :func:`_process_filters`.
+
+    :return: List of processed streams, one for each of `filters`.
+    :rtype: list
+    """
+    if parallel and pool is not None:
+        results = [pool.apply_async(_process_filters, (tr, filters), kwargs)
+                   for tr in st]
+        trace_lists = [p.get() for p in results]
+    elif parallel:
         if not num_cores:
             num_cores = cpu_count()
         if num_cores > len(st):
             num_cores = len(st)
         pool = Pool(processes=num_cores)
-        results = [pool.apply_async(process, (tr,), {
-            'lowcut': lowcut, 'highcut': highcut, 'filt_order': filt_order,
-            'samp_rate': samp_rate, 'starttime': starttime, 'clip': True,
-            'ignore_length': ignore_length, 'length': 86400,
-            'seisan_chan_names': seisan_chan_names, 'fill_gaps': fill_gaps,
-            'ignore_bad_data': ignore_bad_data, 'fft_threads': fft_threads})
+        results = [pool.apply_async(_process_filters, (tr, filters), kwargs)
                    for tr in st]
         pool.close()
         try:
-            stream_list = [p.get() for p in results]
+            trace_lists = [p.get() for p in results]
         except KeyboardInterrupt as e:  # pragma: no cover
             pool.terminate()
             raise e
         pool.join()
-        st = Stream(stream_list)
     else:
-        for i, tr in enumerate(st):
-            st[i] = process(
-                tr=tr, lowcut=lowcut, highcut=highcut, filt_order=filt_order,
-                samp_rate=samp_rate, starttime=starttime, clip=True,
-                length=86400, ignore_length=ignore_length,
-                seisan_chan_names=seisan_chan_names, fill_gaps=fill_gaps,
-                ignore_bad_data=ignore_bad_data, fft_threads=fft_threads)
-    for tr in st:
-        if len(tr.data) == 0:
-            st.remove(tr)
-    if tracein:
-        st.merge()
-        return st[0]
-    return st
+        trace_lists = [_process_filters(tr, filters, **kwargs) for tr in st]
+    return [Stream([traces[i] for traces in trace_lists])
+            for i in range(len(filters))]
 
 
 def process(tr, lowcut, highcut, filt_order, samp_rate,
@@ -467,9 +533,38 @@ def process(tr, lowcut, highcut, filt_order, samp_rate,
         calculated within gaps. If your data have gaps you should pass a merged
         stream without the `fill_value` argument (e.g.: `tr = tr.merge()`).
     """
+    return _process_filters(
+        tr=tr, filters=[(lowcut, highcut, filt_order)], samp_rate=samp_rate,
+        starttime=starttime, clip=clip, length=length,
+        seisan_chan_names=seisan_chan_names, ignore_length=ignore_length,
+        fill_gaps=fill_gaps, ignore_bad_data=ignore_bad_data,
+        fft_threads=fft_threads)[0]
+
+
+def _process_filters(tr, filters, samp_rate, starttime=False, clip=False,
+                     length=86400, seisan_chan_names=False,
+                     ignore_length=False, fill_gaps=True,
+                     ignore_bad_data=False, fft_threads=1):
+    """
+    Process a trace with one or more sets of filter settings.
+
+    The trace is gap-filled, detrended, trimmed to length and resampled
+    once, then filtered with each of `filters`.
+
+    :type tr: obspy.core.trace.Trace
+    :param tr: Trace to process
+    :type filters: list
+    :param filters: List of (lowcut, highcut, filt_order) tuples.
+
+    Other arguments are as for :func:`process`.
+
+    :return: List of processed traces, one for each of `filters`.
+    :rtype: list
+    """
     # Add sanity check
-    if highcut and highcut >= 0.5 * samp_rate:
-        raise IOError('Highcut must be lower than the nyquist')
+    for _, highcut, _ in filters:
+        if highcut and highcut >= 0.5 * samp_rate:
+            raise IOError('Highcut must be lower than the nyquist')
 
     # Define the start-time
     if starttime:
@@ -494,11 +589,7 @@ def process(tr, lowcut, highcut, filt_order, samp_rate,
             raise ValueError(msg)
         else:
             Logger.warning(msg)
-            return Trace(data=np.array([]), header={
-                "station": tr.stats.station, "channel": tr.stats.channel,
-                "network": tr.stats.network, "location": tr.stats.location,
-                "starttime": tr.stats.starttime,
-                "sampling_rate": tr.stats.sampling_rate})
+            return [_empty_trace(tr) for _ in filters]
     tr = tr.detrend('simple')
     # Detrend data before filtering
     Logger.debug('I have {0} data points for {1} before processing'.format(
@@ -524,11 +615,7 @@ def process(tr, lowcut, highcut, filt_order, samp_rate,
                 raise NotImplementedError(msg)
             else:
                 Logger.warning(msg)
-                return Trace(data=np.array([]), header={
-                    "station": tr.stats.station, "channel": tr.stats.channel,
-                    "network": tr.stats.network, "location": tr.stats.location,
-                    "starttime": tr.stats.starttime,
-                    "sampling_rate": tr.stats.sampling_rate})
+                return [_empty_trace(tr) for _ in filters]
         # trim, then calculate length of any pads required
         pre_pad_secs = tr.stats.starttime - starttime
         post_pad_secs = (starttime + length) - tr.stats.endtime
@@ -558,11 +645,7 @@ def process(tr, lowcut, highcut, filt_order, samp_rate,
                 raise ValueError(msg)
             else:
                 Logger.warning(msg)
-                return Trace(data=np.array([]), header={
-                    "station": tr.stats.station, "channel": tr.stats.channel,
-                    "network": tr.stats.network, "location": tr.stats.location,
-                    "starttime": tr.stats.starttime,
-                    "sampling_rate": tr.stats.sampling_rate})
+                return [_empty_trace(tr) for _ in filters]
         Logger.debug(
             'I now have {0} data points after enforcing length'.format(
                 tr.stats.npts))
@@ -570,61 +653,79 @@ def process(tr, lowcut, highcut, filt_order, samp_rate,
     if tr.stats.sampling_rate != samp_rate:
         Logger.debug('Resampling')
         tr = _resample(tr, samp_rate, threads=fft_threads)
-    # Filtering section
-    tr = tr.detrend('simple')    # Detrend data again before filtering
-    if highcut and lowcut:
-        Logger.debug('Bandpassing')
-        tr.data = bandpass(tr.data, lowcut, highcut,
-                           tr.stats.sampling_rate, filt_order, True)
-    elif highcut:
-        Logger.debug('Lowpassing')
-        tr.data = lowpass(tr.data, highcut, tr.stats.sampling_rate,
-                          filt_order, True)
-    elif lowcut:
-        Logger.debug('Highpassing')
-        tr.data = highpass(tr.data, lowcut, tr.stats.sampling_rate,
-                           filt_order, True)
-    else:
-        Logger.warning('No filters applied')
-    # Account for two letter channel names in s-files and therefore templates
-    if seisan_chan_names:
-        tr.stats.channel = tr.stats.channel[0] + tr.stats.channel[-1]
-
-    if padded:
-        Logger.debug("Reapplying zero pads post processing")
-        Logger.debug(str(tr))
-        pre_pad = np.zeros(int(pre_pad_secs * tr.stats.sampling_rate))
-        post_pad = np.zeros(int(post_pad_secs * tr.stats.sampling_rate))
-        pre_pad_len = len(pre_pad)
-        post_pad_len = len(post_pad)
-        Logger.debug(
-            "Taking only valid data between {0} and {1} samples".format(
-                pre_pad_len, tr.stats.npts - post_pad_len))
-        # Re-apply the pads, taking only the data section that was valid
-        tr.data = np.concatenate(
-            [pre_pad, tr.data[pre_pad_len: len(tr.data) - post_pad_len],
-             post_pad])
-        Logger.debug(str(tr))
-    # Sanity check to ensure files are correct length
-    if float(tr.stats.npts * tr.stats.delta) != length and clip:
-        Logger.info(
-            'Data for {0} are not of required length, will zero pad'.format(
-                tr.id))
-        # Use obspy's trim function with zero padding
-        tr = tr.trim(starttime, starttime + length, pad=True, fill_value=0,
-                     nearest_sample=True)
-        # If there is one sample too many after this remove the last one
-        # by convention
-        if len(tr.data) == (length * tr.stats.sampling_rate) + 1:
-            tr.data = tr.data[1:len(tr.data)]
-        if abs((tr.stats.sampling_rate * length) -
-               tr.stats.npts) > tr.stats.delta:
-            raise ValueError('Data are not required length for ' +
-                             tr.stats.station + '.' + tr.stats.channel)
-    # Replace the gaps with zeros
-    if gappy:
-        tr = _zero_pad_gaps(tr, gaps, fill_gaps=fill_gaps)
-    return tr
+    resampled = tr
+    processed = []
+    for i, (lowcut, highcut, filt_order) in enumerate(filters):
+        # Filter a copy of the resampled data for all but the last filter
+        if i < len(filters) - 1:
+            tr = resampled.copy()
+        else:
+            tr = resampled
+        # Filtering section
+        tr = tr.detrend('simple')    # Detrend data again before filtering
+        if highcut and lowcut:
+            Logger.debug('Bandpassing')
+            tr.data = bandpass(tr.data, lowcut, highcut,
+                               tr.stats.sampling_rate, filt_order, True)
+        elif highcut:
+            Logger.debug('Lowpassing')
+            tr.data = lowpass(tr.data, highcut, tr.stats.sampling_rate,
+                              filt_order, True)
+        elif lowcut:
+            Logger.debug('Highpassing')
+            tr.data = highpass(tr.data, lowcut, tr.stats.sampling_rate,
+                               filt_order, True)
+        else:
+            Logger.warning('No filters applied')
+        # Account for two letter channel names in s-files and templates
+        if seisan_chan_names:
+            tr.stats.channel = tr.stats.channel[0] + tr.stats.channel[-1]
+
+        if padded:
+            Logger.debug("Reapplying zero pads post processing")
+            Logger.debug(str(tr))
+            pre_pad = np.zeros(int(pre_pad_secs * tr.stats.sampling_rate))
+            post_pad = np.zeros(int(post_pad_secs * tr.stats.sampling_rate))
+            pre_pad_len = len(pre_pad)
+            post_pad_len = len(post_pad)
+            Logger.debug(
+                "Taking only valid data between {0} and {1} samples".format(
+                    pre_pad_len, tr.stats.npts - post_pad_len))
+            # Re-apply the pads, taking only the data section that was valid
+            tr.data = np.concatenate(
+                [pre_pad, tr.data[pre_pad_len: len(tr.data) - post_pad_len],
+                 post_pad])
+            Logger.debug(str(tr))
+        # Sanity check to ensure files are correct length
+        if float(tr.stats.npts * tr.stats.delta) != length and clip:
+            Logger.info(
+                'Data for {0} are not of required length, will zero '
+                'pad'.format(tr.id))
+            # Use obspy's trim function with zero padding
+            tr = tr.trim(starttime, starttime + length, pad=True, fill_value=0,
+                         nearest_sample=True)
+            # If there is one sample too many after this remove the last one
+            # by convention
+            if len(tr.data) == (length * tr.stats.sampling_rate) + 1:
+                tr.data = tr.data[1:len(tr.data)]
+            if abs((tr.stats.sampling_rate * length) -
+                   tr.stats.npts) > tr.stats.delta:
+                raise ValueError('Data are not required length for ' +
+                                 tr.stats.station + '.' + tr.stats.channel)
+        # Replace the gaps with zeros
+        if gappy:
+            tr = _zero_pad_gaps(tr, gaps, fill_gaps=fill_gaps)
+        processed.append(tr)
+    return processed
+
+
+def _empty_trace(tr):
+    """ Empty trace with the same id, start-time and sampling-rate. """
+    return Trace(data=np.array([]), header={
+        "station": tr.stats.station, "channel": tr.stats.channel,
+        "network": tr.stats.network, "location": tr.stats.location,
+        "starttime": tr.stats.starttime,
+        "sampling_rate": tr.stats.sampling_rate})
 
 
 def _resample(tr, sampling_rate, threads=1):
@@ -194,6 +194,171 @@ int multi_decluster(float *arr, long *indices,
 }
 
 
+// Sorted-sweep declustering: same result as decluster, but O(n log n).
+// Peaks are ranked by index, the range of ranks within trig_int of each
+// peak is found by a sweep, and a Fenwick (binary-indexed) tree counts the
+// kept peaks within that range.
+typedef struct {
+    long long index;
+    long long position;
+} indexed_peak;
+
+static int compare_indexed_peaks(const void *a, const void *b){
+    long long index_a = ((const indexed_peak *) a)->index;
+    long long index_b = ((const indexed_peak *) b)->index;
+    return (index_a > index_b) - (index_a < index_b);
+}
+
+static void fenwick_add(long long *tree, long long len, long long rank){
+    for (rank += 1; rank <= len; rank += rank & -rank){
+        tree[rank] += 1;
+    }
+}
+
+static long long fenwick_sum(long long *tree, long long rank){
+    // Sum of counts for ranks less than rank
+    long long total = 0;
+    for (; rank > 0; rank -= rank & -rank){
+        total += tree[rank];
+    }
+    return total;
+}
+
+static int decluster_sweep_indexed(float *arr, indexed_peak *order,
+                                   long long len, float thresh,
+                                   long long trig_int, unsigned int *out){
+    // order must contain the indexes and positions (in arr) of the peaks
+    long long i, rank, lower = 0, upper = 0;
+    long long *ranks, *lowers, *uppers, *tree;
+
+    if (len == 0 || fabs(arr[0]) < thresh){return 0;}
+
+    ranks = (long long *) malloc(len * sizeof(long long));
+    lowers = (long long *) malloc(len * sizeof(long long));
+    uppers = (long long *) malloc(len * sizeof(long long));
+    tree = (long long *) calloc(len + 1, sizeof(long long));
+    if (ranks == NULL || lowers == NULL || uppers == NULL || tree == NULL){
+        free(ranks); free(lowers); free(uppers); free(tree);
+        return 1;
+    }
+    qsort(order, len, sizeof(indexed_peak), compare_indexed_peaks);
+    for (rank = 0; rank < len; ++rank){
+        ranks[order[rank].position] = rank;
+        // Sweep the range of ranks within trig_int of this peak
+        while (order[rank].index - order[lower].index > trig_int){
+            ++lower;
+        }
+        if (upper < rank){upper = rank;}
+        while (upper + 1 < len &&
+               order[upper + 1].index - order[rank].index <= trig_int){
+            ++upper;
+        }
+        lowers[rank] = lower;
+        uppers[rank] = upper;
+    }
+    // Take peaks from highest to lowest if no kept peak is within range
+    for (i = 0; i < len; ++i){
+        // Threshold is for absolute values
+        if (fabs(arr[i]) < thresh){
+            break;
+        }
+        rank = ranks[i];
+        if (fenwick_sum(tree, uppers[rank] + 1) ==
+                fenwick_sum(tree, lowers[rank])){
+            out[i] = 1;
+            fenwick_add(tree, len, rank);
+        }
+        else {out[i] = 0;}
+    }
+    free(ranks);
+    free(lowers);
+    free(uppers);
+    free(tree);
+    return 0;
+}
+
+int decluster_sweep_ll(float *arr, long long *indexes, long long len,
+                       float thresh, long long trig_int, unsigned int *out){
+    // Takes a sorted array and the indexes
+    long long i;
+    int ret_val;
+    indexed_peak *order = (indexed_peak *) malloc(len * sizeof(indexed_peak));
+
+    if (order == NULL){return 1;}
+    for (i = 0; i < len; ++i){
+        order[i].index = indexes[i];
+        order[i].position = i;
+    }
+    ret_val = decluster_sweep_indexed(arr, order, len, thresh, trig_int, out);
+    free(order);
+    return ret_val;
+}
+
+int multi_decluster_sweep_ll(float *arr, long long *indices,
+                             long long *lengths, int n, float *thresholds,
+                             long long trig_int, unsigned int *out,
+                             int threads){
+    int i, ret_val = 0;
+    long long * start_inds = (long long *) calloc(n, sizeof(long long));
+    long long start_ind = 0;
+
+    for (i = 0; i < n; ++i){
+        start_inds[i] = start_ind;
+        start_ind += lengths[i];
+    }
+
+    #pragma omp parallel for num_threads(threads) reduction(+:ret_val)
+    for (i = 0; i < n; ++i){
+        ret_val += decluster_sweep_ll(
+            &arr[start_inds[i]], &indices[start_inds[i]], lengths[i],
+            thresholds[i], trig_int, &out[start_inds[i]]);
+    }
+    free(start_inds);
+    return ret_val;
+}
+
+
+// Functions for longs - should be the same logic as above
+int decluster_sweep(float *arr, long *indexes, long len,
+                    float thresh, long trig_int, unsigned int *out){
+    // Takes a sorted array and the indexes
+    long i;
+    int ret_val;
+    indexed_peak *order = (indexed_peak *) malloc(len * sizeof(indexed_peak));
+
+    if (order == NULL){return 1;}
+    for (i = 0; i < len; ++i){
+        order[i].index = indexes[i];
+        order[i].position = i;
+    }
+    ret_val = decluster_sweep_indexed(arr, order, len, thresh, trig_int, out);
+    free(order);
+    return ret_val;
+}
+
+int multi_decluster_sweep(float *arr, long *indices,
+                          long *lengths, int n, float *thresholds,
+                          long trig_int, unsigned int *out, int threads){
+    int i, ret_val = 0;
+    long * start_inds = (long *) calloc(n, sizeof(long));
+    long start_ind = 0;
+
+    for (i = 0; i < n; ++i){
+        start_inds[i] = start_ind;
+        start_ind += lengths[i];
+    }
+
+    #pragma omp parallel for num_threads(threads) reduction(+:ret_val)
+    for (i = 0; i < n; ++i){
+        ret_val += decluster_sweep(
+            &arr[start_inds[i]], &indices[start_inds[i]], lengths[i],
+            thresholds[i], trig_int, &out[start_inds[i]]);
+    }
+    free(start_inds);
+    return ret_val;
+}
+
+
 int find_peaks(float *arr, long len, float thresh, unsigned int *peak_positions){
     // Find peaks in noisy data above some threshold and at-least
     // trig-int samples apart. Sets all other values in array to 0
@@ -241,4 +406,276 @@ int multi_find_peaks(float *arr, long len, int n, float *thresholds, int threads
 
     free(start_inds);
     return ret_val;
-}
\ No newline at end of file
+}
+
+
+// Fused thresholding, peak-finding and declustering of multiple arrays
+typedef struct {
+    float value;
+    long index;
+} candidate_peak;
+
+static int compare_candidates(const void *a, const void *b){
+    // Descending absolute value, then ascending index
+    float abs_a = fabsf(((const candidate_peak *) a)->value);
+    float abs_b = fabsf(((const candidate_peak *) b)->value);
+    long index_a = ((const candidate_peak *) a)->index;
+    long index_b = ((const candidate_peak *) b)->index;
+
+    if (abs_a != abs_b){return (abs_a < abs_b) - (abs_a > abs_b);}
+    return (index_a > index_b) - (index_a < index_b);
+}
+
+static float select_kth(float *arr, long len, long k){
+    // Quickselect: partially sorts arr and returns the k-th smallest value
+    long left = 0, right = len - 1, i, j;
+    float pivot, tmp;
+
+    while (left < right){
+        pivot = arr[left + (right - left) / 2];
+        i = left;
+        j = right;
+        while (i <= j){
+            while (arr[i] < pivot){++i;}
+            while (arr[j] > pivot){--j;}
+            if (i <= j){
+                tmp = arr[i];
+                arr[i] = arr[j];
+                arr[j] = tmp;
+                ++i;
+                --j;
+            }
+        }
+        if (k <= j){right = j;}
+        else if (k >= i){left = i;}
+        else {break;}
+    }
+    return arr[k];
+}
+
+static float median_abs(float *arr, long len, float *work){
+    // Median of absolute values, the mean of the central two for even len
+    long i, half = len / 2;
+    float upper, lower;
+
+    for (i = 0; i < len; ++i){
+        work[i] = fabsf(arr[i]);
+    }
+    upper = select_kth(work, len, half);
+    if (len % 2 == 1){return upper;}
+    // Values below half are all less than or equal to upper
+    lower = work[0];
+    for (i = 1; i < half; ++i){
+        if (work[i] > lower){lower = work[i];}
+    }
+    return (lower + upper) / 2;
+}
+
+static long hist_bin(double value, double lower, double scale, long n_bins){
+    // Histogram bin of value, clipped to the histogram range
+    long bin = (long) ((value - lower) * scale);
+
+    if (bin < 0){return 0;}
+    if (bin >= n_bins){return n_bins - 1;}
+    return bin;
+}
+
+static float kth_abs_approx(float *arr, long len, long k, double max_abs,
+                            long n_bins, long *coarse, long *fine){
+    // Approximate the k-th smallest absolute value from coarse, a histogram
+    // of absolute values over [0, max_abs], by histogramming the coarse bin
+    // holding it. The centre of the fine bin is returned, which is within
+    // max_abs / (2 * n_bins ** 2) of the exact value.
+    long i, bin = 0, fine_bin = 0, below = 0;
+    double width = max_abs / n_bins, fine_width = width / n_bins;
+    double scale = (width > 0) ? 1.0 / width : 0;
+    double fine_scale = (fine_width > 0) ? 1.0 / fine_width : 0;
+    double value;
+
+    while (below + coarse[bin] <= k){
+        below += coarse[bin];
+        ++bin;
+    }
+    memset(fine, 0, n_bins * sizeof(long));
+    for (i = 0; i < len; ++i){
+        value = fabs((double) arr[i]);
+        if (hist_bin(value, 0, scale, n_bins) == bin){
+            ++fine[hist_bin(value, bin * width, fine_scale, n_bins)];
+        }
+    }
+    k -= below;
+    below = 0;
+    while (below + fine[fine_bin] <= k){
+        below += fine[fine_bin];
+        ++fine_bin;
+    }
+    return (float) (bin * width + (fine_bin + 0.5) * fine_width);
+}
+
+static float median_abs_approx(float *arr, long len, long n_bins,
+                               long *hist){
+    // Approximate median of absolute values using two levels of histogram,
+    // without copying arr. hist must hold 2 * n_bins values.
+    long i, half = len / 2;
+    double max_abs = 0, scale;
+    float upper, lower;
+
+    for (i = 0; i < len; ++i){
+        if (fabs((double) arr[i]) > max_abs){max_abs = fabs((double) arr[i]);}
+    }
+    scale = (max_abs > 0) ? n_bins / max_abs : 0;
+    memset(hist, 0, n_bins * sizeof(long));
+    for (i = 0; i < len; ++i){
+        ++hist[hist_bin(fabs((double) arr[i]), 0, scale, n_bins)];
+    }
+    upper = kth_abs_approx(arr, len, half, max_abs, n_bins, hist,
+                           &hist[n_bins]);
+    if (len % 2 == 1){return upper;}
+    lower = kth_abs_approx(arr, len, half - 1, max_abs, n_bins, hist,
+                           &hist[n_bins]);
+    return (lower + upper) / 2;
+}
+
+static int row_median_abs(float *arr, long len, int approximate,
+                          long n_bins, float *median){
+    // Exact or approximate median absolute value of one array
+    float *work;
+    long *hist;
+
+    if (approximate){
+        hist = (long *) malloc(2 * n_bins * sizeof(long));
+        if (hist == NULL){return 1;}
+        *median = median_abs_approx(arr, len, n_bins, hist);
+        free(hist);
+    } else {
+        work = (float *) malloc(len * sizeof(float));
+        if (work == NULL){return 1;}
+        *median = median_abs(arr, len, work);
+        free(work);
+    }
+    return 0;
+}
+
+int multi_median_abs(float *arr, long len, int n, int approximate,
+                     long n_bins, float *medians, int threads){
+    // Median absolute value of each of n arrays of length len. If
+    // approximate is non-zero a histogram of n_bins bins, refined once, is
+    // used and the result is within max(abs(arr)) / (2 * n_bins ** 2) of
+    // the exact median.
+    int i, ret_val = 0;
+
+    #pragma omp parallel for num_threads(threads) reduction(+:ret_val)
+    for (i = 0; i < n; ++i){
+        if (len == 0){
+            medians[i] = 0;
+            continue;
+        }
+        ret_val += row_median_abs(&arr[(long) i * len], len, approximate,
+                                  n_bins, &medians[i]);
+    }
+    return ret_val;
+}
+
+static int find_peaks_fused(float *arr, long len, double *threshold,
+                            int mad, long n_bins, long trig_int,
+                            int full_peaks,
+                            long capacity, long *count, long *peak_indices,
+                            float *peak_values){
+    long i, rank, n_candidates = 0, n_kept = 0;
+    int stage;
+    float thresh, value, prev_value = 0, next_value, median;
+    float *values;
+    candidate_peak *candidates = NULL;
+    indexed_peak *order;
+    unsigned int *out;
+    int ret_val;
+
+    *count = 0;
+    if (len == 0){return 0;}
+    if (mad){
+        if (row_median_abs(arr, len, mad == 2, n_bins, &median)){return 1;}
+        *threshold = *threshold * (double) median;
+    }
+    thresh = (float) *threshold;
+    // Count, then collect, candidate peaks
+    for (stage = 0; stage < 2; ++stage){
+        prev_value = 0;
+        for (i = 0; i < len; ++i){
+            value = arr[i];
+            next_value = (i < len - 1) ? arr[i + 1] : 0;
+            if ((full_peaks && fabsf(value) >= thresh) ||
+                    (!full_peaks && fabsf(value) > thresh &&
+                     (next_value - value) * (prev_value - value) > 0)){
+                if (stage == 1){
+                    candidates[n_candidates].value = value;
+                    candidates[n_candidates].index = i;
+                }
+                ++n_candidates;
+            }
+            prev_value = value;
+        }
+        if (stage == 0){
+            if (n_candidates == 0){return 0;}
+            candidates = (candidate_peak *) malloc(
+                n_candidates * sizeof(candidate_peak));
+            if (candidates == NULL){return 1;}
+            n_candidates = 0;
+        }
+    }
+    qsort(candidates, n_candidates, sizeof(candidate_peak),
+          compare_candidates);
+    values = (float *) malloc(n_candidates * sizeof(float));
+    order = (indexed_peak *) malloc(n_candidates * sizeof(indexed_peak));
+    out = (unsigned int *) calloc(n_candidates, sizeof(unsigned int));
+    if (values == NULL || order == NULL || out == NULL){
+        free(candidates); free(values); free(order); free(out);
+        return 1;
+    }
+    for (i = 0; i < n_candidates; ++i){
+        values[i] = candidates[i].value;
+        order[i].index = candidates[i].index;
+        order[i].position = i;
+    }
+    ret_val = decluster_sweep_indexed(
+        values, order, n_candidates, thresh, trig_int, out);
+    // order is now sorted by index
+    for (rank = 0; rank < n_candidates && ret_val == 0; ++rank){
+        if (out[order[rank].position] == 1){
+            if (n_kept < capacity){
+                peak_indices[n_kept] = (long) order[rank].index;
+                peak_values[n_kept] = values[order[rank].position];
+            }
+            ++n_kept;
+        }
+    }
+    *count = n_kept;
+    free(candidates);
+    free(values);
+    free(order);
+    free(out);
+    return ret_val;
+}
+
+int multi_find_peaks_fused(float *arr, long len, int n, double *thresholds,
+                           int mad, long n_bins, long trig_int,
+                           int full_peaks, long capacity, long *counts,
+                           long *peak_indices, float *peak_values,
+                           int threads){
+    // Threshold, find peaks and decluster each of n arrays of length len.
+    // If mad is non-zero thresholds are multiplied by the median absolute
+    // value of each array, approximated with n_bins histogram bins if mad
+    // is 2 (see multi_median_abs). Peaks within trig_int (inclusive) of a larger
+    // peak are removed. Up to capacity peaks are returned for each array,
+    // counts gives the number found (which may be more than capacity).
+    int i, ret_val = 0;
+
+    #pragma omp parallel for num_threads(threads) reduction(+:ret_val)
+    for (i = 0; i < n; ++i){
+        ret_val += find_peaks_fused(
+            &arr[(long) i * len], len, &thresholds[i], mad, n_bins,
+            trig_int, full_peaks, capacity, &counts[i],
+            &peak_indices[(long) i * capacity],
+            &peak_values[(long) i * capacity]);
+    }
+    return ret_val;
+}
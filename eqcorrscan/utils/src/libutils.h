@@ -49,6 +49,14 @@
 #define ACCEPTED_DIFF 1e-10 //1e-15
 // Define difference to warn user on
 #define WARN_DIFF 1e-8 //1e-10
+// Number of correlations normalised per tile
+#ifndef NORM_TILE_LEN
+    #define NORM_TILE_LEN 4096
+#endif
+// Maximum number of plan sets kept by the FFTW plan cache
+#ifndef PLAN_CACHE_SIZE
+    #define PLAN_CACHE_SIZE 32
+#endif
 
 // find_peaks functions
 int decluster_dist_time_ll(float*, long long*, float*, long long, float,
@@ -64,20 +72,40 @@ int decluster(float*, long*, long, float, long, unsigned int*);
 
 int multi_decluster(float*, long*, long*, int, float*, long, unsigned int*, int);
 
+int decluster_sweep_ll(float*, long long*, long long, float, long long, unsigned int*);
+
+int multi_decluster_sweep_ll(float*, long long*, long long*, int, float*, long long, unsigned int*, int);
+
+int decluster_sweep(float*, long*, long, float, long, unsigned int*);
+
+int multi_decluster_sweep(float*, long*, long*, int, float*, long, unsigned int*, int);
+
 int findpeaks(float*, long, float, unsigned int*);
 
 int multi_find_peaks(float*, long, int, float*, int, unsigned int*);
 
+int multi_median_abs(float*, long, int, int, long, float*, int);
+
+int multi_find_peaks_fused(float*, long, int, double*, int, long, long, int,
+                           long, long*, long*, float*, int);
+
 // multi_corr functions
 int normxcorr_fftw_main(float*, long, long, float*, long, int, int, float*, long,
                         float*, float*, float*, fftwf_complex*, fftwf_complex*,
                         fftwf_complex*, fftwf_plan, fftwf_plan, fftwf_plan,
                         int*, int*, int, int*, int*, int);
 
+int normxcorr_fftw_chunks(
+    long, long, float*, long, int, int, float*, long, float*, float*, float*,
+    fftwf_complex*, fftwf_complex*, fftwf_complex*, fftwf_plan, fftwf_plan,
+    int*, int*, int, int*, int*, int, int*);
+
 int normxcorr_fftw_internal(
     long, long, float*, long, int, int, float*, long, long, float*, float*, float*,
     float*, fftwf_complex*, fftwf_complex*, fftwf_complex*, fftwf_plan,
-    fftwf_plan, int*, int*, int, int*, int*, int, long);
+    fftwf_plan, int*, int*, int, int*, int*, int, long, int*);
+
+int running_mean_var(float*, long, long, long, double*, double*);
 
 int normxcorr_fftw_threaded(
     float*, long, long, float*, long, float*, long, int*, int*, int*, int*);
@@ -96,6 +124,22 @@ int multi_normxcorr_fftw(
 
 int normxcorr_fftw(float*, long, long, float*, long, float*, long, int*, int*, int*, int*);
 
+int prepare_template_spectra(float*, long*, long, long, long, fftwf_complex*, float*);
+
+int multi_normxcorr_fftw_prepared(
+    fftwf_complex*, float*, long*, int*, long, long, long, float*, long, float*,
+    long, int*, int*, int, int*, int*, int);
+
+int set_fftw_planning(int);
+
+int clear_fftw_plan_cache(void);
+
+int fftw_plan_cache_len(void);
+
+int import_fftw_wisdom(char*);
+
+int export_fftw_wisdom(char*);
+
 // time_corr functions
 int normxcorr_time_threaded(float*, int, float*, int, float*, int);
 
@@ -104,3 +148,8 @@ int normxcorr_time(float*, int, float*, int, float*);
 int multi_normxcorr_time(float*, int, int, float*, int, float*);
 
 int multi_normxcorr_time_threaded(float*, int, int, float*, int, float*, int);
+
+int multi_normxcorr_time_blocked(float*, long, long, float*, long, float*, int);
+
+int multi_normxcorr_time_max(float*, long, long, float*, long, long*, long*,
+                             long, int*, float*, long*, int);
@@ -22,8 +22,211 @@
 
 
 static inline int set_ncc(
-    long t, long i, int chan, int n_chans, long template_len, long image_len,
-    float value, int *used_chans, int *pad_array, float *ncc, int stack_option);
+    long t, long out_t, long i, int chan, int n_chans, long template_len,
+    long image_len, float value, int *used_chans, int *pad_array, float *ncc,
+    int stack_option);
+
+static void running_mean_var_tile(
+    float *image, long template_len, long start, long n, double *mean,
+    double *var, int *flatline_count, int prev_flatline);
+
+// Plan cache
+/*
+  FFTW plans are expensive to create (particularly with anything other than
+  FFTW_ESTIMATE), but for a given shape they can be re-used for any arrays with
+  the same alignment via the new-array execute interface. Plans are kept here,
+  keyed on the number of templates, the fft length, the number of FFTW threads
+  and the planning flags, and persist for the lifetime of the library.
+
+  Planning is not thread-safe in FFTW, so all access to the cache (and all
+  plan creation and destruction) happens within a named critical section.
+*/
+typedef struct {
+    long n_templates;
+    long fft_len;
+    int n_threads;
+    unsigned int flags;
+    fftwf_plan pa;
+    fftwf_plan pb;
+    fftwf_plan px;
+} fftwf_plan_set;
+
+static fftwf_plan_set plan_cache[PLAN_CACHE_SIZE];
+static int plan_cache_len = 0;
+static unsigned int planning_flags = FFTW_ESTIMATE;
+static int fftw_threads_initialised = 0;
+
+static const unsigned int planning_flag_options[] = {
+    FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT, FFTW_EXHAUSTIVE};
+
+
+static void plan_with_threads(int n_threads){
+    /* Set the number of threads used for subsequent plans - must be called
+       within the planner critical section. */
+    #ifdef N_THREADS
+    if (n_threads > 1 && fftw_threads_initialised == 0){
+        fftwf_init_threads();
+        fftw_threads_initialised = 1;
+    }
+    if (fftw_threads_initialised == 1){
+        fftwf_plan_with_nthreads(n_threads);
+    }
+    #endif
+}
+
+
+static int get_fftwf_plans(
+    long n_templates, long fft_len, int n_threads, float *template_ext,
+    fftwf_complex *outa, float *image_ext, fftwf_complex *outb,
+    fftwf_complex *out, float *ccc, fftwf_plan *pa, fftwf_plan *pb,
+    fftwf_plan *px){
+  /*
+  Purpose: get forward and reverse plans for a given shape, from the cache if
+           possible.
+  Args:
+    n_templates:    Number of templates (n0)
+    fft_len:        Size for fft (n1)
+    n_threads:      Number of threads for FFTW to use within each transform
+    template_ext, outa, image_ext, outb, out, ccc:
+                    Arrays to plan with. These will be overwritten if the
+                    planning flags are anything other than FFTW_ESTIMATE.
+    pa, pb, px:     Output plans
+  Returns:
+    1 if plans are owned by the cache, 0 if the cache is full and the caller
+    must destroy the plans, -1 if planning failed.
+  */
+    int i, cached = -1;
+
+    #pragma omp critical (fftw_planner)
+    {
+        for (i = 0; i < plan_cache_len; ++i){
+            if (plan_cache[i].n_templates == n_templates &&
+                plan_cache[i].fft_len == fft_len &&
+                plan_cache[i].n_threads == n_threads &&
+                plan_cache[i].flags == planning_flags){
+                *pa = plan_cache[i].pa;
+                *pb = plan_cache[i].pb;
+                *px = plan_cache[i].px;
+                cached = 1;
+                break;
+            }
+        }
+        if (cached == -1){
+            plan_with_threads(n_threads);
+            *pa = fftwf_plan_dft_r2c_2d(n_templates, fft_len, template_ext, outa, planning_flags);
+            *pb = fftwf_plan_dft_r2c_1d(fft_len, image_ext, outb, planning_flags);
+            *px = fftwf_plan_dft_c2r_2d(n_templates, fft_len, out, ccc, planning_flags);
+            if (*pa == NULL || *pb == NULL || *px == NULL){
+                if (*pa != NULL){fftwf_destroy_plan(*pa);}
+                if (*pb != NULL){fftwf_destroy_plan(*pb);}
+                if (*px != NULL){fftwf_destroy_plan(*px);}
+            } else if (plan_cache_len < PLAN_CACHE_SIZE){
+                plan_cache[plan_cache_len].n_templates = n_templates;
+                plan_cache[plan_cache_len].fft_len = fft_len;
+                plan_cache[plan_cache_len].n_threads = n_threads;
+                plan_cache[plan_cache_len].flags = planning_flags;
+                plan_cache[plan_cache_len].pa = *pa;
+                plan_cache[plan_cache_len].pb = *pb;
+                plan_cache[plan_cache_len].px = *px;
+                plan_cache_len += 1;
+                cached = 1;
+            } else {
+                cached = 0;
+            }
+        }
+    }
+    return cached;
+}
+
+
+static void destroy_fftwf_plans(fftwf_plan pa, fftwf_plan pb, fftwf_plan px){
+    #pragma omp critical (fftw_planner)
+    {
+        fftwf_destroy_plan(pa);
+        fftwf_destroy_plan(pb);
+        fftwf_destroy_plan(px);
+    }
+}
+
+
+int set_fftw_planning(int rigor){
+  /*
+  Purpose: set the planning rigor used for new plans
+  Args:
+    rigor:  0: FFTW_ESTIMATE, 1: FFTW_MEASURE, 2: FFTW_PATIENT, 3: FFTW_EXHAUSTIVE
+  Returns:
+    0 on success, -1 if rigor is not known.
+  */
+    if (rigor < 0 || rigor > 3){
+        printf("ERROR: planning rigor %i is not known\n", rigor);
+        return -1;
+    }
+    #pragma omp critical (fftw_planner)
+    {
+        planning_flags = planning_flag_options[rigor];
+    }
+    return 0;
+}
+
+
+int clear_fftw_plan_cache(void){
+  /*
+  Purpose: destroy all cached plans. Must not be called while correlations
+           are running.
+  Returns:
+    The number of plan sets destroyed.
+  */
+    int i, n_cleared;
+
+    #pragma omp critical (fftw_planner)
+    {
+        for (i = 0; i < plan_cache_len; ++i){
+            fftwf_destroy_plan(plan_cache[i].pa);
+            fftwf_destroy_plan(plan_cache[i].pb);
+            fftwf_destroy_plan(plan_cache[i].px);
+        }
+        n_cleared = plan_cache_len;
+        plan_cache_len = 0;
+    }
+    return n_cleared;
+}
+
+
+int fftw_plan_cache_len(void){
+    return plan_cache_len;
+}
+
+
+int import_fftw_wisdom(char *filename){
+  /*
+  Purpose: import accumulated FFTW wisdom from a file.
+  Returns:
+    1 on success, 0 on failure (as per FFTW)
+  */
+    int ret;
+
+    #pragma omp critical (fftw_planner)
+    {
+        ret = fftwf_import_wisdom_from_filename(filename);
+    }
+    return ret;
+}
+
+
+int export_fftw_wisdom(char *filename){
+  /*
+  Purpose: export accumulated FFTW wisdom to a file.
+  Returns:
+    1 on success, 0 on failure (as per FFTW)
+  */
+    int ret;
+
+    #pragma omp critical (fftw_planner)
+    {
+        ret = fftwf_export_wisdom_to_filename(filename);
+    }
+    return ret;
+}
 
 // Functions
 
@@ -48,26 +251,37 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
   */
     long N2 = fft_len / 2 + 1;
     long i, t, startind;
-    int status = 0;
+    int status = 0, cached, n_threads = 1;
     int flatline_count = 0, unused_corr = 0;
     double mean, stdev, old_mean, new_samp, old_samp, var=0.0, sum=0.0;
     float * norm_sums = (float *) calloc(n_templates, sizeof(float));
-    float * template_ext = (float *) calloc(fft_len * n_templates, sizeof(float));
-    float * image_ext = (float *) calloc(fft_len, sizeof(float));
+    float * template_ext = (float *) fftwf_malloc(sizeof(float) * fft_len * n_templates);
+    float * image_ext = (float *) fftwf_malloc(sizeof(float) * fft_len);
     float * ccc = (float *) fftwf_malloc(sizeof(float) * fft_len * n_templates);
     fftwf_complex * outa = (fftwf_complex *) fftwf_malloc(sizeof(fftwf_complex) * N2 * n_templates);
     fftwf_complex * outb = (fftwf_complex *) fftwf_malloc(sizeof(fftwf_complex) * N2);
     fftwf_complex * out = (fftwf_complex *) fftwf_malloc(sizeof(fftwf_complex) * N2 * n_templates);
-    // Initialize threads
+    fftwf_plan pa, pb, px;
     #ifdef N_THREADS
-        fftwf_init_threads();
-        fftwf_plan_with_nthreads(N_THREADS);
+        n_threads = N_THREADS;
     #endif
     // Plan
-
-    fftwf_plan pa = fftwf_plan_dft_r2c_2d(n_templates, fft_len, template_ext, outa, FFTW_ESTIMATE);
-    fftwf_plan pb = fftwf_plan_dft_r2c_1d(fft_len, image_ext, outb, FFTW_ESTIMATE);
-    fftwf_plan px = fftwf_plan_dft_c2r_2d(n_templates, fft_len, out, ccc, FFTW_ESTIMATE);
+    cached = get_fftwf_plans(n_templates, fft_len, n_threads, template_ext, outa,
+                             image_ext, outb, out, ccc, &pa, &pb, &px);
+    if (cached < 0){
+        printf("ERROR: Could not create FFTW plans\n");
+        fftwf_free(out);
+        fftwf_free(outa);
+        fftwf_free(outb);
+        fftwf_free(ccc);
+        fftwf_free(template_ext);
+        fftwf_free(image_ext);
+        free(norm_sums);
+        return -1;
+    }
+    // Initialise to zero
+    memset(template_ext, 0, (size_t) fft_len * n_templates * sizeof(float));
+    memset(image_ext, 0, (size_t) fft_len * sizeof(float));
 
     // zero padding - and flip template
     for (t = 0; t < n_templates; ++t){
@@ -84,9 +298,9 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
     //  Compute ffts of template and image
     #pragma omp parallel sections
     {
-        {fftwf_execute(pa); }
+        {fftwf_execute_dft_r2c(pa, template_ext, outa); }
         #pragma omp section
-        {fftwf_execute(pb); }
+        {fftwf_execute_dft_r2c(pb, image_ext, outb); }
     }
     //  Compute dot product
     for (t = 0; t < n_templates; ++t){
@@ -97,7 +311,7 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
         }
     }
     //  Compute inverse fft
-    fftwf_execute(px);
+    fftwf_execute_dft_c2r(px, out, ccc);
     //  Procedures for normalisation
     // Compute starting mean, will update this
     for (i=0; i < template_len; ++i){
@@ -115,7 +329,7 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
     if (var >= ACCEPTED_DIFF) {
         for (t = 0; t < n_templates; ++t){
             float c = ((ccc[(t * fft_len) + startind] / (fft_len * n_templates)) - norm_sums[t] * mean) / stdev;
-            status += set_ncc(t, 0, 0, 1, template_len, image_len, (float) c, used_chans, pad_array, ncc, 0);
+            status += set_ncc(t, t, 0, 0, 1, template_len, image_len, (float) c, used_chans, pad_array, ncc, 0);
         }
         if (var <= WARN_DIFF){
             variance_warning[0] = 1;
@@ -140,7 +354,7 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
         if (var >= ACCEPTED_DIFF && flatline_count < template_len - 1 && stdev * mean >= ACCEPTED_DIFF) {
             for (t = 0; t < n_templates; ++t){
                 float c = ((ccc[(t * fft_len) + i + startind] / (fft_len * n_templates)) - norm_sums[t] * mean ) / stdev;
-                status += set_ncc(t, i, 0, 1, template_len, image_len, (float) c, used_chans, pad_array, ncc, 0);
+                status += set_ncc(t, t, i, 0, 1, template_len, image_len, (float) c, used_chans, pad_array, ncc, 0);
             }
             if (var <= WARN_DIFF){
                 variance_warning[0] += 1;
@@ -149,20 +363,17 @@ int normxcorr_fftw_threaded(float *templates, long template_len, long n_template
     }
     missed_corr[0] = unused_corr;
     //  Clean up
-    fftwf_destroy_plan(pa);
-    fftwf_destroy_plan(pb);
-    fftwf_destroy_plan(px);
+    if (cached == 0){
+        destroy_fftwf_plans(pa, pb, px);
+    }
 
     fftwf_free(out);
     fftwf_free(outa);
     fftwf_free(outb);
     fftwf_free(ccc);
-
-    fftwf_cleanup();
-    fftwf_cleanup_threads();
-
-    free(template_ext);
-    free(image_ext);
+    fftwf_free(template_ext);
+    fftwf_free(image_ext);
+    free(norm_sums);
 
     return status;
 }
@@ -190,8 +401,9 @@ int normxcorr_fftw(float *templates, long template_len, long n_templates,
     for that function. We have taken this outside the main function because creating plans
     is not thread-safe and we want to call the main function from within an OpenMP loop.
   */
-    int status = 0;
+    int status = 0, cached;
     long N2 = fft_len / 2 + 1;
+    fftwf_plan pa, pb, px;
     // All memory allocated with `fftw_malloc` to ensure 16-byte aligned
     float * template_ext = (float*) fftwf_malloc(fft_len * n_templates * sizeof(float));
     float * image_ext = (float*) fftwf_malloc(fft_len * sizeof(float));
@@ -200,9 +412,18 @@ int normxcorr_fftw(float *templates, long template_len, long n_templates,
     fftwf_complex * outb = (fftwf_complex*) fftwf_malloc(N2 * sizeof(fftwf_complex));
     fftwf_complex * out = (fftwf_complex*) fftwf_malloc(N2 * n_templates * sizeof(fftwf_complex));
     // Plan
-    fftwf_plan pa = fftwf_plan_dft_r2c_2d(n_templates, fft_len, template_ext, outa, FFTW_ESTIMATE);
-    fftwf_plan pb = fftwf_plan_dft_r2c_1d(fft_len, image_ext, outb, FFTW_ESTIMATE);
-    fftwf_plan px = fftwf_plan_dft_c2r_2d(n_templates, fft_len, out, ccc, FFTW_ESTIMATE);
+    cached = get_fftwf_plans(n_templates, fft_len, 1, template_ext, outa,
+                             image_ext, outb, out, ccc, &pa, &pb, &px);
+    if (cached < 0){
+        printf("ERROR: Could not create FFTW plans\n");
+        fftwf_free(out);
+        fftwf_free(outa);
+        fftwf_free(outb);
+        fftwf_free(ccc);
+        fftwf_free(template_ext);
+        fftwf_free(image_ext);
+        return -1;
+    }
 
     // Initialise to zero
     memset(template_ext, 0, (size_t) fft_len * n_templates * sizeof(float));
@@ -215,10 +436,10 @@ int normxcorr_fftw(float *templates, long template_len, long n_templates,
         fft_len, template_ext, image_ext, ccc, outa, outb, out, pa, pb, px,
         used_chans, pad_array, 1, variance_warning, missed_corr, 0);
 
-    // free memory and plans
-    fftwf_destroy_plan(pa);
-    fftwf_destroy_plan(pb);
-    fftwf_destroy_plan(px);
+    // free memory and any plans not owned by the cache
+    if (cached == 0){
+        destroy_fftwf_plans(pa, pb, px);
+    }
 
     fftwf_free(out);
     fftwf_free(outa);
@@ -227,9 +448,6 @@ int normxcorr_fftw(float *templates, long template_len, long n_templates,
     fftwf_free(template_ext);
     fftwf_free(image_ext);
 
-    fftwf_cleanup();
-    fftwf_cleanup_threads();
-
     return status;
 }
 
@@ -278,7 +496,7 @@ int normxcorr_fftw_main(
     missed_corr:    Pointer to array to store warnings for unused correlations
     stack_option:   Whether to stack correlograms (1) or leave as individual channels (0),
   */
-    long i, t, chunk, n_chunks, chunk_len, startind, step_len;
+    long i, t;
     int status = 0;
     float * norm_sums = (float *) calloc(n_templates, sizeof(float));
 
@@ -304,6 +522,36 @@ int normxcorr_fftw_main(
     //  Compute fft of template
     fftwf_execute_dft_r2c(pa, template_ext, outa);
 
+    status = normxcorr_fftw_chunks(
+        template_len, n_templates, image, image_len, chan, n_chans, ncc,
+        fft_len, image_ext, norm_sums, ccc, outa, outb, out, pb, px,
+        used_chans, pad_array, num_threads, variance_warning, missed_corr,
+        stack_option, NULL);
+    free(norm_sums);
+    return status;
+}
+
+int normxcorr_fftw_chunks(
+    long template_len, long n_templates, float *image, long image_len,
+    int chan, int n_chans, float *ncc, long fft_len, float *image_ext,
+    float *norm_sums, float *ccc, fftwf_complex *outa, fftwf_complex *outb,
+    fftwf_complex *out, fftwf_plan pb, fftwf_plan px, int *used_chans,
+    int *pad_array, int num_threads, int *variance_warning, int *missed_corr,
+    int stack_option, int *template_index) {
+  /*
+  Purpose: loop over chunks of the image for a single channel, given the
+           transformed templates.
+  Args:
+    As for normxcorr_fftw_main, except:
+    norm_sums:      Sums of the normalised templates, n_templates long
+    outa:           Template spectra (must be computed), n_templates x
+                    (fft_len / 2 + 1) long
+    template_index: Position of each template in ncc, n_templates long. Use
+                    NULL if templates are in the same order as ncc.
+  */
+    long i, chunk, n_chunks, chunk_len, startind, step_len;
+    int status = 0;
+
     if (fft_len >= image_len){
         n_chunks = 1;
         chunk_len = image_len;
@@ -323,12 +571,11 @@ int normxcorr_fftw_main(
         for (i = 0; i < chunk_len; ++i){image_ext[i] = image[startind + i];}
         status += normxcorr_fftw_internal(
             template_len, n_templates, &image[startind], chunk_len, chan,
-            n_chans, &ncc[0], image_len, fft_len, template_ext,
+            n_chans, &ncc[0], image_len, fft_len, NULL,
             image_ext, norm_sums, ccc, outa, outb, out, pb, px, used_chans,
             pad_array, num_threads, variance_warning, missed_corr,
-            stack_option, startind);
+            stack_option, startind, template_index);
     }
-    free(norm_sums);
     return status;
 }
 
@@ -339,7 +586,7 @@ int normxcorr_fftw_internal(
     fftwf_complex *outa, fftwf_complex *outb, fftwf_complex *out,
     fftwf_plan pb, fftwf_plan px, int *used_chans, int *pad_array,
     int num_threads, int *variance_warning, int *missed_corr,
-    int stack_option, long offset)
+    int stack_option, long offset, int *template_index)
 {
   /*
     Internal function for chunking cross-correlations
@@ -377,13 +624,16 @@ int normxcorr_fftw_internal(
     missed_corr:    Pointer to array to store warnings for unused correlations
     stack_option:   Whether to stacked correlograms (1) or leave as individual channels (0),
     offset:         Offset for position of chunk in ncc (for a pad of zero).
+    template_index: Position of each template in ncc, n_templates long. Use
+                    NULL if templates are in the same order as ncc.
   */
-    long i, t, startind;
+    long i, j, t, startind, tile_start, tile_len, first;
     long N2 = fft_len / 2 + 1;
-    int status = 0, unused_corr = 0;
-    int * flatline_count = (int *) calloc(image_len - template_len + 1, sizeof(int));
+    long n_corr = image_len - template_len + 1;
+    long max_tile_len = (n_corr < NORM_TILE_LEN) ? n_corr : NORM_TILE_LEN;
+    int status = 0, unused_corr = 0, prev_flatline = 0;
+    int *flatline_count;
     double *mean, *var;
-    double new_samp, old_samp, sum=0.0;
 
     // Compute fft of image
     fftwf_execute_dft_r2c(pb, image_ext, outb);
@@ -400,112 +650,205 @@ int normxcorr_fftw_internal(
 
     //  Compute inverse fft
     fftwf_execute_dft_c2r(px, out, ccc);
- 
-    // Allocate mean and var arrays
-    mean = (double*) malloc((image_len - template_len + 1) * sizeof(double));
+
+    // Allocate mean, var and flatline arrays for one tile
+    mean = (double*) malloc(max_tile_len * sizeof(double));
     if (mean == NULL) {
         printf("ERROR: Error allocating mean in normxcorr_fftw_internal\n");
-        free(norm_sums);
         return 1;
     }
-    var = (double*) malloc((image_len - template_len + 1) * sizeof(double));
+    var = (double*) malloc(max_tile_len * sizeof(double));
     if (var == NULL) {
         printf("ERROR: Error allocating var in normxcorr_fftw_internal\n");
-        free(norm_sums);
         free(mean);
         return 1;
     }
-    
-    // Procedures for normalisation
-    // Compute starting mean, will update this
-    sum = 0.0;
-    for (i=0; i < template_len; ++i){
-        sum += (double) image[i];
-    }
-    mean[0] = sum / template_len;
-
-    // Compute starting standard deviation
-    sum = 0.0;
-    for (i=0; i < template_len; ++i){
-        sum += pow((double) image[i] - mean[0], 2) / (template_len);
+    flatline_count = (int*) malloc(max_tile_len * sizeof(int));
+    if (flatline_count == NULL) {
+        printf("ERROR: Error allocating flatline_count in normxcorr_fftw_internal\n");
+        free(mean);
+        free(var);
+        return 1;
     }
-    var[0] = sum;
 
     // Used for centering - taking only the valid part of the cross-correlation
     startind = template_len - 1;
-    if (var[0] >= ACCEPTED_DIFF) {
-        double stdev = sqrt(var[0]);
-        for (t = 0; t < n_templates; ++t){
-            double c = ((ccc[(t * fft_len) + startind] / (fft_len * n_templates)) - norm_sums[t] * mean[0]);
-            c /= stdev;
-            status += set_ncc(t, offset, chan, n_chans, template_len, ncc_len,
-                              (float) c, used_chans, pad_array, ncc, stack_option);
+
+    // Procedures for normalisation, computed in tiles to bound memory use and
+    // the accumulation of rounding errors in the running mean and variance.
+    for (tile_start = 0; tile_start < n_corr; tile_start += max_tile_len){
+        tile_len = (n_corr - tile_start < max_tile_len) ? n_corr - tile_start : max_tile_len;
+        running_mean_var_tile(image, template_len, tile_start, tile_len, mean,
+                              var, flatline_count, prev_flatline);
+        prev_flatline = flatline_count[tile_len - 1];
+
+        first = 0;
+        if (tile_start == 0){
+            // The first correlation does not check flatlines
+            if (var[0] >= ACCEPTED_DIFF) {
+                double stdev = sqrt(var[0]);
+                for (t = 0; t < n_templates; ++t){
+                    double c = ((ccc[(t * fft_len) + startind] / (fft_len * n_templates)) - norm_sums[t] * mean[0]);
+                    c /= stdev;
+                    status += set_ncc(t, (template_index == NULL) ? t : template_index[t], offset, chan, n_chans, template_len, ncc_len,
+                                      (float) c, used_chans, pad_array, ncc, stack_option);
+                }
+                if (var[0] <= WARN_DIFF){
+                    variance_warning[0] = 1;
+                }
+            } else {
+                unused_corr += 1;
+            }
+            first = 1;
         }
-        if (var[0] <= WARN_DIFF){
-            variance_warning[0] = 1;
+
+        // Center and divide by length to generate scaled convolution
+        #pragma omp parallel for reduction(+:status,unused_corr) num_threads(num_threads) private(t, i)
+        for(j = first; j < tile_len; ++j){
+            i = tile_start + j;
+            if (var[j] >= ACCEPTED_DIFF && flatline_count[j] < template_len - 1) {
+                double stdev = sqrt(var[j]);
+                double meanstd = fabs(mean[j] * stdev);
+                if (meanstd >= ACCEPTED_DIFF){
+                    for (t = 0; t < n_templates; ++t){
+                        double c = ((ccc[(t * fft_len) + i + startind] / (fft_len * n_templates)) - norm_sums[t] * mean[j]);
+                        c /= stdev;
+                        status += set_ncc(t, (template_index == NULL) ? t : template_index[t], i + offset, chan, n_chans, template_len,
+                                          ncc_len, (float) c, used_chans,
+                                          pad_array, ncc, stack_option);
+                    }
+                }
+                else {
+                    unused_corr += 1;
+                }
+                if (var[j] <= WARN_DIFF){
+                    variance_warning[0] += 1;
+                }
+            } else {
+                unused_corr += 1;
+            }
         }
+    }
+    missed_corr[0] += unused_corr;
+
+    //  Clean up
+    free(mean);
+    free(var);
+    free(flatline_count);
+    return status;
+}
+
+static void running_mean_var_tile(
+    float *image, long template_len, long start, long n, double *mean,
+    double *var, int *flatline_count, int prev_flatline){
+  /*
+  Purpose: compute the running mean and (population) variance of windows of an
+           image for one tile.
+  Args:
+    image:          Image to compute statistics for
+    template_len:   Window length
+    start:          Index of the first window in the tile
+    n:              Number of windows in the tile
+    mean:           Output, must be n long
+    var:            Output, must be n long
+    flatline_count: Output number of repeated samples at the end of each window,
+                    must be n long
+    prev_flatline:  Flatline count for the window before start (ignored if
+                    start is 0)
+  Notes:
+    The first window of the tile is computed directly using Welford's
+    algorithm, and subsequent windows are updated using the sliding-window
+    form of Welford's update.  Re-anchoring at the start of every tile stops
+    rounding errors accumulating over long images.
+  */
+    long i;
+    double delta, new_samp, old_samp, m = 0.0, m2 = 0.0;
+
+    for (i = 0; i < template_len; ++i){
+        new_samp = (double) image[start + i];
+        delta = new_samp - m;
+        m += delta / (i + 1);
+        m2 += delta * (new_samp - m);
+    }
+    mean[0] = m;
+    var[0] = m2 / template_len;
+    if (start > 0 && image[start + template_len - 1] == image[start + template_len - 2]){
+        flatline_count[0] = prev_flatline + 1;
     } else {
-        unused_corr += 1;
+        flatline_count[0] = 0;
     }
 
-    // pre-compute the mean and var so we can parallelise the calculation
-    for(i = 1; i < (image_len - template_len + 1); ++i){
+    for (i = 1; i < n; ++i){
         // Need to cast to double otherwise we end up with annoying floating
         // point errors when the variance is massive - collecting fp errors.
-        new_samp = (double) image[i + template_len - 1];
-        old_samp = (double) image[i - 1];
+        new_samp = (double) image[start + i + template_len - 1];
+        old_samp = (double) image[start + i - 1];
         mean[i] = mean[i - 1] + (new_samp - old_samp) / template_len;
         var[i] = var[i - 1] + (new_samp - old_samp) * (new_samp - mean[i] + old_samp - mean[i - 1]) / (template_len);
-        if (new_samp == (double) image[i + template_len - 2]) {
+        if (new_samp == (double) image[start + i + template_len - 2]) {
             flatline_count[i] = flatline_count[i - 1] + 1;
         }
         else {
             flatline_count[i] = 0;
         }
     }
+}
 
-    // Center and divide by length to generate scaled convolution
-    #pragma omp parallel for reduction(+:status,unused_corr) num_threads(num_threads) private(t)
-    for(i = 1; i < (image_len - template_len + 1); ++i){
-        if (var[i] >= ACCEPTED_DIFF && flatline_count[i] < template_len - 1) {
-            double stdev = sqrt(var[i]);
-            double meanstd = fabs(mean[i] * stdev);
-            if (meanstd >= ACCEPTED_DIFF){
-                for (t = 0; t < n_templates; ++t){
-                    double c = ((ccc[(t * fft_len) + i + startind] / (fft_len * n_templates)) - norm_sums[t] * mean[i]);
-                    c /= stdev;
-                    status += set_ncc(t, i + offset, chan, n_chans, template_len,
-                                      ncc_len, (float) c, used_chans,
-                                      pad_array, ncc, stack_option);
-                }
-            }
-            else {
-                unused_corr += 1;
-            }
-            if (var[i] <= WARN_DIFF){
-                variance_warning[0] += 1;
-            }
-        } else {
-            unused_corr += 1;
-        }
-    }
-    missed_corr[0] += unused_corr;
+int running_mean_var(float *image, long image_len, long template_len,
+                     long tile_len, double *mean, double *var){
+  /*
+  Purpose: compute the running mean and (population) variance of all windows
+           of an image using the same tiled routine used for normalisation of
+           correlations.
+  Args:
+    image:          Image to compute statistics for
+    image_len:      Length of image
+    template_len:   Window length
+    tile_len:       Number of windows to compute per tile, uses NORM_TILE_LEN
+                    if <= 0
+    mean:           Output, must be image_len - template_len + 1 long
+    var:            Output, must be image_len - template_len + 1 long
+  */
+    long tile_start, n;
+    long n_corr = image_len - template_len + 1;
+    int prev_flatline = 0;
+    int *flatline_count;
 
-    //  Clean up
-    free(mean);
-    free(var);
+    if (n_corr <= 0){
+        printf("ERROR: window length %ld is longer than image %ld\n", template_len, image_len);
+        return -1;
+    }
+    if (tile_len <= 0){
+        tile_len = NORM_TILE_LEN;
+    }
+    flatline_count = (int*) malloc(tile_len * sizeof(int));
+    if (flatline_count == NULL){
+        printf("ERROR: Error allocating flatline_count in running_mean_var\n");
+        return -1;
+    }
+    for (tile_start = 0; tile_start < n_corr; tile_start += tile_len){
+        n = (n_corr - tile_start < tile_len) ? n_corr - tile_start : tile_len;
+        running_mean_var_tile(image, template_len, tile_start, n,
+                              &mean[tile_start], &var[tile_start],
+                              flatline_count, prev_flatline);
+        prev_flatline = flatline_count[n - 1];
+    }
     free(flatline_count);
-    return status;
+    return 0;
 }
 
 static inline int set_ncc(
-    long t, long i, int chan, int n_chans, long template_len, long image_len,
-    float value, int *used_chans, int *pad_array, float *ncc, int stack_option){
-
+    long t, long out_t, long i, int chan, int n_chans, long template_len,
+    long image_len, float value, int *used_chans, int *pad_array, float *ncc,
+    int stack_option){
+    /*
+    t is the index of the template in used_chans and pad_array, out_t is the
+    index of the template in ncc (these differ for sparse layouts).
+    */
     int status = 0;
 
     if (used_chans[t] && (i >= pad_array[t])) {
-        size_t ncc_index = (t * n_chans * ((size_t) image_len - template_len + 1)) +
+        size_t ncc_index = (out_t * n_chans * ((size_t) image_len - template_len + 1)) +
             (chan * ((size_t) image_len - template_len + 1) + i - pad_array[t]);
 
         if (isnanf(value)) {
@@ -582,7 +925,7 @@ int multi_normxcorr_fftw(float *templates, long n_templates, long template_len,
                          int stack_option)
     {
     int i, chan, n_chans, num_threads_outer=1;
-    int r = 0;
+    int r = 0, cached;
     size_t N2 = (size_t) fft_len / 2 + 1;
     float **template_ext = NULL;
     float **image_ext = NULL;
@@ -604,15 +947,9 @@ int multi_normxcorr_fftw(float *templates, long n_templates, long template_len,
         printf("WARNING\tMULTI_NORMXCORR_FFTW\tSetting inner threading to %i and outer threading to 1\n", num_threads_inner);
         num_threads_outer = 1;
     }
-    if (num_threads_inner > 1) {
-        /* initialise FFTW threads */
-        fftwf_init_threads();
-        fftwf_plan_with_nthreads(num_threads_inner);
-
-        if (num_threads_outer > 1) {
-            /* explicitly enable nested OpenMP loops */
-            omp_set_nested(1);
-        }
+    if (num_threads_inner > 1 && num_threads_outer > 1) {
+        /* explicitly enable nested OpenMP loops */
+        omp_set_nested(1);
     }
 
     /* warn if the total number of threads is higher than the number of cores */
@@ -728,10 +1065,17 @@ int multi_normxcorr_fftw(float *templates, long n_templates, long template_len,
         }
     }
 
-    // We create the plans here since they are not thread safe.
-    pa = fftwf_plan_dft_r2c_2d(n_templates, fft_len, template_ext[0], outa[0], FFTW_ESTIMATE);
-    pb = fftwf_plan_dft_r2c_1d(fft_len, image_ext[0], outb[0], FFTW_ESTIMATE);
-    px = fftwf_plan_dft_c2r_2d(n_templates, fft_len, out[0], ccc[0], FFTW_ESTIMATE);
+    // We get the plans here since planning is not thread safe. Plans are
+    // re-used from the cache for repeated shapes.
+    cached = get_fftwf_plans(n_templates, fft_len, num_threads_inner,
+                             template_ext[0], outa[0], image_ext[0], outb[0],
+                             out[0], ccc[0], &pa, &pb, &px);
+    if (cached < 0) {
+        printf("Error creating FFTW plans\n");
+        free(results);
+        free_fftwf_arrays(num_threads_outer, template_ext, image_ext, ccc, outa, outb, out);
+        return -1;
+    }
 
     /* loop over the channels */
     /* #pragma omp parallel for num_threads(num_threads_outer) */
@@ -789,13 +1133,212 @@ int multi_normxcorr_fftw(float *templates, long n_templates, long template_len,
     free(results);
     /* free fftw memory */
     free_fftwf_arrays(num_threads_outer, template_ext, image_ext, ccc, outa, outb, out);
-    fftwf_destroy_plan(pa);
-    fftwf_destroy_plan(pb);
-    fftwf_destroy_plan(px);
-    if (num_threads_inner > 1) {
-        fftwf_cleanup_threads();
+    if (cached == 0) {
+        destroy_fftwf_plans(pa, pb, px);
     }
-    fftwf_cleanup();
 
     return r;
 }
+
+
+int prepare_template_spectra(float *templates, long *chan_offsets, long template_len,
+                             long n_channels, long fft_len,
+                             fftwf_complex *template_spectra, float *norm_sums)
+    {
+  /*
+  Purpose: compute the spectra of flipped, normalised templates for later
+           re-use by multi_normxcorr_fftw_prepared.
+  Args:
+    templates:          Normalised templates, one row of template_len per
+                        template, with the rows for each channel contiguous.
+    chan_offsets:       Index of the first row for each channel, n_channels + 1
+                        long, the last element is the total number of rows.
+    template_len:       Length of templates
+    n_channels:         Number of channels
+    fft_len:            Size for fft
+    template_spectra:   Output, must be n_rows x (fft_len / 2 + 1)
+    norm_sums:          Output sums of normalised templates, must be n_rows
+  Notes:
+    Channels may have different numbers of rows: the spectra for each channel
+    are computed using plans for that number of rows.
+  */
+    long i, t, chan, n_rows, max_rows = 0;
+    int cached = 0, status = 0;
+    size_t N2 = (size_t) fft_len / 2 + 1;
+    float *template_ext, *image_ext, *ccc;
+    fftwf_complex *outa, *outb, *out;
+    fftwf_plan pa, pb, px;
+
+    for (chan = 0; chan < n_channels; ++chan){
+        n_rows = chan_offsets[chan + 1] - chan_offsets[chan];
+        max_rows = (n_rows > max_rows) ? n_rows : max_rows;
+    }
+    if (max_rows == 0){
+        return 0;
+    }
+    template_ext = (float*) fftwf_malloc((size_t) fft_len * max_rows * sizeof(float));
+    image_ext = (float*) fftwf_malloc(fft_len * sizeof(float));
+    ccc = (float*) fftwf_malloc((size_t) fft_len * max_rows * sizeof(float));
+    outa = (fftwf_complex*) fftwf_malloc(N2 * max_rows * sizeof(fftwf_complex));
+    outb = (fftwf_complex*) fftwf_malloc(N2 * sizeof(fftwf_complex));
+    out = (fftwf_complex*) fftwf_malloc(N2 * max_rows * sizeof(fftwf_complex));
+
+    if (template_ext == NULL || image_ext == NULL || ccc == NULL ||
+        outa == NULL || outb == NULL || out == NULL){
+        printf("Error allocating memory in prepare_template_spectra\n");
+        status = -1;
+    }
+
+    for (chan = 0; chan < n_channels && status == 0; ++chan){
+        float *chan_templates = &templates[(size_t) chan_offsets[chan] * template_len];
+        float *chan_norm_sums = &norm_sums[chan_offsets[chan]];
+
+        n_rows = chan_offsets[chan + 1] - chan_offsets[chan];
+        if (n_rows == 0){
+            continue;
+        }
+        cached = get_fftwf_plans(n_rows, fft_len, 1, template_ext, outa,
+                                 image_ext, outb, out, ccc, &pa, &pb, &px);
+        if (cached < 0){
+            printf("Error creating FFTW plans\n");
+            status = -1;
+            break;
+        }
+        memset(template_ext, 0, (size_t) fft_len * n_rows * sizeof(float));
+        for (t = 0; t < n_rows; ++t){
+            chan_norm_sums[t] = 0.0;
+            for (i = 0; i < template_len; ++i){
+                template_ext[(t * fft_len) + i] = chan_templates[((t + 1) * template_len) - (i + 1)];
+                chan_norm_sums[t] += chan_templates[(t * template_len) + i];
+            }
+        }
+        // Transform into aligned memory, then copy out
+        fftwf_execute_dft_r2c(pa, template_ext, outa);
+        memcpy(&template_spectra[(size_t) chan_offsets[chan] * N2], outa,
+               N2 * n_rows * sizeof(fftwf_complex));
+        if (cached == 0){
+            destroy_fftwf_plans(pa, pb, px);
+        }
+    }
+
+    fftwf_free(template_ext);
+    fftwf_free(image_ext);
+    fftwf_free(ccc);
+    fftwf_free(outa);
+    fftwf_free(outb);
+    fftwf_free(out);
+
+    return status;
+}
+
+
+int multi_normxcorr_fftw_prepared(fftwf_complex *template_spectra, float *norm_sums,
+                                  long *chan_offsets, int *template_index,
+                                  long n_templates, long template_len, long n_channels,
+                                  float *image, long image_len, float *ncc, long fft_len,
+                                  int *used_chans, int *pad_array, int num_threads_inner,
+                                  int *variance_warning, int *missed_corr, int stack_option)
+    {
+  /*
+  Purpose: multi-channel normalised cross-correlation using template spectra
+           pre-computed by prepare_template_spectra. Only the image transform,
+           the spectral product and the inverse transform are computed.
+  Args:
+    template_spectra:   Output of prepare_template_spectra
+    norm_sums:          Output of prepare_template_spectra
+    chan_offsets:       Index of the first row for each channel, n_channels + 1
+                        long.
+    template_index:     Index of the template (in ncc) for each row
+    n_templates:        Number of templates in ncc
+    used_chans:         Whether each row is used, n_rows long
+    pad_array:          Pad for each row, n_rows long
+    Others as for multi_normxcorr_fftw
+  Notes:
+    Channels only need rows for the templates that use them (a sparse layout),
+    so the cost of correlation scales with the number of (template, channel)
+    pairs rather than n_templates x n_channels.
+  */
+    long i, chan, n_chans, n_rows, max_rows = 0;
+    int cached, result;
+    int r = 0;
+    size_t N2 = (size_t) fft_len / 2 + 1;
+    float *template_ext = NULL, *image_ext, *ccc;
+    fftwf_complex *outa = NULL, *outb, *out;
+    fftwf_plan pa, pb, px;
+
+    #ifndef N_THREADS
+    /* threading/OpenMP is disabled */
+    num_threads_inner = 1;
+    #endif
+
+    if (stack_option > 1) {
+        printf("ERROR: stack_option %i is not supported\n", stack_option);
+        return -1;
+    }
+    for (i = 0; i < n_channels; ++i){
+        n_rows = chan_offsets[i + 1] - chan_offsets[i];
+        max_rows = (n_rows > max_rows) ? n_rows : max_rows;
+    }
+    if (max_rows == 0){
+        return 0;
+    }
+    image_ext = (float*) fftwf_malloc(fft_len * sizeof(float));
+    ccc = (float*) fftwf_malloc((size_t) fft_len * max_rows * sizeof(float));
+    outb = (fftwf_complex*) fftwf_malloc(N2 * sizeof(fftwf_complex));
+    out = (fftwf_complex*) fftwf_malloc(N2 * max_rows * sizeof(fftwf_complex));
+    /* Template arrays are only needed to create plans */
+    template_ext = (float*) fftwf_malloc((size_t) fft_len * max_rows * sizeof(float));
+    outa = (fftwf_complex*) fftwf_malloc(N2 * max_rows * sizeof(fftwf_complex));
+
+    if (image_ext == NULL || ccc == NULL || outb == NULL || out == NULL ||
+        template_ext == NULL || outa == NULL){
+        printf("Error allocating memory in multi_normxcorr_fftw_prepared\n");
+        r = -1;
+    }
+
+    for (i = 0; i < n_channels && r >= 0; ++i){
+        size_t row = chan_offsets[i];
+
+        n_rows = chan_offsets[i + 1] - chan_offsets[i];
+        if (n_rows == 0){
+            continue;
+        }
+        cached = get_fftwf_plans(n_rows, fft_len, num_threads_inner,
+                                 template_ext, outa, image_ext, outb, out,
+                                 ccc, &pa, &pb, &px);
+        if (cached < 0){
+            printf("Error creating FFTW plans\n");
+            r = -1;
+            break;
+        }
+        if (stack_option == 1){
+            chan = 0;
+            n_chans = 1;
+        } else {
+            chan = i;
+            n_chans = n_channels;
+        }
+        result = normxcorr_fftw_chunks(
+            template_len, n_rows, &image[(size_t) image_len * i],
+            image_len, chan, n_chans, ncc, fft_len, image_ext,
+            &norm_sums[row], ccc, &template_spectra[row * N2], outb, out,
+            pb, px, &used_chans[row], &pad_array[row], num_threads_inner,
+            &variance_warning[i], &missed_corr[i], stack_option,
+            &template_index[row]);
+        if (result != 0){
+            printf("WARNING: %i out-of-range correlations on channel %li\n", result, i);
+        }
+        r += result;
+        if (cached == 0) {
+            destroy_fftwf_plans(pa, pb, px);
+        }
+    }
+
+    fftwf_free(template_ext);
+    fftwf_free(outa);
+    fftwf_free(image_ext);
+    fftwf_free(ccc);
+    fftwf_free(outb);
+    fftwf_free(out);
+    return r;
+}
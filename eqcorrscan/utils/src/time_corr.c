@@ -19,6 +19,18 @@
  */
 #include <libutils.h>
 
+// Number of samples accumulated in float before adding to the double sum
+#ifndef TIME_MAX_BLOCK
+    #define TIME_MAX_BLOCK 64
+#endif
+// Number of templates correlated per pass through the data (the blocked
+// routine is written for 4)
+#define TIME_TEMPLATE_BLOCK 4
+// Number of lags per tile of work in the blocked routine
+#ifndef TIME_LAG_TILE
+    #define TIME_LAG_TILE 2048
+#endif
+
 int normxcorr_time_threaded(float *template, int template_len, float *image, int image_len, float *ccc, int num_threads){
     // Time domain cross-correlation - requires zero-mean template
 	int p, k;
@@ -103,3 +115,279 @@ int multi_normxcorr_time_threaded(float *templates, int template_len, int n_temp
 	}
 	return 0;
 }
+
+int multi_normxcorr_time_max(
+    float *templates, long template_len, long n_templates, float *image,
+    long image_len, long *window_starts, long *window_lens, long n_windows,
+    int *used_chans, float *max_cc, long *max_lag, int num_threads){
+  /*
+  Purpose: find the maximum normalised cross-correlation, and its lag, of
+           multiple templates with one channel of data within windows of
+           lags, without computing the full correlogram.
+  Args:
+    templates:      Zero-mean templates (n_templates, template_len)
+    template_len:   Length of templates
+    n_templates:    Number of templates
+    image:          Data to correlate with
+    image_len:      Length of image
+    window_starts:  Index of the first lag of each window
+    window_lens:    Number of lags in each window
+    n_windows:      Number of windows
+    used_chans:     Whether each template is used (n_templates)
+    max_cc:         Output maximum correlation (n_templates, n_windows)
+    max_lag:        Output index of the maximum relative to the start of the
+                    window (n_templates, n_windows)
+    num_threads:    Number of threads to parallel over (template, window)
+                    pairs
+  Notes:
+    Windows are normalised using the running mean and variance used by the
+    fftw routines. Correlations are direct dot-products, so the cost scales
+    with the number of lags in the windows. Returns the number of
+    out-of-range correlations (set to zero), or -1 on error.
+  */
+    long i, w, n_lags = 0, n_corr = image_len - template_len + 1;
+    long *lag_offsets = NULL;
+    double *mean = NULL, *var = NULL, *auto_a = NULL;
+    int status = 0;
+
+    lag_offsets = (long*) malloc(n_windows * sizeof(long));
+    if (lag_offsets == NULL){
+        printf("ERROR: Error allocating lag_offsets in multi_normxcorr_time_max\n");
+        return -1;
+    }
+    for (w = 0; w < n_windows; ++w){
+        if (window_lens[w] <= 0 || window_starts[w] < 0 ||
+            window_starts[w] + window_lens[w] > n_corr){
+            printf("ERROR: window %ld is outside of the %ld correlations\n", w, n_corr);
+            free(lag_offsets);
+            return -1;
+        }
+        lag_offsets[w] = n_lags;
+        n_lags += window_lens[w];
+    }
+    mean = (double*) malloc(n_lags * sizeof(double));
+    var = (double*) malloc(n_lags * sizeof(double));
+    auto_a = (double*) calloc(n_templates, sizeof(double));
+    if (mean == NULL || var == NULL || auto_a == NULL){
+        printf("ERROR: Error allocating memory in multi_normxcorr_time_max\n");
+        free(lag_offsets); free(mean); free(var); free(auto_a);
+        return -1;
+    }
+    for (w = 0; w < n_windows; ++w){
+        if (running_mean_var(&image[window_starts[w]], window_lens[w] + template_len - 1,
+                             template_len, 0, &mean[lag_offsets[w]], &var[lag_offsets[w]]) != 0){
+            free(lag_offsets); free(mean); free(var); free(auto_a);
+            return -1;
+        }
+    }
+    for (i = 0; i < n_templates; ++i){
+        long p;
+        for (p = 0; p < template_len; ++p){
+            auto_a[i] += (double) templates[i * template_len + p] * (double) templates[i * template_len + p];
+        }
+    }
+
+    #pragma omp parallel for reduction(+:status) num_threads(num_threads)
+    for (i = 0; i < n_templates * n_windows; ++i){
+        long t = i / n_windows, k, p, b;
+        long start = window_starts[i % n_windows];
+        double *_var = &var[lag_offsets[i % n_windows]];
+        float *template = &templates[t * template_len];
+        double best = -2.0, numerator, c;
+        long best_lag = 0;
+
+        if (!used_chans[t] || auto_a[t] <= 0.0){
+            max_cc[i] = 0.0;
+            max_lag[i] = 0;
+            continue;
+        }
+        for (k = 0; k < window_lens[i % n_windows]; ++k){
+            if (_var[k] < ACCEPTED_DIFF){
+                c = 0.0;
+            } else {
+                // Templates are zero-mean, so the data mean cancels out.
+                // Accumulate in float over short blocks so that the inner
+                // loop vectorises, and sum the blocks in double.
+                numerator = 0.0;
+                for (b = 0; b < template_len; b += TIME_MAX_BLOCK){
+                    long block_end = (b + TIME_MAX_BLOCK < template_len) ? b + TIME_MAX_BLOCK : template_len;
+                    float partial = 0.0;
+                    #pragma omp simd reduction(+:partial)
+                    for (p = b; p < block_end; ++p){
+                        partial += template[p] * image[start + k + p];
+                    }
+                    numerator += (double) partial;
+                }
+                c = numerator / sqrt(auto_a[t] * _var[k] * template_len);
+                if (fabs(c) > 1.01){
+                    c = 0.0;
+                    status += 1;
+                } else if (c > 1.0){
+                    c = 1.0;
+                } else if (c < -1.0){
+                    c = -1.0;
+                }
+            }
+            if (c > best){
+                best = c;
+                best_lag = k;
+            }
+        }
+        max_cc[i] = (float) best;
+        max_lag[i] = best_lag;
+    }
+    free(lag_offsets);
+    free(mean);
+    free(var);
+    free(auto_a);
+    return status;
+}
+
+int multi_normxcorr_time_blocked(
+    float *templates, long template_len, long n_templates, float *image,
+    long image_len, float *ccc, int num_threads){
+  /*
+  Purpose: compute the normalised cross-correlations of multiple templates
+           with one channel of data in the time-domain.
+  Args:
+    templates:      Zero-mean templates (n_templates, template_len)
+    template_len:   Length of templates
+    n_templates:    Number of templates
+    image:          Data to correlate with
+    image_len:      Length of image
+    ccc:            Output correlations (n_templates, image_len - template_len + 1)
+    num_threads:    Number of threads to parallel over tiles of correlations
+  Notes:
+    Windows are normalised using the running mean and variance used by the
+    fftw routines, rather than recomputing the energy of every window.
+    Correlations are computed for TIME_TEMPLATE_BLOCK templates per pass
+    through the data, in tiles of TIME_LAG_TILE lags, so that each data
+    sample loaded is used for several templates. Products are accumulated in
+    float over TIME_MAX_BLOCK samples (so that the inner loop vectorises) and
+    the partial sums added in double. Correlations of flat windows, or
+    windows with no variance, are set to zero. Returns the number of out-of-range
+    correlations (set to zero), or -1 on error.
+  */
+    long i, t, flat_run, n_corr = image_len - template_len + 1;
+    long n_blocks = (n_templates + TIME_TEMPLATE_BLOCK - 1) / TIME_TEMPLATE_BLOCK;
+    long n_tiles = (n_corr + TIME_LAG_TILE - 1) / TIME_LAG_TILE;
+    double *mean = NULL, *var = NULL, *auto_a = NULL;
+    float *blocked = NULL;
+    int status = 0;
+
+    if (n_corr <= 0){
+        printf("ERROR: template length %ld is longer than image %ld\n", template_len, image_len);
+        return -1;
+    }
+    mean = (double*) malloc(n_corr * sizeof(double));
+    var = (double*) malloc(n_corr * sizeof(double));
+    auto_a = (double*) calloc(n_blocks * TIME_TEMPLATE_BLOCK, sizeof(double));
+    // Templates padded with zeros to a whole number of blocks
+    blocked = (float*) calloc((size_t) n_blocks * TIME_TEMPLATE_BLOCK * template_len, sizeof(float));
+    if (mean == NULL || var == NULL || auto_a == NULL || blocked == NULL){
+        printf("ERROR: Error allocating memory in multi_normxcorr_time_blocked\n");
+        free(mean); free(var); free(auto_a); free(blocked);
+        return -1;
+    }
+    if (running_mean_var(image, image_len, template_len, 0, mean, var) != 0){
+        free(mean); free(var); free(auto_a); free(blocked);
+        return -1;
+    }
+    // Rounding in the running variance can leave a small residual for flat
+    // windows (e.g. zero-filled gaps), so zero their variance explicitly.
+    flat_run = 0;
+    for (i = 1; i < image_len; ++i){
+        flat_run = (image[i] == image[i - 1]) ? flat_run + 1 : 0;
+        if (flat_run >= template_len - 1 && i - template_len + 1 >= 0){
+            var[i - template_len + 1] = 0.0;
+        }
+    }
+    memcpy(blocked, templates, (size_t) n_templates * template_len * sizeof(float));
+    for (t = 0; t < n_templates; ++t){
+        long p;
+        for (p = 0; p < template_len; ++p){
+            auto_a[t] += (double) templates[t * template_len + p] * (double) templates[t * template_len + p];
+        }
+    }
+
+    #pragma omp parallel for reduction(+:status) num_threads(num_threads)
+    for (i = 0; i < n_blocks * n_tiles; ++i){
+        long block = i / n_tiles, tile_start = (i % n_tiles) * TIME_LAG_TILE;
+        long tile_end = (tile_start + TIME_LAG_TILE < n_corr) ? tile_start + TIME_LAG_TILE : n_corr;
+        long k, p, b, j;
+        float *t0 = &blocked[(size_t) block * TIME_TEMPLATE_BLOCK * template_len];
+        float *t1 = t0 + template_len, *t2 = t1 + template_len, *t3 = t2 + template_len;
+
+        // Two lags per pass, so each template sample loaded is used twice
+        for (k = tile_start; k < tile_end; k += 2){
+            double numerator[2][TIME_TEMPLATE_BLOCK] = {{0.0, 0.0, 0.0, 0.0}, {0.0, 0.0, 0.0, 0.0}};
+            long n_lags = (k + 1 < tile_end) ? 2 : 1, l;
+            float *x = &image[k];
+
+            if (var[k] >= ACCEPTED_DIFF || (n_lags == 2 && var[k + 1] >= ACCEPTED_DIFF)){
+                for (b = 0; b < template_len; b += TIME_MAX_BLOCK){
+                    long block_end = (b + TIME_MAX_BLOCK < template_len) ? b + TIME_MAX_BLOCK : template_len;
+                    float p0 = 0.0, p1 = 0.0, p2 = 0.0, p3 = 0.0;
+                    float q0 = 0.0, q1 = 0.0, q2 = 0.0, q3 = 0.0;
+                    if (n_lags == 2){
+                        #pragma omp simd reduction(+:p0,p1,p2,p3,q0,q1,q2,q3)
+                        for (p = b; p < block_end; ++p){
+                            float x0 = x[p], x1 = x[p + 1];
+                            p0 += t0[p] * x0;
+                            p1 += t1[p] * x0;
+                            p2 += t2[p] * x0;
+                            p3 += t3[p] * x0;
+                            q0 += t0[p] * x1;
+                            q1 += t1[p] * x1;
+                            q2 += t2[p] * x1;
+                            q3 += t3[p] * x1;
+                        }
+                    } else {
+                        #pragma omp simd reduction(+:p0,p1,p2,p3)
+                        for (p = b; p < block_end; ++p){
+                            p0 += t0[p] * x[p];
+                            p1 += t1[p] * x[p];
+                            p2 += t2[p] * x[p];
+                            p3 += t3[p] * x[p];
+                        }
+                    }
+                    numerator[0][0] += (double) p0;
+                    numerator[0][1] += (double) p1;
+                    numerator[0][2] += (double) p2;
+                    numerator[0][3] += (double) p3;
+                    numerator[1][0] += (double) q0;
+                    numerator[1][1] += (double) q1;
+                    numerator[1][2] += (double) q2;
+                    numerator[1][3] += (double) q3;
+                }
+            }
+            for (l = 0; l < n_lags; ++l){
+                for (j = 0; j < TIME_TEMPLATE_BLOCK; ++j){
+                    long _t = block * TIME_TEMPLATE_BLOCK + j;
+                    double c = 0.0;
+                    if (_t >= n_templates){
+                        break;
+                    }
+                    if (var[k + l] >= ACCEPTED_DIFF && auto_a[_t] > 0.0){
+                        // Templates are zero-mean, so the data mean cancels out
+                        c = numerator[l][j] / sqrt(auto_a[_t] * var[k + l] * template_len);
+                        if (fabs(c) > 1.01){
+                            c = 0.0;
+                            status += 1;
+                        } else if (c > 1.0){
+                            c = 1.0;
+                        } else if (c < -1.0){
+                            c = -1.0;
+                        }
+                    }
+                    ccc[(size_t) _t * n_corr + k + l] = (float) c;
+                }
+            }
+        }
+    }
+    free(mean);
+    free(var);
+    free(auto_a);
+    free(blocked);
+    return status;
+}